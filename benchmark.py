@@ -0,0 +1,659 @@
+"""
+Benchmarks for repath.
+
+Run ``python benchmark.py <name>``, or ``python benchmark.py --help`` for the
+list of benchmarks.
+
+"""
+import argparse
+import asyncio
+import gc
+import os
+import random
+import re
+import subprocess
+import sys
+import tracemalloc
+
+import repath
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def make_paths(count, seed=0):
+    """
+    Generate a mix of static and parameterised paths.
+
+    """
+    rand = random.Random(seed)
+    paths = []
+
+    for index in range(count):
+        section = 's%d' % (index // 50)
+        kind = rand.choice(['static', 'param', 'nested'])
+        if kind == 'static':
+            paths.append('/%s/page%d' % (section, index))
+        elif kind == 'param':
+            paths.append('/%s/item%d/:id' % (section, index))
+        else:
+            paths.append('/%s/item%d/:id(\\d+)/:rest*' % (section, index))
+
+    return paths
+
+
+def make_strings(paths, count, seed=0):
+    """
+    Generate strings matching the given paths.
+
+    """
+    rand = random.Random(seed)
+    strings = []
+
+    for _ in range(count):
+        path = rand.choice(paths)
+        strings.append(repath.template(path)({'id': 42, 'rest': ['a', 'b']}))
+
+    return strings
+
+
+def private_dirty_kb():
+    """
+    Read the private dirty memory of this process, in kB (Linux only).
+
+    """
+    total = 0
+    with open('/proc/self/smaps') as fp:
+        for line in fp:
+            if line.startswith('Private_Dirty:'):
+                total += int(line.split()[1])
+    return total
+
+
+def _fork_workers(router, strings, workers):
+    results = []
+
+    for _ in range(workers):
+        read, write = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:  # pragma: no cover
+            os.close(read)
+            before = private_dirty_kb()
+            for string in strings:
+                router.match(string)
+            gc.collect()
+            after = private_dirty_kb()
+            os.write(write, ('%d' % (after - before)).encode('ascii'))
+            os._exit(0)
+
+        os.close(write)
+        os.waitpid(pid, 0)
+        with os.fdopen(read) as fp:
+            results.append(int(fp.read()))
+
+    return sum(results) / float(len(results))
+
+
+@benchmark
+def prefork(args):
+    """
+    Memory each forked worker copies from a shared route table.
+
+    """
+    if not os.path.exists('/proc/self/smaps'):
+        print('prefork: requires /proc/self/smaps (Linux)')
+        return
+
+    paths = make_paths(args.routes)
+    strings = make_strings(paths, 2000)
+
+    for freeze in (False, True):
+        router = repath.Router()
+        for index, path in enumerate(paths):
+            router.add(path, index, name='r%d' % index)
+        router.templates.precompile()
+
+        if freeze:
+            router.freeze()
+        else:
+            gc.collect()
+
+        copied = _fork_workers(router, strings, args.workers)
+        print('%-9s %8.0f kB copied per worker' % (
+            'frozen' if freeze else 'unfrozen', copied))
+
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+
+def _time(function, number):
+    """
+    Best time of *number* runs of *function*, in seconds.
+
+    """
+    best = None
+    for _ in range(number):
+        started = repath.timer()
+        function()
+        elapsed = repath.timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def skewed(items, count, seed=0, exponent=1.2):
+    """
+    Draw *count* items with Zipf-like frequencies, favouring the last items.
+
+    """
+    rand = random.Random(seed)
+    weights = [1.0 / (rank + 1) ** exponent for rank in range(len(items))]
+    ranked = list(reversed(items))
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+
+    def draw():
+        point = rand.random() * total
+        low, high = 0, len(cumulative) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if cumulative[middle] < point:
+                low = middle + 1
+            else:
+                high = middle
+        return ranked[low]
+
+    return [draw() for _ in range(count)]
+
+
+@benchmark
+def adaptive(args):
+    """
+    Matching skewed traffic with and without adaptive ordering.
+
+    """
+    paths = make_paths(min(args.routes, 1000))
+    strings = make_strings(skewed(paths, 200), 20000, seed=1)
+
+    for enabled in (False, True):
+        router = repath.Router(adaptive=enabled)
+        for path in paths:
+            router.add(path)
+
+        def run():
+            for string in strings:
+                router.match(string)
+
+        run()  # warm up, letting the adaptive router settle
+        elapsed = _time(run, args.number)
+        print('%-9s %10.0f matches/s' % (
+            'adaptive' if enabled else 'static', len(strings) / elapsed))
+
+
+@benchmark
+def insensitive(args):
+    """
+    Case insensitive matching with re.IGNORECASE and with case folding.
+
+    """
+    paths = make_paths(min(args.routes, 1000))
+    strings = [string.upper() for string in make_strings(paths, 5000)]
+
+    for name, options in (('re.I', {'flags': re.I}),
+                          ('folded', {'sensitive': False})):
+        router = repath.Router(**options)
+        for path in paths:
+            router.add(path)
+
+        def run():
+            for string in strings:
+                router.match(string)
+
+        elapsed = _time(run, args.number)
+        print('%-9s %10.0f matches/s' % (name, len(strings) / elapsed))
+
+
+@benchmark
+def hosts(args):
+    """
+    Matching tenant host names with a host router and with a router.
+
+    """
+    rand = random.Random(0)
+    tenants = ['tenant%d' % index for index in range(args.routes * 10)]
+    patterns = ['%s.example.com' % tenant for tenant in tenants] + [
+        'api.:tenant.example.com', '*.cdn.example.com', ':tenant.example.com',
+    ]
+    strings = [
+        rand.choice(['%s.example.com', 'api.%s.example.com',
+                     'a.b.cdn.example.com', 'new-%s.example.com'])
+        .replace('%s', rand.choice(tenants))
+        for _ in range(5000)
+    ]
+
+    router = repath.HostRouter()
+    for host in patterns:
+        router.add(host)
+
+    def run():
+        for string in strings:
+            router.match(string)
+
+    elapsed = _time(run, args.number)
+    print('%-9s %10.0f matches/s (%d hosts)' % (
+        'host', len(strings) / elapsed, len(patterns)))
+
+    # a router of all hosts takes too long to build, so only try a tenth
+    patterns = patterns[-args.routes - 3:]
+    router = repath.Router(sensitive=False)
+    for host in patterns:
+        router.add(host.replace(':tenant', ':tenant([^.]+)'))
+
+    elapsed = _time(run, 1)
+    print('%-9s %10.0f matches/s (%d hosts)' % (
+        'router', len(strings) / elapsed, len(patterns)))
+
+
+@benchmark
+def startup(args):
+    """
+    Time taken to import repath in a new interpreter.
+
+    """
+    command = [sys.executable, '-X', 'importtime', '-c', 'import repath']
+    subprocess.check_call(command, stderr=subprocess.DEVNULL)  # cache bytecode
+
+    best = None
+    for _ in range(max(args.number, 5)):
+        output = subprocess.run(
+            command, stderr=subprocess.PIPE, universal_newlines=True, check=True
+        ).stderr
+        for line in output.splitlines():
+            if line.endswith('| repath'):
+                micros = int(line.split('|')[1])
+                best = micros if best is None else min(best, micros)
+    print('%-9s %10d us' % ('import', best))
+
+
+@benchmark
+def dispatch(args):
+    """
+    Requests per second through the WSGI and ASGI dispatchers.
+
+    """
+    paths = make_paths(min(args.routes, 1000))
+    strings = make_strings(paths, 10000)
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [])
+        return [b'']
+
+    async def asgi_app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    for name in ('wsgi', 'asgi'):
+        router = repath.Router()
+        for path in paths:
+            router.add(path, wsgi_app if name == 'wsgi' else asgi_app)
+        router.freeze(collect=False)
+
+        if name == 'wsgi':
+            dispatcher = repath.WSGIDispatcher(router)
+
+            def run():
+                for string in strings:
+                    dispatcher({'PATH_INFO': string}, start_response)
+        else:
+            dispatcher = repath.ASGIDispatcher(router)
+
+            async def serve():
+                for string in strings:
+                    await dispatcher({'type': 'http', 'path': string}, receive, send)
+
+            def run():
+                asyncio.run(serve())
+
+        elapsed = _time(run, args.number)
+        metrics = dispatcher.metrics
+        print('%-9s %10.0f requests/s, %4.1f%% of time routing' % (
+            name, len(strings) / elapsed,
+            100 * metrics.routing / (metrics.routing + metrics.handling)))
+
+
+@benchmark
+def methods(args):
+    """
+    Matching paths with methods, one pattern per route against one per path.
+
+    """
+    rand = random.Random(0)
+    paths = make_paths(min(args.routes, 1000))
+    methods = ['GET', 'POST', 'PUT', 'DELETE']
+    requests = [
+        (string, rand.choice(methods + ['PATCH']))
+        for string in make_strings(paths, 5000)
+    ]
+
+    table = [
+        (repath.compile(path), method, path)
+        for path in paths for method in methods
+    ]
+
+    def scan():
+        for string, method in requests:
+            allowed = set()
+            for regex, allows, target in table:
+                if regex.match(string):
+                    if allows == method:
+                        break
+                    allowed.add(allows)
+
+    router = repath.Router()
+    for path in paths:
+        for method in methods:
+            router.add(path, path, methods=[method])
+
+    def run():
+        for string, method in requests:
+            try:
+                router.match(string, method)
+            except repath.MethodNotAllowed:
+                pass
+
+    for name, function in (('patterns', scan), ('router', run)):
+        elapsed = _time(function, args.number)
+        print('%-9s %10.0f matches/s' % (name, len(requests) / elapsed))
+
+
+@benchmark
+def optimize(args):
+    """
+    Matching with default and optimized patterns.
+
+    """
+    rand = random.Random(0)
+    paths = [
+        '/users/:id', '/users/:id/posts/:post', '/files/:name.:ext',
+        '/:org/:repo/tree/:branch/:path*', '/api/:version/items/:item/',
+    ]
+    pairs = []
+    for path in paths:
+        build = repath.template(path)
+        for _ in range(2000):
+            params = dict(
+                (name, ''.join(rand.choice('abcdefgh0123') for _ in range(
+                    rand.randint(4, 24))))
+                for name in ('id', 'post', 'name', 'ext', 'org', 'repo',
+                             'branch', 'version', 'item')
+            )
+            params['path'] = ['src', 'lib']
+            string = build(params)
+            if rand.random() < 0.3:
+                string += '/extra/segments'  # misses
+            pairs.append((path, string))
+
+    for name, optimized in (('default', False), ('optimized', True)):
+        compiled = dict(
+            (path, repath.compile(path, optimize=optimized)) for path in paths
+        )
+        work = [(compiled[path].match, string) for path, string in pairs]
+
+        def run():
+            for match, string in work:
+                match(string)
+
+        elapsed = _time(run, args.number)
+        print('%-9s %10.0f matches/s' % (name, len(work) / elapsed))
+
+
+@benchmark
+def factor(args):
+    """
+    Matching a list of paths as one pattern, with and without factoring.
+
+    """
+    for count in (100, 1000, min(args.routes, 5000)):
+        # Group names cannot repeat within a pattern, so use unnamed groups
+        paths = [
+            path.replace(':id(\\d+)/:rest*', '(\\d+)').replace(':id', '([^/]+)')
+            for path in make_paths(count)
+        ]
+        strings = [
+            string.replace('/a/b', '')
+            for string in make_strings(make_paths(count), 500)
+        ]
+
+        for factored in (False, True):
+            started = repath.timer()
+            regex = repath.compile(paths, factor=factored)
+            compiled = repath.timer() - started
+
+            def run():
+                for string in strings:
+                    regex.match(string)
+
+            elapsed = _time(run, args.number)
+            print('%5d paths %-9s %10.0f matches/s, compiled in %.2fs' % (
+                count, 'factored' if factored else 'flat',
+                len(strings) / elapsed, compiled))
+
+
+class SeparateRouter(repath.Router):
+    """
+    A router compiling one pattern per route, as routers did before routes of
+    the same shape shared a pattern.
+
+    """
+    def _share(self, entries):
+        return [(entry.regex, entry) for entry in entries]
+
+
+@benchmark
+def tenants(args):
+    """
+    Building and matching per-tenant routes, with and without shared patterns.
+
+    """
+    rand = random.Random(0)
+    shapes = ['/t/%s/items/:id', '/t/%s/orders/:id<int>', '/t/%s/users/:id/edit']
+
+    for count in (100, 1000, 5000):
+        tenants = ['tenant%d' % index for index in range(count)]
+        strings = [
+            rand.choice(shapes).replace(':id<int>', '42').replace(':id', 'x')
+            % rand.choice(tenants)
+            for _ in range(1000)
+        ]
+
+        for name, factory in (('shared', repath.Router), ('separate', SeparateRouter)):
+            tracemalloc.start()
+            started = repath.timer()
+            router = factory()
+            for tenant in tenants:
+                for shape in shapes:
+                    router.add(shape % tenant)
+            added = repath.timer()
+            router.match('/')
+            indexed = repath.timer()
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            # keep collections of the objects just built out of the timings
+            gc.collect()
+
+            def run():
+                for string in strings:
+                    router.match(string)
+
+            elapsed = _time(run, args.number)
+            print(
+                '%5d tenants %-8s added in %6.3fs, indexed in %6.3fs, '
+                '%5d patterns, %8.0f kB, %8.0f matches/s' % (
+                    count, name, added - started, indexed - added,
+                    len(router._full), memory / 1024.0, len(strings) / elapsed))
+
+
+@benchmark
+def results(args):
+    """
+    Matching routes with and without reading their parameters.
+
+    """
+    paths = make_paths(min(args.routes, 1000))
+    strings = make_strings(paths, 5000)
+    router = repath.Router()
+    for path in paths:
+        router.add(path)
+
+    def values():
+        for string in strings:
+            router.match(string)
+
+    def params():
+        for string in strings:
+            router.match(string).params
+
+    for name, function in (('values', values), ('params', params)):
+        elapsed = _time(function, args.number)
+        print('%-7s %10.0f matches/s' % (name, len(strings) / elapsed))
+
+    tracemalloc.start()
+    kept = [router.match(string) for string in strings]
+    lazy = tracemalloc.get_traced_memory()[0]
+    for result in kept:
+        result.params
+    eager = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%.0f bytes per match, %.0f with params' % (
+        lazy / len(kept), eager / len(kept)))
+
+
+@benchmark
+def sampling(args):
+    """
+    Matching routes without a sampler, and with samplers of several rates.
+
+    """
+    paths = make_paths(min(args.routes, 1000))
+    strings = make_strings(paths, 5000)
+
+    for name, sampler in (
+            ('none', None),
+            ('every 1000', repath.MatchSampler(every=1000)),
+            ('every 100', repath.MatchSampler(every=100)),
+            ('every 1', repath.MatchSampler(every=1)),
+            ('profile 100', repath.MatchSampler(every=100, profile=True))):
+        router = repath.Router(sampler=sampler)
+        for path in paths:
+            router.add(path)
+
+        def run():
+            for string in strings:
+                router.match(string)
+
+        elapsed = _time(run, args.number)
+        print('%-11s %10.0f matches/s' % (name, len(strings) / elapsed))
+
+
+@benchmark
+def classify(args):
+    """
+    Classifying many strings with NumPy buckets against trying every path.
+
+    """
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print('skipped, requires numpy')
+        return
+
+    paths = make_paths(min(args.routes, 500))
+    strings = make_strings(paths, 20000) + ['/nothing/%d' % n for n in range(5000)]
+    regexes = [repath.compile(path) for path in paths]
+
+    def loop():
+        results = []
+        for string in strings:
+            for index, regex in enumerate(regexes):
+                if regex.match(string):
+                    results.append(index)
+                    break
+            else:
+                results.append(-1)
+        return results
+
+    def batch():
+        return repath.classify(strings, paths)
+
+    assert batch().tolist() == loop()
+    for name, function in (('loop', loop), ('classify', batch)):
+        elapsed = _time(function, args.number)
+        print('%-8s %10.0f strings/s' % (name, len(strings) / elapsed))
+
+
+@benchmark
+def cache(args):
+    """
+    Matching routes directly and through a warm shared match cache.
+
+    """
+    paths = make_paths(args.routes)
+    strings = make_strings(paths, 5000)
+    router = repath.Router()
+    for path in paths:
+        router.add(path)
+
+    with repath.SharedMatchCache(router, slots=1 << 16) as shared:
+        for string in strings:
+            shared.match(string)
+
+        def direct():
+            for string in strings:
+                router.match(string)
+
+        def cached():
+            for string in strings:
+                shared.match(string)
+
+        for name, function in (('router', direct), ('cache', cached)):
+            elapsed = _time(function, args.number)
+            print('%-6s %10.0f matches/s' % (name, len(strings) / elapsed))
+        shared.unlink()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        'names', nargs='*', metavar='name',
+        help='benchmarks to run: %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--routes', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    for name in args.names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+        print('# %s: %s' % (name, BENCHMARKS[name].__doc__.strip()))
+        BENCHMARKS[name](args)
+        print()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
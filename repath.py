@@ -1,10 +1,15 @@
+import collections
+import gc
+import io
 import re
-
-import six
-from six.moves.urllib import parse as urllib
+import sys
+import time
+from collections.abc import Mapping
 
 REGEXP_TYPE = type(re.compile(''))
 
+timer = time.perf_counter
+
 
 # Match escaped characters that would otherwise appear in future matches.
 # This allows the user to escape special characters that won't transform.
@@ -12,13 +17,15 @@ REGEXP_TYPE = type(re.compile(''))
 # Match Express-style parameters and un-named parameters with a prefix
 # and optional suffixes. Matches appear as:
 #
-#  Path         | prefix | name   | capture | group | suffix | asterisk
-# --------------+--------+--------+---------+-------+--------+----------
-#  /:test(\d+)? | "/"    | "test" | "\d+"   | None  | "?"    | None
-#  /route(\d+)  | None   | None   | None    | "\d+" | None   | None
-#  /*           | "/"    | None   | None    | None  | None   | "*"
-
-PATH_REGEXP = re.compile(r'''
+#  Path          | prefix | name   | converter | capture | group | suffix | asterisk
+# ---------------+--------+--------+-----------+---------+-------+--------+----------
+#  /:test(\d+)?  | "/"    | "test" | None      | "\d+"   | None  | "?"    | None
+#  /:test<int>   | "/"    | "test" | "int"     | None    | None  | None   | None
+#  /route(\d+)   | None   | None   | None      | None    | "\d+" | None   | None
+#  /*            | "/"    | None   | None      | None    | None  | None   | "*"
+
+# The pattern is compiled on first use, see `_path_regexp`.
+PATH_REGEXP_SOURCE = r'''
     (?P<escaped>\\.)
     |
     (?P<prefix>[/.])?
@@ -26,6 +33,11 @@ PATH_REGEXP = re.compile(r'''
         (?:
             \:
             (?P<name>\w+)
+            (?:
+                <
+                (?P<converter>\w+)
+                >
+            )?
             (?:
                 \(
                 (?P<capture>
@@ -52,7 +64,26 @@ PATH_REGEXP = re.compile(r'''
         |
         (?P<asterisk>\*)
     )
-''', re.X)
+'''
+
+
+def _path_regexp():
+    """
+    Compile :data:`PATH_REGEXP` on first use rather than on import.
+
+    """
+    try:
+        return PATH_REGEXP
+    except NameError:
+        regexp = globals()['PATH_REGEXP'] = re.compile(PATH_REGEXP_SOURCE, re.X)
+        return regexp
+
+
+def __getattr__(name):
+    if name == 'PATH_REGEXP':
+        return _path_regexp()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
 
 PATTERNS = dict(
     REPEAT='(?:{prefix}{capture})*',
@@ -60,19 +91,143 @@ PATTERNS = dict(
     REQUIRED='{prefix}({name}{capture})'
 )
 
+# Messages of errors raised by templates and reported by validators.
+MESSAGES = dict(
+    missing='Expected "{name}" to be defined',
+    repeat='Expected "{name}" to not repeat',
+    empty='Expected "{name}" to not be empty',
+    pattern='Expected "{name}" to match "{pattern}"',
+    repeat_pattern='Expected all "{name}" to match "{pattern}"',
+)
+
+# A converter supplies the default pattern of a parameter, turns its matched
+# values into Python objects and formats those objects back into paths. Values
+# whose type is listed in `types` are formatted without being validated.
+Converter = collections.namedtuple(
+    'Converter', ['pattern', 'to_python', 'to_url', 'types']
+)
+
+
+def _int_to_url(value):
+    if value < 0:
+        raise ValueError('Expected "{}" to not be negative'.format(value))
+    return str(value)
+
+
+def _to_uuid(value):
+    import uuid
+
+    return uuid.UUID(value)
+
+
+class _ModuleType(object):
+    """
+    The ``types`` of a converter for a type of a module that may not be
+    imported yet. Values of the type only exist once the module is imported,
+    so it is looked up when checked instead of importing the module.
+
+    """
+    __slots__ = ('module', 'name')
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def __contains__(self, cls):
+        module = sys.modules.get(self.module)
+        return module is not None and cls is getattr(module, self.name, None)
+
+    def __repr__(self):
+        return '<type %s.%s>' % (self.module, self.name)
+
+
+CONVERTERS = dict(
+    int=Converter('[0-9]+', int, _int_to_url, (int,)),
+    uuid=Converter(
+        '[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+        '[0-9a-fA-F]{4}-[0-9a-fA-F]{12}',
+        _to_uuid,
+        str,
+        _ModuleType('uuid', 'UUID')
+    ),
+)
+
+
+def _is_bytes(value):
+    """
+    Determine whether a path or pattern should be handled as raw bytes.
+
+    """
+    return isinstance(value, (bytes, bytearray))
+
 
 def escape_string(string):
     """
     Escape URL-acceptable regex special-characters.
 
     """
+    if _is_bytes(string):
+        return re.sub(b'([.+*?=^!:${}()[\\]|])', br'\\\1', bytes(string))
     return re.sub('([.+*?=^!:${}()[\\]|])', r'\\\1', string)
 
 
 def escape_group(group):
+    if _is_bytes(group):
+        return re.sub(b'([=!:$()])', br'\\\1', bytes(group))
     return re.sub('([=!:$()])', r'\\\1', group)
 
 
+def register_converter(name, pattern, to_python, to_url=None, types=()):
+    """
+    Register a converter for use in paths as ``:param<name>``.
+
+    :param name: name of the converter
+    :param pattern: regular expression matching valid values
+    :param to_python: function converting a matched value to a Python object
+    :param to_url: (optional) function formatting a Python object for a path
+    :param types: (optional) types that *to_url* always formats to valid values
+    :return: The registered :class:`Converter`
+
+    """
+    converter = Converter(pattern, to_python, to_url or str, tuple(types))
+    CONVERTERS[name] = converter
+    return converter
+
+
+def _get_converter(token):
+    converter = token.get('converter')
+    if converter is None or isinstance(converter, Converter):
+        return converter
+    try:
+        return CONVERTERS[converter]
+    except KeyError:
+        raise ValueError('Unknown converter "{}"'.format(converter))
+
+
+def apply_converters(tokens, converters):
+    """
+    Assign converters to the parameters of a list of tokens.
+
+    Parameters still using the default pattern take the converter's pattern.
+
+    :param tokens: list of path tokens as returned by :func:`parse`
+    :param converters: dictionary of parameter names to converter names or
+        :class:`Converter` objects
+    :return: A new list of tokens
+
+    """
+    result = []
+
+    for token in tokens:
+        if not isinstance(token, str) and token['name'] in converters:
+            token = dict(token, converter=converters[token['name']])
+            if token['pattern'] == '[^%s]+?' % token['delimiter']:
+                token['pattern'] = _get_converter(token).pattern
+        result.append(token)
+
+    return result
+
+
 def parse(string):
     """
     Parse a string for the raw tokens.
@@ -86,7 +241,7 @@ def parse(string):
     index = 0
     path = ''
 
-    for match in PATH_REGEXP.finditer(string):
+    for match in _path_regexp().finditer(string):
         parts = match.groupdict()
         offset = match.start(0)
         path += string[index:offset]
@@ -101,6 +256,10 @@ def parse(string):
             path = ''
 
         delimiter = parts['prefix'] or '/'
+        converter = None
+        if parts['converter']:
+            converter = _get_converter(parts)
+
         token_pattern = (
             parts['capture'] or
             parts['group'] or
@@ -120,6 +279,11 @@ def parse(string):
             'pattern': escape_group(token_pattern),
         }
 
+        if converter is not None:
+            token['converter'] = parts['converter']
+            if not parts['capture']:
+                token['pattern'] = converter.pattern
+
         tokens.append(token)
 
     if index < len(string):
@@ -131,86 +295,381 @@ def parse(string):
     return tokens
 
 
-def tokens_to_template(tokens):
+# Characters `urllib.quote` leaves alone in single and repeated parameters.
+QUOTE_SAFE = '-_.!~*\'()'
+QUOTE_SAFE_REPEAT = ''
+
+_unquoted = {}
+
+
+def _unquoted_chars(safe):
+    """
+    List the printable ASCII characters that quoting with *safe* leaves as-is.
+
+    """
+    try:
+        return _unquoted[safe]
+    except KeyError:
+        from urllib.parse import quote
+
+        chars = ''.join(
+            c for c in map(chr, range(32, 127)) if quote(c, safe) == c
+        )
+        _unquoted[safe] = chars
+        return chars
+
+
+def _quoter(safe, memo_size=0):
+    """
+    Build a function percent-encoding values the same way `urllib.quote` does.
+
+    Values made up only of characters that need no quoting are returned
+    unchanged without calling `quote`, and with a *memo_size* up to that many
+    quoted values are remembered.
+
+    """
+    from urllib.parse import quote
+
+    plain = re.compile('[%s]*\\Z' % re.escape(_unquoted_chars(safe)))
+
+    def quote_value(value):
+        if plain.match(value):
+            return value
+        return quote(value.encode('utf8'), safe)
+
+    if not memo_size:
+        return quote_value
+
+    memo = {}
+
+    def quote_memoized(value):
+        try:
+            return memo[value]
+        except KeyError:
+            pass
+
+        if len(memo) >= memo_size:
+            memo.clear()
+
+        quoted = memo[value] = quote_value(value)
+        return quoted
+    return quote_memoized
+
+
+def tokens_to_template(tokens, trusted=False, memo_size=0):
     """
     Generate a function for templating tokens into a path string.
 
+    :param tokens: list of path tokens as returned by :func:`parse`
+    :param trusted: (optional) skip validating values against the patterns
+        of their parameters, for values known to be valid
+    :param memo_size: (optional) number of quoted values to remember for
+        each parameter, for parameters that often repeat the same values
+
     """
-    def template_function(obj):
-        path = ''
+    plan = []
+
+    for token in tokens:
+        if isinstance(token, str):
+            plan.append((token, None, None, None, None))
+            continue
+
+        plan.append((
+            token,
+            None if trusted else re.compile('^%s$' % token['pattern']),
+            _get_converter(token),
+            _quoter(QUOTE_SAFE, memo_size),
+            _quoter(QUOTE_SAFE_REPEAT, memo_size),
+        ))
+
+    def render(obj, write):
         obj = obj or {}
 
-        for token in tokens:
-            if isinstance(token, six.string_types):
-                path += token
+        for token, regexp, converter, quote, quote_repeat in plan:
+            if quote is None:
+                write(token)
                 continue
 
-            regexp = re.compile('^%s$' % token['pattern'])
-
             value = obj.get(token['name'])
             if value is None:
                 if token["optional"]:
                     continue
                 else:
-                    raise KeyError(
-                        'Expected "{name}" to be defined'.format(**token)
-                    )
+                    raise KeyError(MESSAGES['missing'].format(**token))
 
             if isinstance(value, list):
                 if not token['repeat']:
-                    raise TypeError(
-                        'Expected "{name}" to not repeat'.format(**token)
-                    )
+                    raise TypeError(MESSAGES['repeat'].format(**token))
 
                 if len(value) == 0:
                     if token['optional']:
                         continue
                     else:
-                        raise ValueError(
-                            'Expected "{name}" to not be empty'.format(**token)
-                        )
+                        raise ValueError(MESSAGES['empty'].format(**token))
 
                 for i, val in enumerate(value):
-                    val = six.text_type(val)
-                    if not regexp.search(val):
-                        raise ValueError(
-                            'Expected all "{name}" to match "{pattern}"'.format(**token)
-                        )
+                    if converter is not None and type(val) in converter.types:
+                        val = converter.to_url(val)
+                    else:
+                        val = str(val)
+                        if regexp is not None and not regexp.search(val):
+                            raise ValueError(
+                                MESSAGES['repeat_pattern'].format(**token)
+                            )
 
-                    path += token['prefix'] if i == 0 else token['delimiter']
-                    path += urllib.quote(val, '')
+                    write(token['prefix'] if i == 0 else token['delimiter'])
+                    write(quote_repeat(val))
 
                 continue
 
-            value = six.text_type(value)
-            if not regexp.search(value):
-                raise ValueError(
-                    'Expected "{name}" to match "{pattern}"'.format(**token)
-                )
+            if converter is not None and type(value) in converter.types:
+                value = converter.to_url(value)
+            else:
+                value = str(value)
+                if regexp is not None and not regexp.search(value):
+                    raise ValueError(MESSAGES['pattern'].format(**token))
 
-            path += token['prefix'] + urllib.quote(value.encode('utf8'), '-_.!~*\'()')
+            write(token['prefix'])
+            write(quote(value))
 
-        return path
+    def template_function(obj):
+        parts = []
+        render(obj, parts.append)
+        return ''.join(parts)
+
+    def render_into(buf, obj, encoding=None):
+        """
+        Write the path for *obj* into a writable text or binary buffer.
+
+        The path is written in pieces as it is generated, so when a value is
+        invalid the buffer is left with the part of the path before it.
+
+        :param buf: file-like object, such as :class:`io.StringIO` or a file
+        :param obj: dictionary of parameter values
+        :param encoding: (optional) codec for binary buffers, detected from
+            the type and mode of *buf* when not given
+
+        """
+        if encoding is None and _is_binary_buffer(buf):
+            encoding = 'utf-8'
+
+        if encoding is None:
+            render(obj, buf.write)
+        else:
+            write = buf.write
+            render(obj, lambda part: write(part.encode(encoding)))
+
+    def render_iter(objs, separator='\n', encoding='utf-8', batch_size=1000):
+        """
+        Generate paths for many objects as encoded chunks of bytes.
+
+        Each path is followed by *separator*, and the paths of every
+        *batch_size* objects are yielded together, e.g. for
+        ``fp.writelines()``.
+
+        :param objs: iterable of dictionaries of parameter values
+        :return: generator of ``bytes``
+
+        """
+        chunk = []
+        append = chunk.append
+        count = 0
+
+        for obj in objs:
+            render(obj, append)
+            append(separator)
+
+            count += 1
+            if count == batch_size:
+                yield ''.join(chunk).encode(encoding)
+                del chunk[:]
+                count = 0
+
+        if chunk:
+            yield ''.join(chunk).encode(encoding)
+
+    template_function.render_into = render_into
+    template_function.render_iter = render_iter
     return template_function
 
 
-def tokens_to_pattern(tokens, end=True, strict=False):
+def _is_binary_buffer(buf):
+    """
+    Guess whether a file-like object expects bytes to be written to it.
+
+    """
+    if isinstance(buf, (io.RawIOBase, io.BufferedIOBase)):
+        return True
+    if isinstance(buf, io.TextIOBase):
+        return False
+    return 'b' in getattr(buf, 'mode', '')
+
+
+def tokens_to_extractor(tokens, decode=False):
+    """
+    Generate a function for extracting parameters from a match of the tokens.
+
+    The group of every token is located once, up front, so that extracting
+    parameters is a single pass over the groups of the match. Repeated
+    parameters are split on their delimiter into lists, unnamed parameters
+    are keyed by their index (as in :func:`parse`) and parameters with a
+    converter are converted to Python objects.
+
+    :param tokens: list of path tokens as returned by :func:`parse`
+    :param decode: (optional) percent-decode extracted values
+    :return: A function accepting a match of the pattern generated from the
+        same tokens and returning a dictionary of parameters. Values are
+        taken from the matched string, or from the string optionally passed
+        as second argument, which must line up with the matched string. Its
+        ``values`` attribute builds the same dictionary from the tuple of
+        groups of such a match.
+
+    """
+    plan = []
+    index = 0
+
+    for token in tokens:
+        if isinstance(token, str):
+            continue
+
+        nested = re.compile(token['pattern']).groups
+        delimiter = token['delimiter'] if token['repeat'] else None
+        converter = _get_converter(token)
+        convert = converter.to_python if converter is not None else None
+        plan.append((token['name'], index, delimiter, convert))
+
+        # Repeated tokens contain their pattern twice, see `PATTERNS`
+        index += 1 + nested * (2 if token['repeat'] else 1)
+
+    plan = tuple(plan)
+    spans = range(1, index + 1)
+    if decode:
+        from urllib.parse import unquote
+    else:
+        unquote = None
+
+    def extract_values(groups):
+        params = {}
+
+        for name, index, delimiter, convert in plan:
+            value = groups[index]
+
+            if value is not None:
+                if delimiter is not None:
+                    value = value.split(delimiter)
+                    if unquote is not None:
+                        value = [unquote(v) for v in value]
+                    if convert is not None:
+                        value = [convert(v) for v in value]
+                else:
+                    if unquote is not None:
+                        value = unquote(value)
+                    if convert is not None:
+                        value = convert(value)
+
+            params[name] = value
+
+        return params
+
+    def extract_function(match, string=None):
+        if string is None:
+            return extract_values(match.groups())
+        return extract_values([
+            None if start == -1 else string[start:end]
+            for start, end in map(match.span, spans)
+        ])
+
+    extract_function.values = extract_values
+    return extract_function
+
+
+def tokens_to_pattern(tokens, end=True, strict=False, optimize=False):
     """
     Generate a pattern for the given list of tokens.
 
+    With *optimize*, parameters using the default pattern are matched with
+    greedy (and on Python 3.11+ possessive) character classes wherever the
+    rest of the pattern forces them to stop at the same place as the default
+    lazy ones, and the optional trailing delimiter is simplified. Optimized
+    patterns match the same strings with the same groups, except when
+    compiled with :data:`re.MULTILINE`.
+
+    """
+    return '^%s' % _tokens_to_route(tokens, end, strict, optimize=optimize)
+
+
+# Possessive quantifiers are only supported from Python 3.11.
+POSSESSIVE = '+' if sys.version_info >= (3, 11) else ''
+
+
+def _greedy_capture(token, following, end, strict):
+    """
+    Find a greedy pattern equivalent to the default lazy pattern of a token,
+    given the tokens following it, or return ``None``.
+
+    """
+    delimiter = token['delimiter']
+    if token['repeat'] or token['pattern'] != '[^%s]+?' % delimiter:
+        return None
+
+    if following:
+        after = following[0]
+        if isinstance(after, str):
+            stops = after.startswith(delimiter)
+        else:
+            stops = after['prefix'] == delimiter and not after['optional']
+        # The capture cannot contain the delimiter that must follow it, so
+        # it can only end right before the first delimiter
+        return '[^%s]+%s' % (delimiter, POSSESSIVE) if stops else None
+
+    if delimiter == '/' or strict and end:
+        # The capture can only end before a "/" or at the end of the string,
+        # but `$` also matches before a final newline, which the lazy pattern
+        # leaves out of the capture unless it is the only character
+        return '[^{0}][^{0}\\n]*{1}(?:\\n(?!\\Z)[^{0}\\n]*{1})*{1}'.format(
+            delimiter, POSSESSIVE
+        )
+
+    return None
+
+
+def _tokens_to_route(tokens, end, strict, boundary='$', optimize=False):
     """
+    Generate the unanchored body of a pattern for the given list of tokens.
+
+    *boundary* is a zero-width expression standing in for the end of the
+    string, letting paths be matched where they are embedded in a larger
+    body of text.
+
+    """
+    lookahead = '$' if boundary == '$' else '(?=%s)' % boundary
     route = ''
     last = tokens[-1]
-    trailing_slash = isinstance(last, six.string_types) and last.endswith('/')
+    trailing_slash = isinstance(last, str) and last.endswith('/')
+    optimize = optimize and boundary == '$'
+
+    if optimize and trailing_slash and not strict:
+        # The trailing slash is replaced by an optional one below
+        effective = list(tokens[:-1])
+        if last[:-1]:
+            effective.append(last[:-1])
+    else:
+        effective = tokens
 
-    for token in tokens:
-        if isinstance(token, six.string_types):
+    for index, token in enumerate(tokens):
+        if isinstance(token, str):
             route += escape_string(token)
             continue
 
+        capture = None
+        if optimize:
+            capture = _greedy_capture(
+                token, effective[index + 1:], end, strict
+            )
+
         parts = {
             'prefix': escape_string(token['prefix']),
-            'capture': token['pattern'],
+            'capture': capture or token['pattern'],
             'name': ''
         }
 
@@ -226,14 +685,17 @@ def tokens_to_pattern(tokens, end=True, strict=False):
 
     if not strict:
         route = route[:-1] if trailing_slash else route
-        route += '(?:/(?=$))?'
+        if optimize and end:
+            route += '/?'
+        else:
+            route += '(?:/(?=%s))?' % boundary
 
     if end:
-        route += '$'
+        route += lookahead
     else:
-        route += '' if strict and trailing_slash else '(?=/|$)'
+        route += '' if strict and trailing_slash else '(?=/|%s)' % boundary
 
-    return '^%s' % route
+    return route
 
 
 def compile(path, flags=0, **options):
@@ -263,34 +725,3130 @@ def match(path, string, flags=0, **options):
     return compile(path, flags=0, **options).match(string)
 
 
-def pattern(path, **options):
+def pattern(path, converters=None, sort=False, prune=False, factor=False,
+            **options):
     """
     Generate a pattern from any kind of path value.
 
     This function selects the appropriate function array/regex/string paths,
     and calls it with the provided values.
 
-    :param path: express-style path string, or list of paths, or compiled regex
+    :param path: express-style path string, or list of paths, or compiled regex.
+        Paths given as ``bytes`` produce ``bytes`` patterns.
     :param end: Make *path* match to the end of strings (default ``True``)
     :param strict: Enforce trailing slash in matched strins (default ``False``)
+    :param converters: (optional) dictionary of parameter names to converters
+    :param sort: Order a list of paths by specificity, see :func:`sort_paths`
+    :param prune: Drop unreachable paths from a list, see :func:`prune_paths`
+    :param factor: Factor the literal text that consecutive paths of a list
+        start with out of their alternatives, so that it is matched once
     :return: A regular expression pattern string
 
     """
     if isinstance(path, REGEXP_TYPE):
         return path.pattern
     if isinstance(path, list):
-        parts = [pattern(p, **options) for p in path]
+        if sort:
+            path = sort_paths(path, options.get('strict', False), converters)
+        if prune:
+            path = prune_paths(
+                path,
+                options.get('end', True),
+                options.get('strict', False),
+                converters
+            )
+        if factor:
+            return _factored_pattern(path, converters, options)
+        parts = [pattern(p, converters, **options) for p in path]
+        if parts and all(_is_bytes(p) for p in parts):
+            return b'(?:' + b'|'.join(parts) + b')'
         return '(?:%s)' % '|'.join(parts)
+    if _is_bytes(path):
+        # Each byte maps to exactly one latin-1 code point (and back), so the
+        # text machinery produces a pattern that is byte-for-byte correct.
+        text = bytes(path).decode('latin-1')
+        tokens = _parse(text, converters)
+        return tokens_to_pattern(tokens, **options).encode('latin-1')
+
+    return tokens_to_pattern(_parse(path, converters), **options)
+
+
+def _literal_atoms(tokens, body):
+    """
+    Split the literal text a pattern starts with into escaped characters.
+
+    :param tokens: the tokens the pattern was generated from
+    :param body: the pattern
+    :return: A tuple of the escaped characters, and the rest of the pattern
+
+    """
+    atoms = ['^']
+    if tokens and isinstance(tokens[0], str):
+        atoms += re.findall(r'\\.|.', escape_string(tokens[0]), re.S)
+
+    # The literal text may have lost its trailing slash
+    while not body.startswith(''.join(atoms)):
+        atoms.pop()
+
+    return tuple(atoms), body[len(''.join(atoms)):]
+
+
+def _factor(branches):
+    """
+    Join alternatives, factoring out the escaped characters that consecutive
+    alternatives start with.
+
+    Alternatives are tried in the same order and capture the same groups as
+    when joined as they are, as only the literal text they start with is
+    moved, which can only be matched one way.
+
+    :param branches: a list of tuples of the characters an alternative starts
+        with, and the rest of the alternative
+    :return: A list of alternatives
+
+    """
+    alternatives = []
+    index = 0
+
+    while index < len(branches):
+        atoms, rest = branches[index]
+        end = index + 1
+        while atoms and end < len(branches) and branches[end][0][:1] == atoms[:1]:
+            end += 1
+
+        if end - index == 1:
+            alternatives.append(''.join(atoms) + rest)
+            index = end
+            continue
+
+        group = [branch[0] for branch in branches[index:end]]
+        size = 1
+        while all(
+            len(other) > size and other[size] == atoms[size] for other in group
+        ):
+            size += 1
+
+        inner = _factor([
+            (atoms[size:], rest) for atoms, rest in branches[index:end]
+        ])
+        alternatives.append(''.join(atoms[:size]) + '(?:%s)' % '|'.join(inner))
+        index = end
 
-    return tokens_to_pattern(parse(path), **options)
+    return alternatives
 
 
-def template(path):
+def _factored_pattern(paths, converters, options):
+    """
+    Generate the pattern of a list of paths, factoring the literal text they
+    start with.
+
+    """
+    binary = bool(paths) and all(_is_bytes(p) for p in paths)
+    branches = []
+
+    for path in paths:
+        if binary:
+            path = bytes(path).decode('latin-1')
+        if isinstance(path, str):
+            tokens = _parse(path, converters)
+            branches.append(
+                _literal_atoms(tokens, tokens_to_pattern(tokens, **options))
+            )
+        else:
+            branches.append(((), pattern(path, converters, **options)))
+
+    result = '(?:%s)' % '|'.join(_factor(branches))
+    return result.encode('latin-1') if binary else result
+
+
+def _parse(path, converters=None):
+    tokens = parse(path)
+    return apply_converters(tokens, converters) if converters else tokens
+
+
+def template(path, converters=None, **options):
     """
     Compile a string to a template function for the path.
 
     :param path: express-style path string
+    :param converters: (optional) dictionary of parameter names to converters
+    :param options: (optional) dictionary of options accepted by
+        :func:`tokens_to_template`
     :return: A template funcion for generating paths from given field values
 
     """
-    return tokens_to_template(parse(path))
+    return tokens_to_template(_parse(path, converters), **options)
+
+
+def extractor(path, decode=False, converters=None):
+    """
+    Compile a string to a parameter extraction function for the path.
+
+    :param path: express-style path string
+    :param decode: (optional) percent-decode extracted values
+    :param converters: (optional) dictionary of parameter names to converters
+    :return: A function for extracting a dictionary of parameters from a
+        match of the pattern generated from *path*
+
+    """
+    return tokens_to_extractor(_parse(path, converters), decode)
+
+
+ParamError = collections.namedtuple('ParamError', ['name', 'reason', 'message'])
+
+
+def tokens_to_validator(tokens):
+    """
+    Generate a function for checking parameter values against tokens.
+
+    Values are checked exactly as a template function generated from the
+    same tokens would check them, but without building a path, and every
+    problem is reported rather than only the first.
+
+    :param tokens: list of path tokens as returned by :func:`parse`
+    :return: A function accepting a dictionary of parameter values and
+        returning a list of :class:`ParamError` tuples, empty when valid
+
+    """
+    plan = tuple(
+        (token, re.compile('^%s$' % token['pattern']), _get_converter(token))
+        for token in tokens
+        if not isinstance(token, str)
+    )
+
+    def error(token, reason):
+        return ParamError(
+            token['name'], reason, MESSAGES[reason].format(**token)
+        )
+
+    def valid(value, regexp, converter):
+        if converter is not None and type(value) in converter.types:
+            try:
+                converter.to_url(value)
+            except ValueError:
+                return False
+            return True
+        return regexp.search(str(value)) is not None
+
+    def validate_function(obj):
+        errors = []
+        obj = obj or {}
+
+        for token, regexp, converter in plan:
+            value = obj.get(token['name'])
+
+            if value is None:
+                if not token['optional']:
+                    errors.append(error(token, 'missing'))
+            elif isinstance(value, list):
+                if not token['repeat']:
+                    errors.append(error(token, 'repeat'))
+                elif not value:
+                    if not token['optional']:
+                        errors.append(error(token, 'empty'))
+                elif not all(valid(v, regexp, converter) for v in value):
+                    errors.append(error(token, 'repeat_pattern'))
+            elif not valid(value, regexp, converter):
+                errors.append(error(token, 'pattern'))
+
+        return errors
+    return validate_function
+
+
+def validator(path, converters=None):
+    """
+    Compile a string to a parameter validation function for the path.
+
+    :param path: express-style path string
+    :param converters: (optional) dictionary of parameter names to converters
+    :return: A function returning a list of :class:`ParamError` tuples for a
+        dictionary of parameter values
+
+    """
+    return tokens_to_validator(_parse(path, converters))
+
+
+_validators = {}
+
+
+def _cached_validator(path):
+    try:
+        return _validators[path]
+    except KeyError:
+        if len(_validators) >= 256:
+            _validators.clear()
+        function = _validators[path] = validator(path)
+        return function
+
+
+def validate(path, params):
+    """
+    Check parameter values against the parameters of a path.
+
+    :param path: express-style path string
+    :param params: dictionary of parameter values
+    :return: A list of :class:`ParamError` tuples, empty when valid
+
+    """
+    return _cached_validator(path)(params)
+
+
+def validate_many(path, objs):
+    """
+    Check many dictionaries of parameter values against a path.
+
+    :param path: express-style path string
+    :param objs: iterable of dictionaries of parameter values
+    :return: A list with a list of :class:`ParamError` tuples for each
+
+    """
+    function = _cached_validator(path)
+    return [function(obj) for obj in objs]
+
+
+def fold_case(string):
+    """
+    Lower-case a string without changing its length.
+
+    Characters whose lower case form is longer than one character (such as
+    "\u0130") are left as they are.
+
+    """
+    folded = string.lower()
+    if len(folded) == len(string):
+        return folded
+    return ''.join(c if len(c.lower()) != 1 else c.lower() for c in string)
+
+
+def fold_tokens(tokens):
+    """
+    Fold the case of the literal text of a list of tokens.
+
+    Parameter patterns are left untouched, so case sensitive patterns such as
+    ``[A-Z]+`` should not be used for case insensitive matching.
+
+    """
+    return [
+        fold_case(token) if isinstance(token, str) else token
+        for token in tokens
+    ]
+
+
+def normalize(string, merge_slashes=True, strip_dots=True):
+    """
+    Normalize a path before matching it.
+
+    :param string: a path
+    :param merge_slashes: (optional) replace runs of slashes with one slash
+    :param strip_dots: (optional) remove trailing dots from path segments,
+        except from the special segments "." and ".."
+    :return: The normalized path
+
+    """
+    if merge_slashes and '//' in string:
+        string = re.sub('//+', '/', string)
+    if strip_dots and '.' in string:
+        string = re.sub('(?<=[^/.])\\.+(?=/|$)', '', string)
+    return string
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _intern_tokens(tokens, table):
+    """
+    Replace tokens with identical, shared ones from *table*.
+
+    Sharing tokens and interning their strings keeps a large table of routes
+    compact, which also keeps fewer pages for forked processes to copy.
+
+    :return: A tuple of tokens
+
+    """
+    result = []
+
+    for token in tokens:
+        if isinstance(token, str):
+            result.append(_intern(token))
+            continue
+
+        key = tuple(sorted(token.items()))
+        try:
+            shared = table[key]
+        except KeyError:
+            shared = table[key] = dict(
+                (_intern(name), _intern(value))
+                for name, value in token.items()
+            )
+        result.append(shared)
+
+    return tuple(result)
+
+
+# Specificity of a segment, from most to least specific. Paths are compared
+# segment by segment, so `/users/me` ranks before `/users/:id`, which ranks
+# before `/users/*`. Segments past the end of a path rank after all others,
+# placing longer paths ahead of the shorter paths they extend.
+SPECIFICITY = dict(
+    STATIC=0,
+    CUSTOM=1,
+    PARAM=2,
+    OPTIONAL=3,
+    REPEAT=4,
+    WILDCARD=5,
+    END=6,
+)
+
+Conflict = collections.namedtuple('Conflict', ['kind', 'path', 'other'])
+
+
+# The segment standing for whatever follows a kept trailing slash of a path
+# matched without `end`, newlines included
+_REST = dict(
+    name=None, prefix='/', delimiter='/', optional=False, repeat=False,
+    pattern='(?s:.*)'
+)
+
+
+def _segments(path, strict=False, converters=None, end=True):
+    """
+    Split a path into a list of ``(prefix, token)`` segments for analysis.
+
+    Static segments have a string token. Returns ``None`` for paths which
+    cannot be split on "/", such as regular expressions or `/:file.json`.
+
+    """
+    if isinstance(path, REGEXP_TYPE):
+        return None
+    if _is_bytes(path):
+        path = bytes(path).decode('latin-1')
+
+    return _token_segments(_parse(path, converters), strict, end)
+
+
+def _token_segments(tokens, strict=False, end=True):
+    """
+    Split the text tokens of a path into segments, see :func:`_segments`.
+
+    """
+    segments = []
+
+    for token in tokens:
+        if not isinstance(token, str):
+            if token['prefix'] != '/':
+                return None
+            segments.append(('/', token))
+            continue
+
+        for text in re.findall('/[^/]*|[^/]+', token):
+            if not text.startswith('/'):
+                return None
+            segments.append(('/', text[1:]))
+
+    # Without `strict`, trailing slashes are optional and match either way.
+    # With it, but without `end`, anything may follow the trailing slash.
+    if segments and segments[-1] == ('/', ''):
+        if not strict:
+            segments.pop()
+        elif not end:
+            segments[-1] = ('/', _REST)
+
+    return segments
+
+
+def _specificity(segment):
+    prefix, token = segment
+
+    if isinstance(token, str):
+        return SPECIFICITY['STATIC']
+    if token['pattern'] == '.*':
+        return SPECIFICITY['WILDCARD']
+    if token['repeat']:
+        return SPECIFICITY['REPEAT']
+    if token['optional']:
+        return SPECIFICITY['OPTIONAL']
+    if token['pattern'] == '[^/]+?':
+        return SPECIFICITY['PARAM']
+    return SPECIFICITY['CUSTOM']
+
+
+def sort_paths(paths, strict=False, converters=None):
+    """
+    Order paths from most to least specific.
+
+    Paths that cannot be analysed, such as regular expressions, keep their
+    position and only the paths between them are reordered. The sort is
+    stable, so equally specific paths keep their relative order.
+
+    :param paths: list of express-style path strings
+    :return: A new, sorted list of paths
+
+    """
+    result = []
+    run = []
+
+    def flush():
+        run.sort(key=lambda item: item[0])
+        result.extend(path for _, path in run)
+        del run[:]
+
+    for path in paths:
+        segments = _segments(path, strict, converters)
+        if segments is None:
+            flush()
+            result.append(path)
+        else:
+            key = [_specificity(s) for s in segments] + [SPECIFICITY['END']]
+            run.append((key, path))
+
+    flush()
+    return result
+
+
+def _segment_matches(token, text, flags=0):
+    return re.match('(?:%s)\\Z' % token['pattern'], text, flags) is not None
+
+
+def _may_end(token, strict=False):
+    """
+    Whether a segment can match what may follow the end of a path matched
+    with `end`: nothing, and without `strict` a trailing slash, followed by
+    a newline, as `$` also matches before a trailing newline.
+
+    """
+    if isinstance(token, str):
+        return not strict and token in ('', '\n')
+    return token['optional'] or not strict and (
+        _segment_matches(token, '') or _segment_matches(token, '\n')
+    )
+
+
+def _single_line(token):
+    """
+    Whether a segment never matches a newline, which `.*` does not match.
+
+    Confined patterns (see :func:`_confined_pattern`) only match newlines
+    through negated classes.
+
+    """
+    if isinstance(token, str):
+        return '\n' not in token
+    pattern = token['pattern']
+    return _confined_pattern(pattern) and '[^' not in pattern
+
+
+def _covers(a, b, end=True):
+    """
+    Whether every string matched by segments *b* is also matched by *a*.
+
+    This is conservative: ``False`` means "not proven".
+
+    """
+    if not a:
+        return not b or not end
+    if not b:
+        # Required segments that may be empty still match their prefix, which
+        # strings of *b* do not have
+        return all(
+            not isinstance(token, str) and token['optional']
+            for _, token in a
+        )
+
+    (_, first), rest = a[0], a[1:]
+    (_, other), remainder = b[0], b[1:]
+    static = isinstance(first, str)
+
+    if not static:
+        if first is _REST:
+            # Anything follows the slash kept by strings of *b* at this point
+            return isinstance(other, str) or not other['optional']
+        if first['pattern'] == '.*' and not rest:
+            return (
+                first['optional'] or
+                isinstance(other, str) or
+                not other['optional']
+            ) and all(_single_line(token) for _, token in b)
+        if first['optional'] and _covers(rest, b, end):
+            return True
+
+    if isinstance(other, str):
+        if static:
+            covered = first == other
+        else:
+            covered = _segment_matches(first, other)
+    else:
+        covered = (
+            not static and
+            first['pattern'] == other['pattern'] and
+            (first['optional'] or not other['optional']) and
+            (first['repeat'] or not other['repeat'])
+        )
+
+    return covered and _covers(rest, remainder, end)
+
+
+def _overlaps(a, b, end=True, flags=0, strict=False):
+    """
+    Whether some string could be matched by both segments *a* and *b*.
+
+    This is liberal: ``True`` means "not ruled out". Of the regex *flags*,
+    only :data:`re.IGNORECASE` is taken into account.
+
+    """
+    if not a or not b:
+        rest = a or b
+        return not end or all(_may_end(token, strict) for _, token in rest)
+
+    (_, first), (_, other) = a[0], b[0]
+
+    for token, segments, others in ((first, a, b), (other, b, a)):
+        if isinstance(token, str):
+            continue
+        # Parameters that may match more than one segment, such as `.*`,
+        # could match whatever follows them
+        if token['repeat'] or not _confined_pattern(token['pattern']):
+            return True
+        if token['optional'] and _overlaps(
+                segments[1:], others, end, flags, strict):
+            return True
+
+    if isinstance(first, str) and isinstance(other, str):
+        if flags & re.IGNORECASE:
+            compatible = re.match(
+                '%s\\Z' % re.escape(first), other, re.IGNORECASE
+            ) is not None
+        else:
+            compatible = first == other
+    elif isinstance(first, str):
+        last = all(_may_end(token, strict) for _, token in a[1:])
+        compatible = _fits(other, first, last, flags)
+    elif isinstance(other, str):
+        last = all(_may_end(token, strict) for _, token in b[1:])
+        compatible = _fits(first, other, last, flags)
+    else:
+        compatible = True
+
+    return compatible and _overlaps(a[1:], b[1:], end, flags, strict)
+
+
+def _fits(token, text, last, flags):
+    """
+    Whether a parameter can match the text of a static segment lined up with
+    it, or, as `$` and the lookahead of paths matched without `end` also
+    match before a trailing newline, the text and a newline when the static
+    segment may be the last one its path matches.
+
+    """
+    flags &= re.IGNORECASE
+    return _segment_matches(token, text, flags) or (
+        last and _segment_matches(token, text + '\n', flags)
+    )
+
+
+def find_conflicts(paths, end=True, strict=False, converters=None):
+    """
+    Report paths that are shadowed by, or overlap with, earlier paths.
+
+    Paths are reported as ``"unreachable"`` when an earlier path matches
+    everything they match, and as ``"overlap"`` when an earlier path may
+    match some of the same strings, in which case the order of the two paths
+    decides which one matches. Paths that cannot be analysed, such as regular
+    expressions, are never reported.
+
+    :param paths: list of express-style path strings
+    :param end: as accepted by :func:`pattern`
+    :param strict: as accepted by :func:`pattern`
+    :return: A list of :class:`Conflict` tuples of ``(kind, path, other)``
+
+    """
+    return [
+        Conflict(kind, paths[index], paths[other])
+        for kind, index, other in _find_conflicts(paths, end, strict, converters)
+    ]
+
+
+def _find_conflicts(paths, end, strict, converters):
+    analysed = [
+        (index, segments)
+        for index, segments in enumerate(
+            _segments(path, strict, converters, end) for path in paths
+        )
+        if segments is not None
+    ]
+
+    for position, (index, segments) in enumerate(analysed):
+        earlier = analysed[:position]
+
+        for other, shadow in earlier:
+            if _covers(shadow, segments, end):
+                yield 'unreachable', index, other
+                break
+        else:
+            for other, shadow in earlier:
+                if _overlaps(shadow, segments, end, 0, strict):
+                    yield 'overlap', index, other
+
+
+def prune_paths(paths, end=True, strict=False, converters=None):
+    """
+    Remove paths that can never match because earlier paths shadow them.
+
+    :param paths: list of express-style path strings
+    :return: A new list of paths
+
+    """
+    dead = set(
+        index
+        for kind, index, _ in _find_conflicts(paths, end, strict, converters)
+        if kind == 'unreachable'
+    )
+    return [path for index, path in enumerate(paths) if index not in dead]
+
+
+class TemplateRegistry(object):
+    """
+    Templates of named paths, for building paths by name ("reverse routing").
+
+    Paths are parsed when they are added, so malformed paths fail early,
+    while their template functions are only compiled on first use (or by
+    :meth:`precompile`) and then kept for every later lookup. Every use is
+    counted, to help find names that are never used.
+
+    :param converters: (optional) dictionary of parameter names to converters
+    :param options: (optional) dictionary of options accepted by
+        :func:`tokens_to_template`
+
+    """
+    def __init__(self, converters=None, **options):
+        self.converters = converters
+        self.options = options
+        self.paths = collections.OrderedDict()
+        self.usage = collections.Counter()
+        self._tokens = {}
+        self._templates = {}
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, name, path):
+        """
+        Register a path under a name.
+
+        :param name: name of the path, unique within the registry
+        :param path: express-style path string
+
+        """
+        if name in self.paths:
+            raise ValueError('Expected "{}" to be unique'.format(name))
+
+        self._tokens[name] = _parse(path, self.converters)
+        self.paths[name] = path
+
+    def template(self, name):
+        """
+        Return the template function of a named path, compiling it if needed.
+
+        """
+        try:
+            return self._templates[name]
+        except KeyError:
+            function = tokens_to_template(self._tokens[name], **self.options)
+            self._templates[name] = function
+            return function
+
+    def precompile(self):
+        """
+        Compile the template functions of all paths ahead of their first use.
+
+        """
+        for name in self.paths:
+            self.template(name)
+
+    def freeze(self, table=None):
+        """
+        Share identical tokens between paths and compile all templates.
+
+        :param table: (optional) dictionary of tokens to share, for sharing
+            tokens between registries
+
+        """
+        table = {} if table is None else table
+
+        for name, tokens in self._tokens.items():
+            self._tokens[name] = _intern_tokens(tokens, table)
+
+        self._templates.clear()
+        self.precompile()
+
+    def url_for(self, name, params=None):
+        """
+        Build a path from the template of a named path.
+
+        :param name: name of the path
+        :param params: (optional) dictionary of parameter values
+        :return: The generated path string
+
+        """
+        try:
+            function = self._templates[name]
+        except KeyError:
+            function = self.template(name)
+
+        self.usage[name] += 1
+        return function(params)
+
+    def url_for_many(self, requests):
+        """
+        Build paths for a sequence of ``(name, params)`` pairs.
+
+        :return: A list of generated path strings
+
+        """
+        return [self.url_for(name, params) for name, params in requests]
+
+    def unused(self):
+        """
+        List the names of paths that have never been used to build a path.
+
+        """
+        return [name for name in self.paths if not self.usage[name]]
+
+
+class RouteMatch(object):
+    """
+    The route found by :meth:`Router.match` for a string, and its parameters.
+
+    Matching only keeps the groups captured by the route's pattern; the
+    dictionary of parameters is built from them, converting and decoding
+    values, the first time ``params`` is read. Like a ``(route, params)``
+    tuple, it can be unpacked and compared with tuples.
+
+    :ivar route: the matched :class:`Route`
+    :ivar values: tuple of the groups captured by the route's pattern
+
+    """
+    __slots__ = ('route', 'values', '_extract', '_params')
+
+    def __init__(self, route, values=(), extract=None, params=None):
+        self.route = route
+        self.values = values
+        self._extract = extract
+        self._params = params
+
+    @property
+    def params(self):
+        """
+        Dictionary of the parameters of the route, built on first access.
+
+        """
+        params = self._params
+        if params is None:
+            extract = self._extract
+            params = self._params = {} if extract is None else extract(self.values)
+        return params
+
+    def __iter__(self):
+        yield self.route
+        yield self.params
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return (self.route, self.params)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, RouteMatch):
+            other = tuple(other)
+        elif not isinstance(other, tuple):
+            return NotImplemented
+        return tuple(self) == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'RouteMatch(route=%r, params=%r)' % (self.route, self.params)
+
+
+def _captures(match, string=None, groups=None):
+    """
+    The groups of a match, or those numbered in *groups*, taken from *string*
+    when given, which must line up with the matched string.
+
+    """
+    if string is None:
+        if groups is None:
+            return match.groups()
+        if len(groups) > 1:
+            return match.group(*groups)
+        return (match.group(groups[0]),) if groups else ()
+    return tuple(
+        None if start == -1 else string[start:end]
+        for start, end in map(
+            match.span, range(1, match.re.groups + 1) if groups is None else groups)
+    )
+
+
+class MethodNotAllowed(LookupError):
+    """
+    Raised by :meth:`Router.match` when a string matches routes, but none of
+    them for the requested method.
+
+    :ivar allowed: the methods of the routes matching the string
+
+    """
+    def __init__(self, string, method, allowed):
+        self.string = string
+        self.method = method
+        self.allowed = frozenset(allowed)
+        super(MethodNotAllowed, self).__init__(
+            '{!r} does not allow {}, only {}'.format(
+                string, method, ', '.join(sorted(self.allowed)))
+        )
+
+
+class Route(object):
+    """
+    A path added to a :class:`Router`, along with its compiled matchers.
+
+    Routes added with methods share their matchers with the routes of other
+    methods added for the same path, and ``methods`` maps each of those
+    methods to its route. It is ``None`` for routes matching any method.
+
+    """
+    __slots__ = ('path', 'target', 'name', 'tokens', '_regex', 'extract', 'methods')
+
+    def __init__(self, path, target, name, tokens, regex, extract, methods=None):
+        self.path = path
+        self.target = target
+        self.name = name
+        self.tokens = tokens
+        self._regex = regex
+        self.extract = extract
+        self.methods = methods
+
+    @property
+    def regex(self):
+        """
+        The compiled pattern of the route.
+
+        Routers compile it on first use, as routes matched with a pattern
+        shared with other routes never need their own.
+
+        """
+        regex = self._regex
+        if type(regex) is tuple:
+            if self.methods is not None:
+                first = next(iter(self.methods.values()))
+                if first is not self:
+                    return first.regex
+            regex = self._regex = re.compile(*regex)
+        return regex
+
+    def __repr__(self):
+        return '<Route %r>' % (self.path,)
+
+
+class _Shared(object):
+    """
+    Routes of a :class:`Router` that differ only by whole literal segments,
+    matched with one pattern capturing those segments as parameters named
+    ``names``, and told apart by looking up the captured values in
+    ``routes``. ``groups`` are the numbers of the other groups, which line up
+    with the groups of each route's own pattern.
+
+    """
+    __slots__ = ('regex', 'groups', 'names', 'routes')
+
+    def __init__(self, regex, groups, names, routes):
+        self.regex = regex
+        self.groups = groups
+        self.names = names
+        self.routes = routes
+
+    def __repr__(self):
+        return '<Shared %r>' % (self.regex.pattern,)
+
+
+# Parameter patterns that cannot match "/": word characters, `\d`, `\w`,
+# classes of those and negated classes starting with "/", each optionally
+# quantified. Ranges in classes must be between word characters, all of which
+# sort after "/".
+_CONFINED = r'''
+    (?:
+        (?:
+            [\w-] | \\[dw.-] |
+            \[ -? (?: [\w.] | \\[dw.-] | (?<=\w)-(?=\w) )* -? \] |
+            \[\^/ (?: [^\]\\] | \\. )* \]
+        )
+        (?: [+*?] | \{\d+(?:,\d*)?\} )? \??
+    )+
+    \Z
+'''
+
+
+def _confined_pattern(pattern):
+    """
+    Whether a parameter pattern never matches more than one path segment.
+
+    Only the default pattern and simple patterns (such as those of the
+    built-in converters) are recognized.
+
+    """
+    return re.match(_CONFINED, pattern, re.VERBOSE) is not None
+
+
+def _confined(token):
+    """
+    Whether a parameter token always matches exactly one path segment.
+
+    """
+    return (
+        not token['optional'] and
+        not token['repeat'] and
+        token['delimiter'] == '/' and
+        _confined_pattern(token['pattern'])
+    )
+
+
+def _shape(tokens):
+    """
+    Find the shape of a path: its tokens with whole literal segments left out.
+
+    :return: A tuple of the shape, in which left out segments are ``None``,
+        and a tuple of the left out segments; or ``None`` when the path has no
+        whole literal segments, or has parameters that could match more or
+        less than one segment
+
+    """
+    shape = []
+    segments = []
+    last = len(tokens) - 1
+
+    for index, token in enumerate(tokens):
+        if not isinstance(token, str):
+            if not _confined(token):
+                return None
+            shape.append(tuple(sorted(token.items())))
+            continue
+
+        parts = token.split('/')
+        following = None if index == last else tokens[index + 1]
+        for number, part in enumerate(parts):
+            if number:
+                shape.append('/')
+            if number and part and (
+                number < len(parts) - 1 or
+                following is None or
+                not isinstance(following, str) and following['prefix'] == '/'
+            ):
+                shape.append(None)
+                segments.append(part)
+            elif part:
+                shape.append(part)
+
+    return (tuple(shape), tuple(segments)) if segments else None
+
+
+class Mount(object):
+    """
+    A child :class:`Router` mounted on a :class:`Router` under a prefix.
+
+    """
+    __slots__ = ('prefix', 'router', 'tokens', 'regex', 'extract', 'template')
+
+    def __init__(self, prefix, router, tokens, regex, extract):
+        self.prefix = prefix
+        self.router = router
+        self.tokens = tokens
+        self.regex = regex
+        self.extract = extract
+        self.template = tokens_to_template(tokens)
+
+    def __repr__(self):
+        return '<Mount %r>' % (self.prefix,)
+
+
+class Router(object):
+    """
+    An ordered table of paths, matched to find the first route for a string.
+
+    Routes can be grouped under a common prefix by mounting another router.
+    The prefix is matched once and the rest of the string is passed on to
+    the mounted router, so the cost of a lookup grows with the depth of the
+    table rather than the total number of routes.
+
+    :param end: as accepted by :func:`pattern`, for routes of this router
+    :param strict: as accepted by :func:`pattern`
+    :param flags: (optional) regex flags as defined in :mod:`re`
+    :param decode: (optional) percent-decode parameter values
+    :param converters: (optional) dictionary of parameter names to converters
+    :param adaptive: (optional) periodically move the most matched routes
+        ahead of others, see :meth:`reorder`
+    :param interval: (optional) number of matches between reorderings
+    :param sensitive: (optional) match case sensitively; otherwise literal
+        text is folded with :func:`fold_case` when routes are added and
+        strings are folded before matching, which is faster than
+        :data:`re.IGNORECASE`. Parameter values keep their original case.
+    :param normalize: (optional) :func:`normalize` strings before matching
+    :param sampler: (optional) a :class:`MatchSampler` timing a sample of
+        matches
+
+    Static routes that cannot be shadowed by an earlier route are found with
+    a dictionary lookup instead of trying their patterns in turn.
+
+    """
+    def __init__(self, end=True, strict=False, flags=0, decode=False,
+                 converters=None, adaptive=False, interval=1000,
+                 sensitive=True, normalize=False, sampler=None):
+        self.end = end
+        self.strict = strict
+        self.flags = flags
+        self.decode = decode
+        self.converters = converters
+        self.adaptive = adaptive
+        self.interval = interval
+        self.sensitive = sensitive
+        self.normalize = normalize
+        self.sampler = sampler
+        self.entries = []
+        self.templates = TemplateRegistry(converters)
+        self.frozen = False
+        self.hits = collections.Counter()
+        self._registered = []
+        self._constraints = None
+        self._countdown = interval
+        self._static = None
+        self._scan = None
+        self._full = None
+        # Shapes of routes, and each distinct shape, see `_share`
+        self._shapes = {}
+
+    def _compile(self, path, end, lazy=False):
+        tokens = _parse(path, self.converters)
+        source = self._source(tokens, end)
+        regex = source if lazy else re.compile(*source)
+        return tokens, regex, tokens_to_extractor(tokens, self.decode)
+
+    def _source(self, tokens, end):
+        """
+        Generate the arguments of :func:`re.compile` for a list of tokens.
+
+        """
+        folded = tokens if self.sensitive else fold_tokens(tokens)
+        return tokens_to_pattern(
+            folded, end=end, strict=self.strict,
+            optimize=not self.flags & re.MULTILINE
+        ), self.flags
+
+    def add(self, path, target=None, name=None, methods=None):
+        """
+        Add a route to the end of the table.
+
+        Routes added with methods for a path that was already added with
+        other methods share its place in the table, so the path is matched
+        once whatever the method, unless a route added in between could match
+        the same strings.
+
+        :param path: express-style path string
+        :param target: (optional) any value to associate with the route
+        :param name: (optional) name of the route, for :meth:`url_for`
+        :param methods: (optional) HTTP methods matched by the route, or
+            ``None`` to match any method
+        :return: The added :class:`Route`
+
+        """
+        self._check_frozen()
+        if name is not None:
+            self.templates.add(name, path)
+
+        if methods is None:
+            route = Route(path, target, name, *self._compile(path, self.end, True))
+            self._append(route)
+            return route
+
+        methods = [method.upper() for method in methods]
+        entry = self._sibling(path)
+        if entry is None:
+            route = Route(
+                path, target, name, *self._compile(path, self.end, True),
+                methods=collections.OrderedDict()
+            )
+            self._append(route)
+        else:
+            route = Route(
+                path, target, name, entry.tokens, entry._regex, entry.extract,
+                methods=entry.methods
+            )
+
+        for method in methods:
+            route.methods.setdefault(method, route)
+        return route
+
+    def _sibling(self, path):
+        """
+        Find the entry of a path added with methods, if no entry added since
+        could match the same strings.
+
+        """
+        later = []
+        for entry in reversed(self._registered):
+            if (
+                type(entry) is Route and
+                entry.path == path and
+                entry.methods is not None
+            ):
+                break
+            later.append(entry)
+        else:
+            return None
+
+        segments = _segments(path, self.strict, self.converters, self.end)
+        flags = self.flags | (0 if self.sensitive else re.IGNORECASE)
+        for other in later:
+            if type(other) is Route:
+                others = _segments(
+                    other.path, self.strict, self.converters, self.end)
+            else:
+                others = _segments(
+                    other.prefix, self.strict, self.converters, False)
+            if segments is None or others is None or _overlaps(
+                    segments, others, self.end and type(other) is Route, flags,
+                    self.strict):
+                return None
+
+        return entry
+
+    def mount(self, prefix, router):
+        """
+        Mount a router under a prefix at the end of the table.
+
+        Parameters of the prefix are merged with the parameters of routes
+        matched in the mounted router.
+
+        :param prefix: express-style path string, matched with ``end=False``
+        :param router: the :class:`Router` to dispatch the rest of strings to
+        :return: The mounted *router*
+
+        """
+        self._check_frozen()
+        self._append(Mount(prefix, router, *self._compile(prefix, False)))
+        return router
+
+    def _append(self, entry):
+        self.entries.append(entry)
+        self._registered.append(entry)
+        self._constraints = None
+        self._static = None
+
+    def _index(self):
+        """
+        Index static routes that no earlier entry could shadow by their path.
+
+        The remaining entries are kept, in order, for matching in turn.
+
+        """
+        static = {}
+        constraints = self._get_constraints()
+
+        if self.end and not self.flags & re.IGNORECASE:
+            for entry in self._registered:
+                if type(entry) is not Route or constraints[entry]:
+                    continue
+                if len(entry.tokens) > 1 or not all(
+                        isinstance(token, str)
+                        for token in entry.tokens):
+                    continue
+
+                path = ''.join(entry.tokens)
+                path = path if self.sensitive else fold_case(path)
+                if self.strict:
+                    keys = [path]
+                else:
+                    path = path[:-1] if path.endswith('/') else path
+                    keys = [path, path + '/']
+                for key in keys:
+                    static.setdefault(key, entry)
+
+        indexed = set(static.values())
+        self._full = self._share(self.entries)
+        self._scan = self._share(
+            [entry for entry in self.entries if entry not in indexed]
+        ) if indexed else self._full
+        self._static = static
+
+    def _share(self, entries):
+        """
+        List the patterns to match in turn, along with their entries.
+
+        Routes of the same shape (see :func:`_shape`) share a pattern when no
+        route of another shape in between could match the same strings.
+        Routes are found in a shared pattern by their exact or case folded
+        segments, so nothing is shared with :data:`re.IGNORECASE`.
+
+        :return: A list of tuples of a compiled pattern, and a :class:`Route`,
+            :class:`Mount` or :class:`_Shared`
+
+        """
+        if self.flags & re.IGNORECASE:
+            return [(entry.regex, entry) for entry in entries]
+
+        constraints = self._get_constraints()
+        items = []
+        position = {}
+        groups = {}
+
+        for entry in entries:
+            found = None
+            if type(entry) is Route:
+                try:
+                    found = self._shapes[entry]
+                except KeyError:
+                    found = _shape(entry.tokens)
+                    if found is not None:
+                        # Routes of one shape keep a single copy of it
+                        shape = self._shapes.setdefault(found[0], found[0])
+                        found = shape, found[1]
+                    self._shapes[entry] = found
+
+            if found is not None:
+                shape, segments = found
+                # Routes with the same segments as a member cannot join it
+                key = segments if self.sensitive else tuple(
+                    fold_case(segment) for segment in segments)
+                group = groups.get(shape)
+                if group is not None and key not in group[3] and all(
+                    position.get(other, -1) <= group[0]
+                    for other in constraints[entry]
+                ):
+                    group[2].append((entry, segments))
+                    group[3].add(key)
+                    position[entry] = group[0]
+                    continue
+
+                group = groups[shape] = [
+                    len(items), shape, [(entry, segments)], set([key])]
+                position[entry] = len(items)
+                items.append(group)
+                continue
+
+            position[entry] = len(items)
+            items.append(entry)
+
+        result = []
+        for item in items:
+            if type(item) is list:
+                result.extend(self._shared(item[1], item[2]))
+            else:
+                result.append((item.regex, item))
+        return result
+
+    def _shared(self, shape, members):
+        """
+        Build the pattern shared by routes of the same shape.
+
+        :return: A list of tuples of a compiled pattern and its entry
+
+        """
+        fold = (lambda text: text) if self.sensitive else fold_case
+        columns = list(zip(*[
+            [fold(segment) for segment in segments] for _, segments in members
+        ]))
+        varying = [len(set(column)) > 1 for column in columns]
+        if len(members) == 1 or not any(varying):
+            return [(entry.regex, entry) for entry, _ in members]
+
+        tokens = []
+        names = []
+        segments = iter(zip(members[0][1], varying))
+        for piece in shape:
+            if piece is None:
+                segment, varies = next(segments)
+                if varies:
+                    names.append('_repath_%d' % len(names))
+                    piece = {
+                        'name': names[-1], 'prefix': '', 'delimiter': '/',
+                        'optional': False, 'repeat': False, 'pattern': '[^/]+?',
+                    }
+                else:
+                    piece = segment
+            elif not isinstance(piece, str):
+                piece = dict(piece)
+
+            if isinstance(piece, str) and tokens and isinstance(tokens[-1], str):
+                tokens[-1] += piece
+            else:
+                tokens.append(piece)
+
+        routes = {}
+        for entry, segments in members:
+            key = tuple(
+                fold(segment) for segment, varies in zip(segments, varying)
+                if varies
+            )
+            routes.setdefault(key[0] if len(key) == 1 else key, entry)
+
+        regex = re.compile(*self._source(tokens, self.end))
+        segments = set(regex.groupindex[name] for name in names)
+        groups = tuple(
+            number for number in range(1, regex.groups + 1)
+            if number not in segments
+        )
+
+        shared = _Shared(regex, groups, tuple(names), routes)
+        return [(regex, shared)]
+
+    def _check_frozen(self):
+        if self.frozen:
+            raise RuntimeError('Expected router to not be frozen')
+
+    def _hit(self, entry):
+        self.hits[entry] += 1
+        self._countdown -= 1
+        if self._countdown <= 0:
+            self.reorder()
+
+    def _get_constraints(self):
+        """
+        Map each entry to the earlier entries it must stay behind.
+
+        Entries that may match the same strings must keep the order they were
+        added in. Entries that cannot be analysed stay behind everything
+        added before them, and ahead of everything added after them.
+
+        """
+        if self._constraints is not None:
+            return self._constraints
+
+        analysed = []
+        for entry in self._registered:
+            if type(entry) is Route:
+                path, end = entry.path, self.end
+            else:
+                path, end = entry.prefix, False
+            if isinstance(path, str):
+                segments = _token_segments(entry.tokens, self.strict, end)
+            else:
+                segments = _segments(path, self.strict, self.converters, end)
+            analysed.append((entry, segments))
+
+        flags = self.flags | (0 if self.sensitive else re.IGNORECASE)
+
+        # Up to their first parameter, paths line up segment by segment, so
+        # paths can only overlap when the literal segments they start with
+        # agree. Each node of this trie of literal segments holds the indexes
+        # of the entries whose literal segments end there, of all entries
+        # below it, and its children.
+        root = ([], [], {})
+        constraints = {}
+
+        for index, (entry, segments) in enumerate(analysed):
+            keys = []
+            for _, token in segments or ():
+                if not isinstance(token, str):
+                    break
+                if flags & re.IGNORECASE:
+                    if any(ord(char) > 127 for char in token):
+                        break
+                    token = token.lower()
+                keys.append(token)
+
+            if segments is None:
+                candidates = range(index)
+            else:
+                node = root
+                candidates = list(node[0])
+                for key in keys:
+                    node = node[2].get(key)
+                    if node is None:
+                        break
+                    candidates.extend(node[0])
+                else:
+                    candidates.extend(node[1])
+                candidates = sorted(set(candidates))
+
+            end = self.end and type(entry) is Route
+            before = constraints[entry] = []
+            for other, earlier in map(analysed.__getitem__, candidates):
+                if (
+                    segments is None or
+                    earlier is None or
+                    _overlaps(
+                        earlier, segments, end and type(other) is Route,
+                        flags, self.strict)
+                ):
+                    before.append(other)
+
+            node = root
+            node[1].append(index)
+            for key in keys if segments is not None else ():
+                node = node[2].setdefault(key, ([], [], {}))
+                node[1].append(index)
+            node[0].append(index)
+
+        self._constraints = constraints
+        return constraints
+
+    def reorder(self):
+        """
+        Order entries by their number of hits, most matched first.
+
+        Entries only move ahead of entries that cannot match the same strings,
+        so the route found for any string never changes. Hit counts are halved
+        afterwards, so the order follows changes in traffic. Only adaptive
+        routers reorder themselves; otherwise the order is only changed by
+        calling this method.
+
+        """
+        import heapq
+
+        constraints = self._get_constraints()
+        position = dict((entry, index) for index, entry in enumerate(self._registered))
+        waiting = dict((entry, len(before)) for entry, before in constraints.items())
+        after = collections.defaultdict(list)
+        for entry, before in constraints.items():
+            for other in before:
+                after[other].append(entry)
+
+        # An entry holding back others is as urgent as the busiest of them
+        hits = self.hits
+        urgency = {}
+        for entry in reversed(self._registered):
+            urgency[entry] = max(
+                [hits[entry]] + [urgency[other] for other in after[entry]]
+            )
+
+        def key(entry):
+            return (-urgency[entry], -hits[entry], position[entry], entry)
+
+        ready = [key(entry) for entry in self._registered if not waiting[entry]]
+        heapq.heapify(ready)
+        entries = []
+
+        while ready:
+            entry = heapq.heappop(ready)[-1]
+            entries.append(entry)
+            for other in after[entry]:
+                waiting[other] -= 1
+                if not waiting[other]:
+                    heapq.heappush(ready, key(other))
+
+        self.entries = tuple(entries) if self.frozen else entries
+        self._static = None
+        self.hits = collections.Counter(
+            dict((entry, count // 2) for entry, count in hits.items() if count > 1)
+        )
+        self._countdown = self.interval
+
+    def freeze(self, collect=True):
+        """
+        Prepare the table for sharing with forked worker processes.
+
+        Call this in the parent process, once all routes are added and before
+        forking. Everything used to match routes and build paths is compiled
+        up front, identical tokens are shared between routes and the table
+        becomes read-only. With *collect*, the garbage collector is run and,
+        where supported (Python 3.7+), all objects are moved out of its
+        tracking with :func:`gc.freeze`, so that collections in the workers
+        do not write to, and thereby copy, the pages holding the table.
+
+        :param collect: (optional) collect and freeze garbage collection
+        :return: The router
+
+        """
+        self._freeze({})
+
+        if collect:
+            gc.collect()
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+
+        return self
+
+    def _freeze(self, table):
+        if self.frozen:
+            return
+
+        for entry in self.entries:
+            entry.tokens = _intern_tokens(entry.tokens, table)
+            entry.extract = tokens_to_extractor(entry.tokens, self.decode)
+
+            if type(entry) is Route and entry.methods is not None:
+                for route in entry.methods.values():
+                    route.tokens = entry.tokens
+                    route.extract = entry.extract
+
+            if type(entry) is Mount:
+                entry.template = tokens_to_template(entry.tokens)
+                entry.router._freeze(table)
+
+        self.templates.freeze(table)
+        self.entries = tuple(self.entries)
+        self._index()
+        self.frozen = True
+
+    def match(self, string, method=None):
+        """
+        Find the first route matching a string.
+
+        :param string: a path to match against the routes of the table
+        :param method: (optional) the HTTP method routes added with methods
+            must match, in any case; by default methods are ignored
+        :return: A :class:`RouteMatch` of the route and its parameters, or
+            ``None``
+        :raises MethodNotAllowed: when routes match the string, but none of
+            them for *method*
+
+        """
+        if method is not None:
+            # Methods are added upper-cased, so match them the same way
+            method = method.upper()
+
+        sampler = self.sampler
+        if sampler is not None and sampler.due():
+            return self._sampled(string, method)
+
+        if method is None:
+            return self._match(string, None, None)
+        return self._lookup(string, method)
+
+    def _lookup(self, string, method):
+        if method is None:
+            return self._match(string, None, None)
+
+        allowed = set()
+        result = self._match(string, method, allowed)
+        if result is None and allowed:
+            raise MethodNotAllowed(string, method, allowed)
+        return result
+
+    def _sampled(self, string, method):
+        result = None
+        started = self.sampler.start()
+        try:
+            result = self._lookup(string, method)
+            return result
+        finally:
+            self.sampler.stop(
+                started, string, method, None if result is None else result.route)
+
+    def _match(self, string, method, allowed):
+        """
+        Find the first route matching a string and method, collecting the
+        methods of routes only matching the string into *allowed*.
+
+        """
+        if self.normalize:
+            string = normalize(string)
+        subject = string if self.sensitive else fold_case(string)
+        values = None if self.sensitive else string
+
+        if self._static is None:
+            self._index()
+
+        if subject.endswith('\n'):
+            # `$` also matches before a trailing newline, which the index of
+            # static paths cannot know about
+            entries = self._full
+        else:
+            entries = self._scan
+            entry = self._static.get(subject)
+            if entry is not None:
+                route = entry
+                if method is not None and entry.methods is not None:
+                    route = entry.methods.get(method)
+                    if route is None:
+                        allowed.update(entry.methods)
+                if route is not None:
+                    if self.adaptive:
+                        self._hit(entry)
+                    return RouteMatch(route)
+
+        for regex, entry in entries:
+            match = regex.match(subject)
+            if match is None:
+                continue
+
+            kind = type(entry)
+            shared = None
+            if kind is _Shared:
+                shared = entry
+                entry = shared.routes.get(match.group(*shared.names))
+                if entry is None:
+                    continue
+                kind = Route
+
+            if kind is Route:
+                route = entry
+                if method is not None and entry.methods is not None:
+                    route = entry.methods.get(method)
+                    if route is None:
+                        allowed.update(entry.methods)
+                        continue
+                if self.adaptive:
+                    self._hit(entry)
+                groups = None if shared is None else shared.groups
+                return RouteMatch(
+                    route, _captures(match, values, groups), entry.extract.values)
+
+            result = entry.router._match(
+                string[match.end():] or '/', method, allowed
+            )
+            if result is not None:
+                if self.adaptive:
+                    self._hit(entry)
+                params = entry.extract(match, values)
+                params.update(result.params)
+                return RouteMatch(
+                    result.route, _captures(match, values) + result.values,
+                    params=params,
+                )
+
+        return None
+
+    def url_for(self, name, params=None):
+        """
+        Build the path of a named route, including the prefixes of routers
+        it is mounted under.
+
+        :param name: name of the route
+        :param params: (optional) dictionary of parameter values
+        :return: The generated path string
+
+        """
+        if name in self.templates:
+            return self.templates.url_for(name, params)
+
+        for entry in self.entries:
+            if type(entry) is Mount and entry.router.has_route(name):
+                path = entry.router.url_for(name, params)
+                prefix = entry.template(params)
+                return prefix if path == '/' and prefix else prefix + path
+
+        raise KeyError('Expected "{}" to be a route name'.format(name))
+
+    def url_for_many(self, requests):
+        """
+        Build paths for a sequence of ``(name, params)`` pairs.
+
+        :return: A list of generated path strings
+
+        """
+        url_for = self.url_for
+        return [url_for(name, params) for name, params in requests]
+
+    def has_route(self, name):
+        """
+        Whether a route of the given name exists in this or a mounted router.
+
+        """
+        return name in self.templates or any(
+            entry.router.has_route(name)
+            for entry in self.entries
+            if type(entry) is Mount
+        )
+
+
+HostMatch = collections.namedtuple('HostMatch', ['host', 'route', 'params'])
+
+
+class Host(object):
+    """
+    A host pattern added to a :class:`HostRouter`.
+
+    """
+    __slots__ = ('host', 'target', 'router', 'tokens')
+
+    def __init__(self, host, target, router, tokens):
+        self.host = host
+        self.target = target
+        self.router = router
+        self.tokens = tokens
+
+    def __repr__(self):
+        return '<Host %r>' % (self.host,)
+
+
+class _HostNode(object):
+    """
+    A node of the reversed-label trie of a :class:`HostRouter`.
+
+    """
+    __slots__ = ('children', 'params', 'tails', 'host')
+
+    def __init__(self):
+        self.children = {}
+        self.params = collections.OrderedDict()
+        self.tails = []
+        self.host = None
+
+
+def _is_tail(piece):
+    """
+    Whether a token of a host pattern can match more or less than one label.
+
+    """
+    return not isinstance(piece, str) and (
+        piece['optional'] or piece['repeat'] or piece['pattern'] == '.*'
+    )
+
+
+def _host_labels(tokens):
+    """
+    Split the tokens of a host pattern prefixed with "." into labels.
+
+    :return: A list of labels, each a list of strings and tokens
+
+    """
+    labels = []
+
+    for token in tokens:
+        if isinstance(token, str):
+            parts = token.split('.')
+            if parts[0]:
+                labels[-1].append(parts[0])
+            labels.extend([part] if part else [] for part in parts[1:])
+        elif token['prefix'] == '.':
+            labels.append([token])
+        else:
+            labels[-1].append(token)
+
+    return labels
+
+
+def _join_labels(labels):
+    """
+    Join labels back into the tokens of a host pattern prefixed with ".".
+
+    """
+    tokens = []
+
+    for label in labels:
+        first = label[0] if label else ''
+        if isinstance(first, str) or first['prefix'] != '.':
+            tokens.append('.')
+        tokens.extend(label)
+
+    return tokens
+
+
+class HostRouter(object):
+    """
+    Match host names against a table of host patterns.
+
+    Host patterns use "." as delimiter, for example ``:tenant.example.com``.
+    Literal labels are indexed from right to left in a trie, so looking up a
+    host takes a few dictionary lookups however many hosts are added, and
+    parameter patterns are only tried for the labels that are not literal.
+
+    Unlike :class:`Router`, where the first matching path wins, literal
+    labels are preferred over parameters, comparing labels from the right:
+    ``www.example.com`` wins over ``:tenant.example.com`` whatever the order
+    they were added in. Hosts with the same labels are tried in the order
+    they were added.
+
+    :param sensitive: (optional) match case sensitively; host names are case
+        insensitive so this is off by default. Parameter values keep their
+        original case.
+    :param converters: (optional) a dictionary of converters by name
+
+    """
+    def __init__(self, sensitive=False, converters=None):
+        self.sensitive = sensitive
+        self.converters = converters
+        self.hosts = []
+        self._root = _HostNode()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def _label_matcher(self, label):
+        tokens = [
+            dict(piece, prefix='') if index == 0 and not isinstance(
+                piece, str) else piece
+            for index, piece in enumerate(label)
+        ]
+        return self._matcher(tokens)
+
+    def _matcher(self, tokens):
+        folded = tokens if self.sensitive else fold_tokens(tokens)
+        regex = re.compile(
+            tokens_to_pattern(folded, end=True, strict=True, optimize=True)
+        )
+        return regex, tokens_to_extractor(tokens)
+
+    def add(self, host, target=None, router=None):
+        """
+        Add a host pattern.
+
+        :param host: a host pattern, such as ``:tenant.example.com``
+        :param target: (optional) any object, returned with matches
+        :param router: (optional) a :class:`Router` matching the paths
+            requested from this host
+        :return: The added :class:`Host`
+
+        """
+        tokens = _parse('.' + host, self.converters)
+        entry = Host(host, target, router, tokens)
+        labels = _host_labels(tokens)
+        node = self._root
+
+        while labels and not any(map(_is_tail, labels[-1])):
+            label = labels.pop()
+            if all(isinstance(piece, str) for piece in label):
+                key = ''.join(label)
+                key = key if self.sensitive else fold_case(key)
+                node = node.children.setdefault(key, _HostNode())
+                continue
+
+            key = tokens_to_pattern(label, end=True, strict=True)
+            if key not in node.params:
+                regex, extract = self._label_matcher(label)
+                node.params[key] = (regex, extract, _HostNode())
+            node = node.params[key][2]
+
+        if labels:
+            regex, extract = self._matcher(_join_labels(labels))
+            node.tails.append((regex, extract, entry))
+        elif node.host is None:
+            node.host = entry
+
+        self.hosts.append(entry)
+        return entry
+
+    def _candidates(self, node, labels, original, index):
+        """
+        Generate the hosts matching the first *index* labels, most specific
+        first, along with their parameters.
+
+        """
+        if index:
+            label = labels[index - 1]
+            child = node.children.get(label)
+            if child is not None:
+                for found in self._candidates(child, labels, original, index - 1):
+                    yield found
+
+            for regex, extract, child in node.params.values():
+                match = regex.match(label)
+                if match is None:
+                    continue
+                for entry, params in self._candidates(
+                        child, labels, original, index - 1):
+                    params.update(extract(match, original[index - 1]))
+                    yield entry, params
+
+        elif node.host is not None:
+            yield node.host, {}
+
+        if node.tails:
+            subject = '.' + '.'.join(labels[:index]) if index else ''
+            value = '.' + '.'.join(original[:index]) if index else ''
+            for regex, extract, entry in node.tails:
+                match = regex.match(subject)
+                if match is not None:
+                    yield entry, extract(match, value)
+
+    def match(self, host, path=None):
+        """
+        Match a host name, and optionally a path on that host.
+
+        A port and a trailing "." are ignored. When a path is given, only
+        hosts with a router matching the path are considered.
+
+        :param host: a host name, such as the value of a "Host" header
+        :param path: (optional) a path to match with the host's router
+        :return: A :class:`HostMatch` of the host, the :class:`Route` matched
+            by the host's router if a path was given, and the parameters of
+            both, or ``None``
+
+        """
+        name, colon, port = host.rpartition(':')
+        if colon and port.isdigit() and not name.endswith(':'):
+            host = name
+        if host.endswith('.'):
+            host = host[:-1]
+
+        original = host.split('.')
+        labels = original if self.sensitive else fold_case(host).split('.')
+
+        for entry, params in self._candidates(
+                self._root, labels, original, len(labels)):
+            if path is None:
+                return HostMatch(entry, None, params)
+            if entry.router is None:
+                continue
+            result = entry.router.match(path)
+            if result is not None:
+                params.update(result.params)
+                return HostMatch(entry, result.route, params)
+
+        return None
+
+
+class DispatchMetrics(object):
+    """
+    Time spent routing requests and handling them, as recorded by
+    :class:`WSGIDispatcher` and :class:`ASGIDispatcher`.
+
+    Any object with a ``record`` method accepting the same arguments can be
+    given to a dispatcher instead, for example to export the time of each
+    request.
+
+    """
+    __slots__ = ('requests', 'unmatched', 'routing', 'handling')
+
+    def __init__(self):
+        self.requests = 0
+        self.unmatched = 0
+        self.routing = 0.0
+        self.handling = 0.0
+
+    def record(self, route, routing, handling):
+        """
+        Record a request.
+
+        :param route: the matched :class:`Route`, or ``None``
+        :param routing: seconds spent matching the path
+        :param handling: seconds spent in the application
+
+        """
+        self.requests += 1
+        self.unmatched += route is None
+        self.routing += routing
+        self.handling += handling
+
+    def __repr__(self):
+        return '<DispatchMetrics requests=%d routing=%.6fs handling=%.6fs>' % (
+            self.requests, self.routing, self.handling)
+
+
+SlowMatch = collections.namedtuple(
+    'SlowMatch', ['seconds', 'string', 'method', 'route']
+)
+
+
+class MatchSampler(object):
+    """
+    Time one lookup in every *every* and keep the slowest of them.
+
+    Give it to a :class:`Router` as ``sampler``, or sample any matching
+    function, such as the ``match`` method of a compiled pattern, with
+    :meth:`wrap`. Lookups that are not sampled only count down to the next
+    sample, and routers without a sampler only check that they have none.
+
+    :param every: (optional) number of lookups per sampled lookup
+    :param threshold: (optional) seconds a sampled lookup must take to be kept
+    :param size: (optional) number of slowest lookups kept
+    :param profile: (optional) run sampled lookups under a
+        :class:`cProfile.Profile`, see :meth:`stats`
+
+    """
+    def __init__(self, every=100, threshold=0.0, size=20, profile=False):
+        self.every = every
+        self.threshold = threshold
+        self.size = size
+        self.sampled = 0
+        self.slow = 0
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self._countdown = every
+        self._heap = []
+        self._order = 0
+
+    def due(self):
+        """
+        Count a lookup, and whether it should be sampled.
+
+        """
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        self._countdown = self.every
+        return True
+
+    def start(self):
+        """
+        Start timing a sampled lookup.
+
+        :return: The time to pass on to :meth:`stop`
+
+        """
+        if self.profiler is not None:
+            self.profiler.enable()
+        return timer()
+
+    def stop(self, started, string, method=None, route=None):
+        """
+        Stop timing a sampled lookup, keeping it if it is among the slowest.
+
+        :param started: the time returned by :meth:`start`
+        :param string: the string that was looked up
+        :param method: (optional) the method it was looked up for
+        :param route: (optional) the route it matched
+
+        """
+        seconds = timer() - started
+        if self.profiler is not None:
+            self.profiler.disable()
+
+        self.sampled += 1
+        if seconds < self.threshold:
+            return
+        self.slow += 1
+
+        import heapq
+
+        self._order += 1
+        item = (seconds, self._order, SlowMatch(seconds, string, method, route))
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, item)
+        elif seconds > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def wrap(self, function, route=None):
+        """
+        Sample the calls of a matching function.
+
+        :param function: function called with the string to match
+        :param route: (optional) the route recorded for its slow calls
+        :return: A function calling *function*, sampling one call in every
+            ``every``
+
+        """
+        def sampled(string, *args, **kwargs):
+            if not self.due():
+                return function(string, *args, **kwargs)
+            started = self.start()
+            try:
+                return function(string, *args, **kwargs)
+            finally:
+                self.stop(started, string, None, route)
+        return sampled
+
+    def worst(self):
+        """
+        The slowest sampled lookups kept, slowest first.
+
+        :return: A list of :class:`SlowMatch` of ``(seconds, string, method,
+            route)``
+
+        """
+        return [item[2] for item in sorted(self._heap, reverse=True)]
+
+    def stats(self):
+        """
+        Profile of the sampled lookups.
+
+        :return: A :class:`pstats.Stats`
+        :raises ValueError: when the sampler was created without *profile*
+
+        """
+        if self.profiler is None:
+            raise ValueError('Expected a sampler created with profile=True')
+
+        import pstats
+        return pstats.Stats(self.profiler)
+
+    def reset(self):
+        """
+        Forget the lookups sampled so far.
+
+        """
+        self.sampled = 0
+        self.slow = 0
+        self._heap = []
+        if self.profiler is not None:
+            self.profiler = type(self.profiler)()
+
+    def __repr__(self):
+        return '<MatchSampler sampled=%d slow=%d every=%d>' % (
+            self.sampled, self.slow, self.every)
+
+
+class SharedMatchCache(object):
+    """
+    A fixed-size cache of the matches of a :class:`Router`, kept in shared
+    memory so that every worker process of a server reads and fills the
+    same cache.
+
+    Strings (and methods) are hashed with BLAKE2b into one of *slots*
+    slots, each holding the route matched, as its index in :attr:`routes`,
+    and the spans of the groups captured by its pattern. Slots are written
+    without locks: a writer makes the slot's sequence number odd while it
+    writes, and readers treat a slot whose sequence number is odd, changes
+    while it is read, or whose checksum does not match as a miss. Entries
+    are tagged with a generation, derived from the route table and
+    :meth:`invalidate`, so that processes with another table never use
+    them.
+
+    Create the cache once all routes are added, then attach to it from other
+    processes by *name*, with a router built the same way. Matches through
+    mounted routers and strings raising :class:`MethodNotAllowed` are not
+    cached. Requires Python 3.8+.
+
+    :param router: the :class:`Router` to cache the matches of
+    :param name: (optional) name of an existing cache to attach to
+    :param slots: (optional) number of entries of a new cache
+    :param generation: (optional) generation of the route table, by default
+        a hash of its parsed paths, converters, methods and options
+
+    """
+    # Group spans kept per entry; routes with more groups are not cached.
+    SPANS = 16
+    MAGIC = b'RPMC'
+
+    def __init__(self, router, name=None, slots=65536, generation=None):
+        import hashlib
+        import struct
+        import zlib
+        from multiprocessing import shared_memory
+
+        self.router = router
+        self.routes = []
+        for entry in router.entries:
+            if type(entry) is Route:
+                if entry.methods is None:
+                    self.routes.append(entry)
+                else:
+                    self.routes.extend(entry.methods.values())
+        self._ids = dict((route, index) for index, route in enumerate(self.routes))
+
+        if generation is None:
+            digest = hashlib.blake2b(
+                repr(self._table(router)).encode('utf-8', 'surrogatepass'),
+                digest_size=8).digest()
+            generation = int.from_bytes(digest, 'little')
+        self.generation = generation
+        self.hits = 0
+        self.misses = 0
+
+        self._blake2b = hashlib.blake2b
+        self._crc32 = zlib.crc32
+        self._header = struct.Struct('<4sIQ')
+        self._seq = struct.Struct('<I')
+        self._entry = struct.Struct('<Q16siH%di' % (2 * self.SPANS))
+        self._slot = self._seq.size + self._entry.size + self._seq.size
+
+        if name is None:
+            self.memory = shared_memory.SharedMemory(
+                create=True, size=self._header.size + slots * self._slot)
+            self._header.pack_into(self.memory.buf, 0, self.MAGIC, slots, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+            magic, slots, _ = self._header.unpack_from(self.memory.buf, 0)
+            if magic != self.MAGIC:
+                self.memory.close()
+                raise ValueError('Expected "{}" to be a match cache'.format(name))
+        self.name = self.memory.name
+        self.slots = slots
+
+    @classmethod
+    def _table(cls, router):
+        """
+        Everything about a router that decides what strings match.
+
+        """
+        table = [(router.end, router.strict, router.flags, router.decode,
+                  router.sensitive, router.normalize)]
+        for entry in router.entries:
+            tokens = cls._tokens(entry.tokens)
+            if type(entry) is Mount:
+                table.append((tokens, cls._table(entry.router)))
+            elif entry.methods is None:
+                table.append(tokens)
+            else:
+                table.append((tokens, tuple(entry.methods)))
+        return table
+
+    @staticmethod
+    def _tokens(tokens):
+        """
+        The parsed tokens of a path, with their converters given by pattern
+        and by the names of their functions, which unlike the functions
+        themselves are the same in every process.
+
+        """
+        def name(function):
+            return '{}.{}'.format(
+                getattr(function, '__module__', None),
+                getattr(function, '__qualname__', type(function).__name__))
+
+        described = []
+        for token in tokens:
+            if not isinstance(token, str):
+                converter = _get_converter(token)
+                if converter is not None:
+                    converter = (
+                        converter.pattern, name(converter.to_python),
+                        name(converter.to_url), tuple(map(name, converter.types)))
+                token = sorted(dict(token, converter=converter).items())
+            described.append(token)
+        return described
+
+    def _epoch(self):
+        return self._header.unpack_from(self.memory.buf, 0)[2]
+
+    def invalidate(self):
+        """
+        Stop using the entries added so far, in every process.
+
+        """
+        magic, slots, epoch = self._header.unpack_from(self.memory.buf, 0)
+        self._header.pack_into(self.memory.buf, 0, magic, slots, epoch + 1)
+
+    def match(self, string, method=None):
+        """
+        Find the first route matching a string, as :meth:`Router.match`
+        does, looking it up in the cache first.
+
+        """
+        key = self._blake2b(
+            ('%s %s' % ((method or '').upper(), string)).encode(
+                'utf-8', 'surrogatepass'),
+            digest_size=16).digest()
+        offset = (
+            self._header.size +
+            int.from_bytes(key[:8], 'little') % self.slots * self._slot
+        )
+        generation = (self.generation + self._epoch()) & 0xFFFFFFFFFFFFFFFF
+
+        found = self._read(offset, key, generation)
+        if found is not None:
+            self.hits += 1
+            index, spans = found
+            if index < 0:
+                return None
+            route = self.routes[index]
+            text = normalize(string) if self.router.normalize else string
+            values = tuple(
+                None if start < 0 else text[start:end]
+                for start, end in zip(spans[::2], spans[1::2])
+            )
+            return RouteMatch(route, values, route.extract.values)
+
+        self.misses += 1
+        result = self.router.match(string, method)
+        self._store(offset, key, generation, string, result)
+        return result
+
+    def _read(self, offset, key, generation):
+        buf = self.memory.buf
+        seq = self._seq.unpack_from(buf, offset)[0]
+        if seq & 1:
+            return None
+
+        start = offset + self._seq.size
+        entry = bytes(buf[start:start + self._entry.size])
+        crc = self._seq.unpack_from(buf, start + self._entry.size)[0]
+        if self._seq.unpack_from(buf, offset)[0] != seq or self._crc32(entry) != crc:
+            return None
+
+        fields = self._entry.unpack(entry)
+        if fields[0] != generation or fields[1] != key:
+            return None
+        return fields[2], fields[4:4 + 2 * fields[3]]
+
+    def _store(self, offset, key, generation, string, result):
+        if result is None:
+            index, spans = -1, ()
+        else:
+            index = self._ids.get(result.route)
+            if index is None:
+                return
+            text = normalize(string) if self.router.normalize else string
+            subject = text if self.router.sensitive else fold_case(text)
+            match = result.route.regex.match(subject)
+            if match is None or match.re.groups > self.SPANS:
+                return
+            spans = tuple(bound for span in match.regs[1:] for bound in span)
+
+        count = len(spans) // 2
+        entry = self._entry.pack(
+            generation, key, index, count,
+            *(spans + (0,) * (2 * self.SPANS - len(spans))))
+
+        buf = self.memory.buf
+        seq = self._seq.unpack_from(buf, offset)[0]
+        if seq & 1:
+            return  # another process is writing this slot
+        start = offset + self._seq.size
+        self._seq.pack_into(buf, offset, (seq + 1) & 0xFFFFFFFF)
+        buf[start:start + self._entry.size] = entry
+        self._seq.pack_into(buf, start + self._entry.size, self._crc32(entry))
+        self._seq.pack_into(buf, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def close(self):
+        """
+        Detach this process from the cache.
+
+        """
+        self.memory.close()
+
+    def unlink(self):
+        """
+        Remove the cache, once every process has closed it.
+
+        """
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return '<SharedMatchCache %r slots=%d hits=%d misses=%d>' % (
+            self.name, self.slots, self.hits, self.misses)
+
+
+def _not_found_wsgi(environ, start_response):
+    start_response('404 Not Found', [('Content-Type', 'text/plain')])
+    return [b'Not Found']
+
+
+def _method_not_allowed_wsgi(environ, start_response):
+    start_response('405 Method Not Allowed', [
+        ('Content-Type', 'text/plain'),
+        ('Allow', ', '.join(sorted(environ['repath.allowed']))),
+    ])
+    return [b'Method Not Allowed']
+
+
+class WSGIDispatcher(object):
+    """
+    A WSGI application dispatching requests on ``PATH_INFO`` to the
+    applications that are the targets of a router's routes.
+
+    The matched route and its parameters are available to applications as
+    ``environ['repath.route']`` and ``environ['repath.params']``, and as
+    ``environ['wsgiorg.routing_args']``. Handling time is the time taken by the
+    application to return its response iterable, not to produce its body.
+
+    :param router: a :class:`Router`, usually frozen
+    :param not_found: (optional) the application called when no route
+        matches, which responds with "404 Not Found" by default
+    :param method_not_allowed: (optional) the application called when routes
+        match the path but not the method, with the allowed methods in
+        ``environ['repath.allowed']``; responds with "405 Method Not
+        Allowed" by default
+    :param metrics: (optional) an object recording the time of each request,
+        a new :class:`DispatchMetrics` by default
+
+    """
+    def __init__(self, router, not_found=None, metrics=None,
+                 method_not_allowed=None):
+        self.router = router
+        self.not_found = not_found or _not_found_wsgi
+        self.method_not_allowed = method_not_allowed or _method_not_allowed_wsgi
+        self.metrics = DispatchMetrics() if metrics is None else metrics
+
+    def __call__(self, environ, start_response):
+        started = timer()
+        try:
+            result = self.router.match(
+                environ.get('PATH_INFO') or '/', environ.get('REQUEST_METHOD')
+            )
+        except MethodNotAllowed as error:
+            result = None
+            environ['repath.allowed'] = error.allowed
+        routed = timer()
+
+        if result is None:
+            route = None
+            application = (
+                self.method_not_allowed if 'repath.allowed' in environ
+                else self.not_found
+            )
+        else:
+            route = result.route
+            application = route.target
+            environ['repath.route'] = route
+            environ['repath.params'] = result.params
+            environ['wsgiorg.routing_args'] = ((), result.params)
+
+        try:
+            return application(environ, start_response)
+        finally:
+            self.metrics.record(route, routed - started, timer() - routed)
+
+
+async def _not_found_asgi(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await send({'type': 'websocket.close', 'code': 1000})
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 404,
+        'headers': [(b'content-type', b'text/plain')],
+    })
+    await send({'type': 'http.response.body', 'body': b'Not Found'})
+
+
+async def _method_not_allowed_asgi(scope, receive, send):
+    allow = ', '.join(sorted(scope['allowed'])).encode('latin-1')
+    await send({
+        'type': 'http.response.start',
+        'status': 405,
+        'headers': [(b'content-type', b'text/plain'), (b'allow', allow)],
+    })
+    await send({'type': 'http.response.body', 'body': b'Method Not Allowed'})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+class ASGIDispatcher(object):
+    """
+    An ASGI application dispatching HTTP and WebSocket connections on
+    ``scope['path']`` to the applications that are the targets of a router's
+    routes.
+
+    Applications receive a copy of the scope with the matched route's
+    parameters as ``scope['path_params']`` and the route as ``scope['route']``.
+    Lifespan events are acknowledged. Handling time is the time taken by the
+    application to complete, including sending its response.
+
+    :param router: a :class:`Router`, usually frozen
+    :param not_found: (optional) the application called when no route
+        matches, which responds with "404 Not Found" by default
+    :param method_not_allowed: (optional) the application called when routes
+        match the path but not the method of an HTTP request, with the allowed
+        methods in ``scope['allowed']``; responds with "405 Method Not
+        Allowed" by default
+    :param metrics: (optional) an object recording the time of each request,
+        a new :class:`DispatchMetrics` by default
+
+    """
+    def __init__(self, router, not_found=None, metrics=None,
+                 method_not_allowed=None):
+        self.router = router
+        self.not_found = not_found or _not_found_asgi
+        self.method_not_allowed = method_not_allowed or _method_not_allowed_asgi
+        self.metrics = DispatchMetrics() if metrics is None else metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await _lifespan(receive, send)
+            return
+
+        started = timer()
+        try:
+            result = self.router.match(scope['path'] or '/', scope.get('method'))
+        except MethodNotAllowed as error:
+            result = None
+            scope = dict(scope, allowed=error.allowed)
+        routed = timer()
+
+        if result is None:
+            route = None
+            application = (
+                self.method_not_allowed if 'allowed' in scope else self.not_found
+            )
+        else:
+            route = result.route
+            application = route.target
+            scope = dict(scope, path_params=result.params, route=route)
+
+        try:
+            await application(scope, receive, send)
+        finally:
+            self.metrics.record(route, routed - started, timer() - routed)
+
+
+class LazyParams(Mapping):
+    """
+    A read-only mapping of the named groups of a match, decoded on access.
+
+    Matching a bytes pattern against ``bytes``, ``bytearray``, ``mmap`` or
+    ``memoryview`` objects yields raw captures; this wrapper defers decoding
+    them to text until a value is actually requested, and then only decodes
+    that value once.
+
+    :param match: a match object from a bytes (or text) pattern
+    :param encoding: (optional) codec used to decode captured values
+    :param errors: (optional) error handler passed to the codec
+    :param groups: (optional) mapping of parameter names to group names in
+        the match, defaulting to every named group of its pattern
+
+    """
+    __slots__ = ('match', 'groups', 'encoding', 'errors', '_cache')
+
+    def __init__(self, match, encoding='utf-8', errors='strict', groups=None):
+        self.match = match
+        self.groups = match.re.groupindex if groups is None else groups
+        self.encoding = encoding
+        self.errors = errors
+        self._cache = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        value = self.match.group(self.groups[name])
+        if value is not None and not isinstance(value, str):
+            value = bytes(value).decode(self.encoding, self.errors)
+
+        self._cache[name] = value
+        return value
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def raw(self, name):
+        """
+        Return the undecoded capture for *name*.
+
+        """
+        return self.match.group(self.groups[name])
+
+
+# Locate the path of the request line in common and combined log formats, e.g.
+# `127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /users/1 HTTP/1.0" 200 2326`
+ACCESS_LOG_LOCATOR = b'"[A-Z]+ '
+
+# Characters that end a path embedded in a log line.
+SCAN_BOUNDARY = '[?#\\s"]|$'
+
+ScanReport = collections.namedtuple(
+    'ScanReport', ['counts', 'unmatched', 'bytes', 'seconds']
+)
+ScanReport.throughput = property(
+    lambda self: self.bytes / 1e6 / self.seconds if self.seconds else 0.0,
+    doc='Scanned megabytes per second.'
+)
+
+
+def scanner(paths, locator=ACCESS_LOG_LOCATOR, end=True, strict=False):
+    """
+    Compile a single bytes regex locating any of the given paths in text.
+
+    Each path is captured by a group named ``r<index>`` and its parameters by
+    groups named ``r<index>_<name>``. A trailing ``_unmatched`` group catches
+    located paths that matched no route.
+
+    :param paths: list of express-style path strings (text or bytes)
+    :param locator: bytes pattern preceding every path to be matched
+    :param end: Make paths match to the end of the located path
+    :param strict: Enforce trailing slash in matched paths
+    :return: A :mod:`re` compiled regular expression object.
+
+    """
+    branches = []
+
+    for index, path in enumerate(paths):
+        if _is_bytes(path):
+            path = bytes(path).decode('latin-1')
+
+        tokens = []
+        for token in parse(path):
+            if not isinstance(token, str):
+                token = dict(token, name='r%d_%s' % (index, token['name']))
+            tokens.append(token)
+
+        route = _tokens_to_route(tokens, end, strict, SCAN_BOUNDARY)
+        branches.append('(?P<r%d>%s)' % (index, route))
+
+    branches.append('(?P<_unmatched>)')
+    body = '(?:%s)' % '|'.join(branches)
+
+    return re.compile(locator + body.encode('latin-1'))
+
+
+def _scan_windows(source, chunk_size):
+    """
+    Map *source* into memory and yield it with newline-aligned windows.
+
+    Pages of each window are released once the caller has moved on, so the
+    resident size stays bounded by *chunk_size* rather than the file size.
+
+    """
+    import mmap
+
+    fp = open(source, 'rb') if isinstance(source, str) else source
+
+    try:
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files cannot be mapped
+            return
+
+        try:
+            size = len(mapped)
+            pos = 0
+
+            while pos < size:
+                end = mapped.find(b'\n', min(pos + chunk_size, size))
+                end = size if end == -1 else end + 1
+                yield mapped, pos, end
+
+                if hasattr(mapped, 'madvise'):
+                    start = pos - pos % mmap.PAGESIZE
+                    mapped.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+                pos = end
+        finally:
+            mapped.close()
+    finally:
+        if fp is not source:
+            fp.close()
+
+
+def _scan_routes(paths, locator, options):
+    """
+    Compile a scanner and map its route group indexes to route indexes.
+
+    """
+    regex = scanner(paths, locator, **options)
+    routes = dict(
+        (regex.groupindex['r%d' % index], index) for index in range(len(paths))
+    )
+    return regex, routes
+
+
+def iter_scan(source, paths, locator=ACCESS_LOG_LOCATOR, chunk_size=1 << 26,
+              encoding='utf-8', errors='strict', **options):
+    """
+    Scan a file for paths matching any of the given routes.
+
+    The file is memory mapped and searched in place, never split into lines.
+
+    :param source: file name or binary file object backed by a real file
+    :param paths: list of express-style path strings
+    :param locator: bytes pattern preceding every path to be matched
+    :param chunk_size: (optional) approximate number of bytes kept resident
+    :param encoding: (optional) codec used to decode parameter values
+    :param errors: (optional) error handler used to decode parameter values
+    :param options: (optional) dictionary of options accepted by :func:`pattern`
+    :return: generator of ``(path, params)`` pairs, where *path* is ``None``
+        for located paths matching no route and *params* is a
+        :class:`LazyParams`
+
+    """
+    regex, routes = _scan_routes(paths, locator, options)
+    names = [
+        dict(
+            (name[len('r%d_' % index):], name)
+            for name in regex.groupindex
+            if name.startswith('r%d_' % index)
+        )
+        for index in range(len(paths))
+    ]
+    empty = {}
+
+    for mapped, pos, end in _scan_windows(source, chunk_size):
+        for match in regex.finditer(mapped, pos, end):
+            index = routes.get(match.lastindex)
+            if index is None:
+                yield None, LazyParams(match, encoding, errors, empty)
+            else:
+                yield paths[index], LazyParams(
+                    match, encoding, errors, names[index])
+
+
+def scan(source, paths, locator=ACCESS_LOG_LOCATOR, chunk_size=1 << 26,
+         **options):
+    """
+    Count the paths in a file matching each of the given routes.
+
+    :param source: file name or binary file object backed by a real file
+    :param paths: list of express-style path strings
+    :param locator: bytes pattern preceding every path to be matched
+    :param chunk_size: (optional) approximate number of bytes kept resident
+    :param options: (optional) dictionary of options accepted by :func:`pattern`
+    :return: A :class:`ScanReport` of per-route counts and throughput
+
+    """
+    regex, routes = _scan_routes(paths, locator, options)
+    hits = collections.defaultdict(int)
+    size = 0
+    started = timer()
+
+    for mapped, pos, end in _scan_windows(source, chunk_size):
+        for match in regex.finditer(mapped, pos, end):
+            hits[match.lastindex] += 1
+        size += end - pos
+
+    seconds = timer() - started
+    counts = collections.OrderedDict(
+        (path, hits.get(regex.groupindex['r%d' % index], 0))
+        for index, path in enumerate(paths)
+    )
+    unmatched = hits.get(regex.groupindex['_unmatched'], 0)
+
+    return ScanReport(counts, unmatched, size, seconds)
+
+
+# Parts of a route measured by `memory_report`.
+MEMORY_COMPONENTS = ('tokens', 'pattern', 'regex', 'template')
+
+MemoryReport = collections.namedtuple(
+    'MemoryReport', ['routes', 'components', 'traced']
+)
+MemoryReport.total = property(
+    lambda self: sum(self.components.values()),
+    doc='Bytes attributed to all routes.'
+)
+
+
+def _memory_top(self, count=10):
+    """
+    The *count* routes using the most memory, as ``(path, bytes)`` pairs.
+
+    """
+    totals = [(path, sum(sizes.values())) for path, sizes in self.routes.items()]
+    return sorted(totals, key=lambda item: -item[1])[:count]
+
+
+def _memory_as_dict(self, top=10):
+    """
+    A dictionary of the report that can be written as JSON.
+
+    """
+    return collections.OrderedDict([
+        ('python', '%d.%d.%d' % sys.version_info[:3]),
+        ('count', len(self.routes)),
+        ('total', self.total),
+        ('traced', self.traced),
+        ('components', self.components),
+        ('top', [{'path': path, 'bytes': size} for path, size in self.top(top)]),
+        ('routes', [
+            dict(sizes, path=path) for path, sizes in self.routes.items()
+        ]),
+    ])
+
+
+MemoryReport.top = _memory_top
+MemoryReport.as_dict = _memory_as_dict
+
+
+def _sizeof(obj, seen):
+    """
+    Size in bytes of an object and everything it holds that is not in *seen*.
+
+    Functions are followed through their closures and attributes, not their
+    code or globals, which are shared by every function they create. Modules,
+    classes and built-in functions are not counted.
+
+    """
+    size = 0
+    stack = [obj]
+
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, _FUNCTION_TYPE):
+            stack.extend(cell.cell_contents for cell in obj.__closure__ or ())
+            stack.extend(obj.__defaults__ or ())
+            stack.append(obj.__dict__)
+        elif isinstance(obj, REGEXP_TYPE):
+            stack.append(obj.pattern)
+        elif hasattr(obj, '__slots__'):
+            stack.extend(
+                getattr(obj, name) for name in obj.__slots__
+                if hasattr(obj, name)
+            )
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+
+    return size
+
+
+_FUNCTION_TYPE = type(_sizeof)
+_SHARED_TYPES = (type(sys), type, type(len), type(_sizeof.__code__))
+
+
+def memory_report(paths, converters=None, end=True, strict=False, flags=0,
+                  optimize=False):
+    """
+    Measure the memory used by the compiled forms of a list of paths.
+
+    Every path is parsed to tokens, turned into a pattern string, compiled
+    to a regex and to a template function. The size of each of these
+    components is measured with :func:`sys.getsizeof`, following containers
+    and closures, and objects shared between routes (such as interned
+    strings, or regexes reused from the :mod:`re` cache) are only counted
+    for the first route using them. Building everything is also traced with
+    :mod:`tracemalloc`, which includes the overhead of the allocator and of
+    caches that belong to no route.
+
+    :param paths: list of express-style path strings
+    :param converters: (optional) dictionary of parameter names to converters
+    :param end: (optional) options of :func:`tokens_to_pattern`
+    :param strict: (optional) options of :func:`tokens_to_pattern`
+    :param flags: (optional) regex flags as defined in :mod:`re`
+    :param optimize: (optional) options of :func:`tokens_to_pattern`
+    :return: A :class:`MemoryReport` of the sizes of each component per
+        route, their totals and the traced total, in bytes
+
+    """
+    import tracemalloc
+
+    def build(path):
+        tokens = _parse(path, converters)
+        source = tokens_to_pattern(tokens, end, strict, optimize)
+        return tokens, source, re.compile(source, flags), tokens_to_template(tokens)
+
+    # Leave imports and compilations done on first use out of the trace
+    for path in paths[:1]:
+        build(path)
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        built = []
+        for path in paths:
+            built.append((path, build(path)))
+        traced = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    seen = set()
+    routes = collections.OrderedDict()
+    components = collections.OrderedDict((name, 0) for name in MEMORY_COMPONENTS)
+
+    for path, parts in built:
+        sizes = routes.setdefault(path, collections.OrderedDict(
+            (name, 0) for name in MEMORY_COMPONENTS))
+        for name, part in zip(MEMORY_COMPONENTS, parts):
+            size = _sizeof(part, seen)
+            sizes[name] += size
+            components[name] += size
+
+    return MemoryReport(routes, components, traced)
+
+
+def _classify_key(tokens, strict):
+    """
+    The literal first segment strings matching the tokens must have, or
+    ``None``, and their minimum length.
+
+    """
+    minimum = 0
+    for token in tokens:
+        if isinstance(token, str):
+            minimum += len(token)
+        elif not token['optional']:
+            minimum += len(token['prefix'])
+            minimum += re.match('(?:%s)$' % token['pattern'], '') is None
+    if not strict and isinstance(tokens[-1], str) and tokens[-1].endswith('/'):
+        minimum -= 1
+
+    first = tokens[0]
+    if not isinstance(first, str) or not first.startswith('/'):
+        return None, minimum
+
+    segment, slash, _ = first[1:].partition('/')
+    if not slash:
+        # The segment ends where the literal does only if a "/" or the end
+        # of the path follows it, whichever optional parameters are matched
+        for following in tokens[1:]:
+            if isinstance(following, str):
+                if following.startswith('/'):
+                    break
+                return None, minimum
+            if following['prefix'] != '/':
+                return None, minimum
+            if not following['optional']:
+                break
+    return segment or None, minimum
+
+
+def classify(strings, paths, converters=None, flags=0, end=True, strict=False):
+    """
+    Find the first of a list of paths matching each of many strings.
+
+    Strings are bucketed with NumPy by their first segment and length, and
+    each path is only tried against the strings of the buckets it could
+    match: those of the literal first segment of the path, if it has one,
+    and at least as long as the shortest string the path can match. The
+    results are the same as trying the compiled paths in turn on every
+    string. Requires NumPy.
+
+    :param strings: sequence or NumPy array of strings to classify
+    :param paths: list of express-style path strings
+    :param converters: (optional) dictionary of parameter names to converters
+    :param flags: (optional) regex flags as defined in :mod:`re`
+    :param end: (optional) as accepted by :func:`pattern`
+    :param strict: (optional) as accepted by :func:`pattern`
+    :return: A NumPy array of the index of the first path matching each
+        string, or ``-1``
+
+    """
+    import numpy
+
+    if isinstance(strings, numpy.ndarray):
+        texts = strings.tolist()
+    else:
+        texts = list(strings)
+    result = numpy.full(len(texts), -1, dtype=numpy.intp)
+    if not texts or not paths:
+        return result
+
+    keyed = {}
+    everywhere = []
+    routes = []
+    for index, path in enumerate(paths):
+        tokens = _parse(path, converters)
+        key, minimum = _classify_key(tokens, strict)
+        routes.append((
+            re.compile(tokens_to_pattern(tokens, end, strict), flags), minimum))
+        # NumPy drops trailing NULs from strings, and so from their segments
+        if key is None or flags & re.IGNORECASE or '\x00' in key:
+            everywhere.append(index)
+        else:
+            keyed.setdefault(key, []).append(index)
+
+    # Only the slash, the longest key and one more character are kept, so
+    # that a first segment longer than every key still equals none of them
+    longest = max(map(len, keyed), default=0)
+    array = numpy.asarray(texts, dtype='U%d' % (longest + 2))
+    # `$` also matches before a trailing newline
+    rest = numpy.char.partition(numpy.char.rstrip(array, '\n'), '/')
+    segments = numpy.char.partition(rest[:, 2], '/')[:, 0]
+    rooted = (rest[:, 0] == '') & (rest[:, 1] == '/')
+    lengths = numpy.fromiter(map(len, texts), dtype=numpy.intp, count=len(texts))
+
+    keys, inverse, counts = numpy.unique(
+        segments, return_inverse=True, return_counts=True)
+    order = numpy.argsort(inverse.ravel(), kind='stable')
+    bounds = numpy.concatenate(([0], numpy.cumsum(counts)))
+
+    for position, key in enumerate(keys.tolist()):
+        bucket = order[bounds[position]:bounds[position + 1]]
+        for members, candidates in (
+                (bucket[rooted[bucket]], sorted(keyed.get(key, []) + everywhere)),
+                (bucket[~rooted[bucket]], everywhere)):
+            for index in candidates:
+                if not len(members):
+                    break
+                regex, minimum = routes[index]
+                indexes = members.tolist()
+                matched = numpy.zeros(len(members), dtype=bool)
+                for offset in numpy.flatnonzero(lengths[members] >= minimum).tolist():
+                    if regex.match(texts[indexes[offset]]):
+                        matched[offset] = True
+                result[members[matched]] = index
+                members = members[~matched]
+
+    return result
+
+
+def main(argv=None):
+    """
+    Command line entry point, run with ``python -m repath``.
+
+    """
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(prog='python -m repath')
+    commands = parser.add_subparsers(dest='command')
+
+    scan_parser = commands.add_parser(
+        'scan', help='count requests per route in an access log')
+    scan_parser.add_argument('log', help='access log file')
+    scan_parser.add_argument('routes', nargs='+', help='express-style paths')
+    scan_parser.add_argument(
+        '--params', action='store_true',
+        help='print extracted parameters of every match as JSON lines')
+    scan_parser.add_argument(
+        '--locator', default=ACCESS_LOG_LOCATOR.decode('ascii'),
+        help='regex preceding each path (default: %(default)r)')
+    scan_parser.add_argument(
+        '--strict', action='store_true', help='enforce trailing slashes')
+
+    memory_parser = commands.add_parser(
+        'memory', help='report the memory used by compiled routes')
+    memory_parser.add_argument('routes', nargs='*', help='express-style paths')
+    memory_parser.add_argument(
+        '--file', help='file of paths, one per line, to add to the routes')
+    memory_parser.add_argument(
+        '--top', type=int, default=10,
+        help='number of largest routes to report (default: %(default)s)')
+    memory_parser.add_argument(
+        '--json', action='store_true', help='print the full report as JSON')
+    memory_parser.add_argument(
+        '--strict', action='store_true', help='enforce trailing slashes')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    if args.command == 'memory':
+        paths = list(args.routes)
+        if args.file:
+            with open(args.file) as fp:
+                paths.extend(line.strip() for line in fp if line.strip())
+        report = memory_report(paths, strict=args.strict)
+
+        if args.json:
+            print(json.dumps(report.as_dict(args.top), indent=2))
+            return 0
+
+        for name, size in report.components.items():
+            print('%d\t%s' % (size, name))
+        print('%d\ttotal (%d traced)' % (report.total, report.traced))
+        for path, size in report.top(args.top):
+            print('%d\t%s' % (size, path))
+        return 0
+
+    locator = args.locator.encode('latin-1')
+
+    if args.params:
+        for path, params in iter_scan(
+                args.log, args.routes, locator=locator, strict=args.strict,
+                errors='replace'):
+            if path is not None:
+                print(json.dumps({'route': path, 'params': dict(params)}))
+        return 0
+
+    report = scan(args.log, args.routes, locator=locator, strict=args.strict)
+    for path, count in report.counts.items():
+        print('%d\t%s' % (count, path))
+    print('%d\tunmatched' % report.unmatched)
+    sys.stderr.write('%.1f MB in %.3fs (%.1f MB/s)\n' % (
+        report.bytes / 1e6, report.seconds, report.throughput))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,11 +12,12 @@ setup(
         'Parses express-style paths to PCRE regular expression patterns, '
         'taking advantage of Python\'s named capture groups.'
     ),
-    install_requires=[
-        "six>=1.9.0",
-    ],
+    python_requires='>=3.7',
     packages=[],
     py_modules=['repath'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     keywords='url path pattern regex express route',
     license='MIT',
     classifiers=[
@@ -25,8 +26,8 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Internet',
         'Topic :: Internet :: WWW/HTTP',
     ],
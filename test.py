@@ -1,12 +1,27 @@
-from __future__ import unicode_literals
-
+import asyncio
+import gc
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import random
 import re
+import subprocess
+import sys
+import tempfile
+import tracemalloc
 import unittest
-
-import six
+import uuid
+from urllib import parse as urllib
 
 import repath
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEFAULT_TOKEN = {
     'prefix': '',
     'optional': False,
@@ -14,7 +29,7 @@ DEFAULT_TOKEN = {
 }
 
 def token(t=None, **kwargs):
-    if isinstance(t, six.string_types):
+    if isinstance(t, str):
         return t
     t = DEFAULT_TOKEN.copy()
     t.update(kwargs)
@@ -32,7 +47,7 @@ class RePathTestCase(unittest.TestCase):
         self.pattern = repath.pattern(path, **options)
         self.regex = re.compile(self.pattern, flags)
 
-        if isinstance(path, six.string_types):
+        if isinstance(path, str):
             self.template = repath.template(path)
             self.tokens = repath.parse(path)
 
@@ -949,3 +964,2148 @@ class CompileErrorTests(unittest.TestCase):
         self.check_to_path(
             '/:foo(\\d+)+', {'foo': [1, 2, 3, 'a']},
             ValueError, 'Expected all "foo" to match "\\d+"')
+
+
+class BytesPatternTests(unittest.TestCase):
+    def test_escape_functions_accept_bytes(self):
+        self.assertEqual(repath.escape_string(b'/a.b'), b'/a\\.b')
+        self.assertEqual(repath.escape_group(b'(x)'), b'\\(x\\)')
+
+    def test_bytes_path_produces_bytes_pattern(self):
+        pattern = repath.pattern(b'/user/:id(\\d+)')
+
+        self.assertIsInstance(pattern, bytes)
+        self.assertEqual(
+            pattern,
+            repath.pattern('/user/:id(\\d+)').encode('latin-1')
+        )
+
+    def test_list_of_bytes_paths_produces_bytes_pattern(self):
+        regex = repath.compile([b'/a', b'/b/:x'])
+
+        self.assertIsNotNone(regex.match(b'/a'))
+        self.assertEqual(regex.match(b'/b/c').group('x'), b'c')
+
+    def test_match_buffer_types(self):
+        regex = repath.compile(b'/user/:id')
+
+        for value in (b'/user/42', bytearray(b'/user/42'), memoryview(b'/user/42')):
+            match = regex.match(value)
+            self.assertIsNotNone(match)
+            self.assertEqual(bytes(match.group('id')), b'42')
+
+    def test_match_mmap_slice(self):
+        regex = repath.compile(b'/user/:id')
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b'GET /user/42\n')
+            fp.flush()
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                match = regex.match(mapped, 4, 12)
+                self.assertIsNone(match)  # "^" does not match at pos > 0
+
+                match = regex.match(mapped[4:12])
+                self.assertEqual(match.group('id'), b'42')
+            finally:
+                mapped.close()
+
+    def test_lazy_params_decode_on_access(self):
+        match = repath.compile(b'/:name/:opt?').match('/caf\xe9'.encode('utf8'))
+        params = repath.LazyParams(match)
+
+        self.assertEqual(params._cache, {})
+        self.assertEqual(params['name'], 'caf\xe9')
+        self.assertEqual(list(params._cache), ['name'])
+        self.assertEqual(params.raw('name'), 'caf\xe9'.encode('utf8'))
+        self.assertIsNone(params['opt'])
+        self.assertEqual(sorted(params), ['name', 'opt'])
+        self.assertRaises(KeyError, lambda: params['missing'])
+
+
+class ScanTests(unittest.TestCase):
+    LOG = (
+        b'127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /users/1 HTTP/1.0" 200 2326\n'
+        b'127.0.0.1 - - [10/Oct/2000:13:55:37 -0700] "GET /users/2/ HTTP/1.0" 200 12\n'
+        b'127.0.0.1 - - [10/Oct/2000:13:55:38 -0700] "POST /orders/9/items?x=1 HTTP/1.0" 201 0\n'
+        b'127.0.0.1 - - [10/Oct/2000:13:55:39 -0700] "GET /users/1/orders HTTP/1.0" 404 0\n'
+        b'127.0.0.1 - - [10/Oct/2000:13:55:40 -0700] "GET /caf%C3%A9/\xc3\xa9 HTTP/1.0" 404 0\n'
+    )
+    ROUTES = ['/users/:id', '/orders/:id/items', b'/caf%C3%A9/:name']
+
+    def setUp(self):
+        self.log = tempfile.NamedTemporaryFile(suffix='.log', delete=False)
+        self.log.write(self.LOG * 3)
+        self.log.close()
+
+    def tearDown(self):
+        os.unlink(self.log.name)
+
+    def test_scanner_finds_routes_within_text(self):
+        regex = repath.scanner(['/users/:id'])
+        match = regex.search(b'"GET /users/7?page=2 HTTP/1.1"')
+
+        self.assertEqual(match.group('r0_id'), b'7')
+
+    def test_scan_counts_routes(self):
+        report = repath.scan(self.log.name, self.ROUTES, chunk_size=100)
+
+        self.assertEqual(list(report.counts.values()), [6, 3, 3])
+        self.assertEqual(report.unmatched, 3)
+        self.assertEqual(report.bytes, len(self.LOG) * 3)
+        self.assertGreaterEqual(report.throughput, 0)
+
+    def test_scan_with_empty_file(self):
+        open(self.log.name, 'wb').close()
+
+        report = repath.scan(self.log.name, self.ROUTES)
+
+        self.assertEqual(list(report.counts.values()), [0, 0, 0])
+        self.assertEqual(report.bytes, 0)
+
+    def test_iter_scan_extracts_params(self):
+        results = [
+            (path, dict(params))
+            for path, params in repath.iter_scan(self.log.name, self.ROUTES)
+        ]
+
+        self.assertEqual(results[:5], [
+            ('/users/:id', {'id': '1'}),
+            ('/users/:id', {'id': '2'}),
+            ('/orders/:id/items', {'id': '9'}),
+            (None, {}),
+            (b'/caf%C3%A9/:name', {'name': '\xe9'}),
+        ])
+
+    def test_main_prints_counts(self):
+        output = io.StringIO()
+        stderr = io.StringIO()
+
+        with _redirect(output, stderr):
+            status = repath.main(['scan', self.log.name, '/users/:id'])
+
+        self.assertEqual(status, 0)
+        self.assertEqual(output.getvalue(), '6\t/users/:id\n9\tunmatched\n')
+        self.assertIn('MB/s', stderr.getvalue())
+
+    def test_main_prints_params(self):
+        output = io.StringIO()
+        with _redirect(output, io.StringIO()):
+            repath.main(['scan', self.log.name, '/orders/:id/items', '--params'])
+
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(lines, [
+            {'route': '/orders/:id/items', 'params': {'id': '9'}},
+        ] * 3)
+
+
+class MemoryReportTests(unittest.TestCase):
+    PATHS = ['/a', '/users/:id<int>', '/orgs/:org/repos/:repo/issues/:number(\\d+)']
+
+    def test_components(self):
+        report = repath.memory_report(self.PATHS)
+
+        self.assertEqual(list(report.routes), self.PATHS)
+        self.assertEqual(list(report.components), list(repath.MEMORY_COMPONENTS))
+        for sizes in report.routes.values():
+            self.assertTrue(all(size > 0 for size in sizes.values()))
+        self.assertEqual(report.total, sum(
+            sum(sizes.values()) for sizes in report.routes.values()))
+        self.assertGreater(report.traced, 0)
+
+    def test_top(self):
+        report = repath.memory_report(self.PATHS)
+        top = report.top(2)
+
+        self.assertEqual([path for path, _ in top], self.PATHS[:0:-1])
+        self.assertGreaterEqual(top[0][1], top[1][1])
+
+    def test_shared_objects_counted_once(self):
+        tokens = repath.parse('/users/:id')
+        seen = set()
+        first = repath._sizeof(tokens, seen)
+
+        self.assertGreater(first, sys.getsizeof(tokens))
+        self.assertEqual(repath._sizeof(tokens, seen), 0)
+
+    def test_main_prints_json(self):
+        output = io.StringIO()
+        with _redirect(output, io.StringIO()):
+            status = repath.main(['memory', '--json', '--top', '1'] + self.PATHS)
+
+        self.assertEqual(status, 0)
+        report = json.loads(output.getvalue())
+        self.assertEqual(report['count'], 3)
+        self.assertEqual([route['path'] for route in report['top']], [self.PATHS[2]])
+        self.assertEqual(sum(report['components'].values()), report['total'])
+
+    def test_main_reads_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as fp:
+            fp.write('\n'.join(self.PATHS) + '\n\n')
+        self.addCleanup(os.unlink, fp.name)
+
+        output = io.StringIO()
+        with _redirect(output, io.StringIO()):
+            repath.main(['memory', '--file', fp.name, '--top', '3'])
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0].split('\t')[1], 'tokens')
+        self.assertIn('traced', lines[4])
+        self.assertEqual(lines[5].split('\t')[1], self.PATHS[2])
+
+
+class _redirect(object):
+    def __init__(self, stdout, stderr):
+        self.streams = stdout, stderr
+
+    def __enter__(self):
+        self.saved = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = self.streams
+
+    def __exit__(self, *exc_info):
+        sys.stdout, sys.stderr = self.saved
+
+
+class ExtractorTests(unittest.TestCase):
+    def check_extract(self, path, string, expected, **options):
+        regex = repath.compile(path)
+        extract = repath.extractor(path, **options)
+
+        self.assertEqual(extract(regex.match(string)), expected)
+
+    def test_named_params(self):
+        self.check_extract('/:foo/:bar', '/a/b', {'foo': 'a', 'bar': 'b'})
+
+    def test_unnamed_params_are_keyed_by_index(self):
+        self.check_extract('/:foo/(\\d+)/(.*)', '/a/1/b/c', {'foo': 'a', '0': '1', '1': 'b/c'})
+
+    def test_repeated_params_are_split(self):
+        self.check_extract('/:path+/:id', '/a/b/c/1', {'path': ['a', 'b', 'c'], 'id': '1'})
+        self.check_extract('/:seg*', '/a/b', {'seg': ['a', 'b']})
+        self.check_extract('/:seg*', '/', {'seg': None})
+
+    def test_repeated_params_split_on_delimiter(self):
+        self.check_extract('/file.:ext+', '/file.tar.gz', {'ext': ['tar', 'gz']})
+
+    def test_optional_param_missing(self):
+        self.check_extract('/:foo/:bar?', '/a', {'foo': 'a', 'bar': None})
+
+    def test_decode(self):
+        self.check_extract('/:name', '/caf%C3%A9', {'name': 'caf%C3%A9'})
+        self.check_extract('/:name', '/caf%C3%A9', {'name': 'caf\xe9'}, decode=True)
+        self.check_extract('/:path+', '/a%2Fb/c%20d', {'path': ['a/b', 'c d']}, decode=True)
+
+    def test_round_trips_with_template(self):
+        path = '/:foo/(\\d+)/:rest*'
+        values = {'foo': 'a b', '0': '12', 'rest': ['x', 'y']}
+        string = repath.template(path)(values)
+
+        self.check_extract(path, string, values, decode=True)
+
+    def test_tokens_to_extractor(self):
+        tokens = repath.parse('/user/:id')
+        regex = re.compile(repath.tokens_to_pattern(tokens))
+        extract = repath.tokens_to_extractor(tokens)
+
+        self.assertEqual(extract(regex.match('/user/1')), {'id': '1'})
+
+
+class ConverterTests(unittest.TestCase):
+    UUID = '9f3c1a4e-2b6d-4c8e-9a1f-0e5d7b3c2a10'
+
+    def tearDown(self):
+        repath.CONVERTERS.pop('hex', None)
+
+    def test_parse_converter(self):
+        self.assertEqual(repath.parse('/:id<int>'), [
+            token(name='id', prefix='/', delimiter='/', pattern='[0-9]+', converter='int'),
+        ])
+
+    def test_explicit_capture_overrides_converter_pattern(self):
+        tokens = repath.parse('/:year<int>(\\d{4})')
+
+        self.assertEqual(tokens[0]['pattern'], '\\d{4}')
+        self.assertEqual(tokens[0]['converter'], 'int')
+
+    def test_unknown_converter(self):
+        with self.assertRaises(ValueError):
+            repath.parse('/:id<nope>')
+
+    def test_builtin_patterns(self):
+        regex = repath.compile('/:id<int>/:key<uuid>')
+
+        self.assertIsNotNone(regex.match('/12/%s' % self.UUID))
+        self.assertIsNone(regex.match('/12/%s0' % self.UUID))
+        self.assertIsNone(regex.match('/1a/%s' % self.UUID))
+        self.assertIsNone(regex.match('/١/%s' % self.UUID))
+
+    def test_extractor_converts(self):
+        path = '/:id<int>/:key<uuid>/:pages<int>*'
+        params = repath.extractor(path)(repath.match(path, '/12/%s/1/2' % self.UUID))
+
+        self.assertEqual(params, {
+            'id': 12, 'key': uuid.UUID(self.UUID), 'pages': [1, 2]
+        })
+
+    def test_template_formats_converted_values(self):
+        to_path = repath.template('/:id<int>/:key<uuid>/:pages<int>*')
+
+        self.assertEqual(
+            to_path({'id': 12, 'key': uuid.UUID(self.UUID), 'pages': [1, 2]}),
+            '/12/%s/1/2' % self.UUID
+        )
+        self.assertEqual(
+            to_path({'id': '12', 'key': self.UUID}),
+            '/12/%s' % self.UUID
+        )
+        self.assertRaises(ValueError, to_path, {'id': -1, 'key': self.UUID})
+        self.assertRaises(ValueError, to_path, {'id': True, 'key': self.UUID})
+        self.assertRaises(ValueError, to_path, {'id': 'x', 'key': self.UUID})
+
+    def test_uuid_objects_are_not_validated(self):
+        to_path = repath.template('/:key<uuid>(unchecked)')
+
+        self.assertIn(uuid.UUID, repath.CONVERTERS['uuid'].types)
+        self.assertNotIn(str, repath.CONVERTERS['uuid'].types)
+        self.assertEqual(to_path({'key': uuid.UUID(self.UUID)}), '/%s' % self.UUID)
+        self.assertRaises(ValueError, to_path, {'key': self.UUID})
+
+    def test_converter_maps(self):
+        converters = {'id': 'int', 'name': repath.Converter('[a-z]+', str.upper, str.lower, (str,))}
+        path = '/:id/:name'
+        regex = repath.compile(path, converters=converters)
+        extract = repath.extractor(path, converters=converters)
+        to_path = repath.template(path, converters=converters)
+
+        self.assertIsNone(regex.match('/a/b'))
+        self.assertEqual(extract(regex.match('/1/b')), {'id': 1, 'name': 'B'})
+        self.assertEqual(to_path({'id': 1, 'name': 'B'}), '/1/b')
+
+    def test_converter_maps_keep_custom_patterns(self):
+        tokens = repath.apply_converters(repath.parse('/:id(\\d{2})'), {'id': 'int'})
+
+        self.assertEqual(tokens[0]['pattern'], '\\d{2}')
+        self.assertEqual(tokens[0]['converter'], 'int')
+
+    def test_register_converter(self):
+        repath.register_converter('hex', '[0-9a-f]+', lambda v: int(v, 16), '{:x}'.format, (int,))
+        path = '/:color<hex>'
+
+        self.assertEqual(repath.extractor(path)(repath.match(path, '/ff')), {'color': 255})
+        self.assertEqual(repath.template(path)({'color': 255}), '/ff')
+
+
+class SpecificityTests(unittest.TestCase):
+    def test_sort_paths_by_specificity(self):
+        paths = ['/files/*', '/users/:id?', '/users/:id', '/users/:id(\\d+)', '/users/me', '/users']
+
+        self.assertEqual(repath.sort_paths(paths), [
+            '/users/me', '/users/:id(\\d+)', '/users/:id', '/users/:id?', '/files/*', '/users'
+        ])
+
+    def test_sort_paths_is_stable(self):
+        paths = ['/b/:id', '/a/:id', '/:x/c']
+
+        self.assertEqual(repath.sort_paths(paths), ['/b/:id', '/a/:id', '/:x/c'])
+
+    def test_sort_paths_keeps_unanalysable_paths_in_place(self):
+        regex = re.compile('/.*')
+        paths = ['/:a', '/b', regex, '/:c.json', '/:d', '/e']
+
+        self.assertEqual(repath.sort_paths(paths), ['/b', '/:a', regex, '/:c.json', '/e', '/:d'])
+
+    def test_find_unreachable_paths(self):
+        paths = ['/users/:id', '/users/me', '/files/*', '/files/a/b', '/users/:id']
+
+        self.assertEqual(repath.find_conflicts(paths), [
+            repath.Conflict('unreachable', '/users/me', '/users/:id'),
+            repath.Conflict('unreachable', '/files/a/b', '/files/*'),
+            repath.Conflict('unreachable', '/users/:id', '/users/:id'),
+        ])
+
+    def test_find_overlapping_paths(self):
+        self.assertEqual(repath.find_conflicts(['/users/me', '/users/:id', '/:a/me']), [
+            repath.Conflict('overlap', '/users/:id', '/users/me'),
+            repath.Conflict('overlap', '/:a/me', '/users/me'),
+            repath.Conflict('overlap', '/:a/me', '/users/:id'),
+        ])
+        self.assertEqual(repath.find_conflicts(['/users/:id(\\d+)', '/users/me']), [])
+
+    def test_optional_segments(self):
+        self.assertEqual(repath.find_conflicts(['/users/:id?', '/users']), [
+            repath.Conflict('unreachable', '/users', '/users/:id?'),
+        ])
+        self.assertEqual(repath.find_conflicts(['/users/:id', '/users/:id?']), [
+            repath.Conflict('overlap', '/users/:id?', '/users/:id'),
+        ])
+
+    def test_segments_matching_empty_strings(self):
+        # `/a/*` and `/a` both match `/a/`, but only `/a` matches `/a`
+        for path in ('/a/*', '/a/:x(\\d*)', '/a/:x(.*)'):
+            self.assertEqual(repath.find_conflicts([path, '/a']), [
+                repath.Conflict('overlap', '/a', path),
+            ])
+            self.assertEqual(repath.find_conflicts(['/a', path]), [
+                repath.Conflict('overlap', path, '/a'),
+            ])
+        self.assertEqual(repath.find_conflicts(['/a/:x(\\d*)', '/b']), [])
+        self.assertEqual(repath.prune_paths(['/a/*', '/a']), ['/a/*', '/a'])
+
+    def test_segments_matching_slashes(self):
+        for path, other in (
+                ('/:p(.+)', '/a/b'),
+                ('/files/:p([^?]+)', '/files/a/b'),
+                ('/:p([a-z/]+)', '/x/:id')):
+            self.assertEqual(repath.find_conflicts([path, other]), [
+                repath.Conflict('overlap', other, path),
+            ])
+        self.assertEqual(repath.find_conflicts(['/:p([\\w.-]+)', '/a/b']), [])
+        self.assertEqual(repath.find_conflicts(['/:p([^/.]+)', '/a/b']), [])
+
+    def test_trailing_newlines(self):
+        # `$` also matches before a trailing newline, so both match `/x/\n`
+        self.assertEqual(repath.find_conflicts(['/:a/:b', '/:a']), [
+            repath.Conflict('overlap', '/:a', '/:a/:b'),
+        ])
+        self.assertEqual(repath.find_conflicts(['/:a', '/'], strict=True), [
+            repath.Conflict('overlap', '/', '/:a'),
+        ])
+        # Only `/files/:name` matches `/files/a\nb`, as `.*` stops at newlines
+        self.assertEqual(repath.find_conflicts(['/files/*', '/files/:name']), [
+            repath.Conflict('overlap', '/files/:name', '/files/*'),
+        ])
+
+    def test_trailing_slashes(self):
+        self.assertEqual(len(repath.find_conflicts(['/users', '/users/'])), 1)
+        self.assertEqual(repath.find_conflicts(['/users', '/users/'], strict=True), [])
+
+    def test_strict_trailing_slashes_without_end(self):
+        # `^/` and `^/a/` match whatever follows the slash
+        self.assertEqual(
+            repath.find_conflicts(['/', '/:id'], end=False, strict=True), [
+                repath.Conflict('unreachable', '/:id', '/'),
+            ])
+        self.assertEqual(
+            repath.find_conflicts(['/a/', '/a/b/c'], end=False, strict=True), [
+                repath.Conflict('unreachable', '/a/b/c', '/a/'),
+            ])
+        self.assertEqual(
+            repath.find_conflicts(['/a/', '/b/'], end=False, strict=True), [])
+
+    def test_prefix_matching(self):
+        self.assertEqual(repath.find_conflicts(['/a', '/a/b']), [])
+        self.assertEqual(repath.find_conflicts(['/a', '/a/b'], end=False), [
+            repath.Conflict('unreachable', '/a/b', '/a'),
+        ])
+
+    def test_prune_paths(self):
+        paths = ['/users/:id', '/users/me', '/users/:id', '/orders']
+
+        self.assertEqual(repath.prune_paths(paths), ['/users/:id', '/orders'])
+
+    def test_pattern_sort_and_prune(self):
+        paths = ['/users/:id', '/users/me', '/users/:id']
+
+        self.assertEqual(
+            repath.pattern(paths, prune=True),
+            repath.pattern(['/users/:id'])
+        )
+        self.assertEqual(
+            repath.pattern(paths, sort=True, prune=True),
+            repath.pattern(['/users/me', '/users/:id'])
+        )
+
+
+class RouterTests(unittest.TestCase):
+    def setUp(self):
+        self.users = repath.Router()
+        self.users.add('/', 'list')
+        self.users.add('/:id', 'detail')
+
+        self.tenant = repath.Router()
+        self.tenant.mount('/users', self.users)
+        self.tenant.add('/settings', 'settings')
+
+        self.router = repath.Router()
+        self.router.add('/health', 'health')
+        self.router.mount('/t/:tenant', self.tenant)
+        self.router.add('/:page', 'page')
+
+    def check_route(self, string, target, **params):
+        result = self.router.match(string)
+
+        if target is None:
+            self.assertIsNone(result)
+        else:
+            self.assertIsNotNone(result)
+            self.assertEqual(result.route.target, target)
+            self.assertEqual(result.params, params)
+
+    def test_routes(self):
+        self.check_route('/health', 'health')
+        self.check_route('/about', 'page', page='about')
+        self.check_route('/about/us', None)
+
+    def test_mounted_routes(self):
+        self.check_route('/t/acme/users/1', 'detail', tenant='acme', id='1')
+        self.check_route('/t/acme/settings', 'settings', tenant='acme')
+
+    def test_mounted_root_routes(self):
+        self.check_route('/t/acme/users', 'list', tenant='acme')
+        self.check_route('/t/acme/users/', 'list', tenant='acme')
+
+    def test_mount_falls_through_when_nothing_matches(self):
+        self.check_route('/t/acme/nothing', None)
+        self.check_route('/t', 'page', page='t')
+
+    def test_prefix_matches_whole_segments(self):
+        self.check_route('/t/acme/usersettings', None)
+
+    def test_router_options(self):
+        router = repath.Router(flags=re.I, decode=True, converters={'id': 'int'})
+        router.add('/Items/:id/:name')
+
+        self.assertEqual(router.match('/items/1/a%20b').params, {'id': 1, 'name': 'a b'})
+        self.assertIsNone(router.match('/items/x/y'))
+
+    def test_add_returns_route(self):
+        route = repath.Router().add('/a', 'target', 'name')
+
+        self.assertEqual((route.path, route.target, route.name), ('/a', 'target', 'name'))
+
+
+class TemplateRegistryTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = repath.TemplateRegistry()
+        self.registry.add('user', '/users/:id')
+        self.registry.add('users', '/users')
+
+    def test_url_for(self):
+        self.assertEqual(self.registry.url_for('user', {'id': 1}), '/users/1')
+        self.assertEqual(self.registry.url_for('users'), '/users')
+        self.assertRaises(KeyError, self.registry.url_for, 'missing')
+
+    def test_url_for_many(self):
+        self.assertEqual(
+            self.registry.url_for_many([('user', {'id': 1}), ('user', {'id': 2}), ('users', None)]),
+            ['/users/1', '/users/2', '/users']
+        )
+
+    def test_templates_are_compiled_lazily_once(self):
+        self.assertEqual(self.registry._templates, {})
+
+        function = self.registry.template('user')
+
+        self.assertIs(self.registry.template('user'), function)
+        self.assertEqual(list(self.registry._templates), ['user'])
+
+        self.registry.precompile()
+        self.assertEqual(sorted(self.registry._templates), ['user', 'users'])
+
+    def test_paths_are_parsed_when_added(self):
+        self.assertRaises(ValueError, self.registry.add, 'bad', '/:id<nope>')
+        self.assertNotIn('bad', self.registry)
+
+    def test_duplicate_names(self):
+        self.assertRaises(ValueError, self.registry.add, 'user', '/u/:id')
+
+    def test_usage(self):
+        self.registry.url_for('user', {'id': 1})
+        self.registry.url_for('user', {'id': 2})
+
+        self.assertEqual(self.registry.usage['user'], 2)
+        self.assertEqual(self.registry.unused(), ['users'])
+
+    def test_converters(self):
+        registry = repath.TemplateRegistry(converters={'id': 'int'})
+        registry.add('user', '/users/:id')
+
+        self.assertRaises(ValueError, registry.url_for, 'user', {'id': 'abc'})
+
+
+class RouterUrlForTests(unittest.TestCase):
+    def setUp(self):
+        users = repath.Router()
+        users.add('/', name='users')
+        users.add('/:id', name='user')
+
+        self.router = repath.Router()
+        self.router.add('/health', name='health')
+        self.router.mount('/orgs/:org/users', users)
+
+    def test_url_for(self):
+        self.assertEqual(self.router.url_for('health'), '/health')
+
+    def test_url_for_mounted_routes(self):
+        self.assertEqual(self.router.url_for('user', {'org': 'acme', 'id': 1}), '/orgs/acme/users/1')
+        self.assertEqual(self.router.url_for('users', {'org': 'acme'}), '/orgs/acme/users')
+
+    def test_url_for_many(self):
+        self.assertEqual(
+            self.router.url_for_many([('health', None), ('users', {'org': 'a'})]),
+            ['/health', '/orgs/a/users']
+        )
+
+    def test_url_for_missing_route(self):
+        self.assertRaises(KeyError, self.router.url_for, 'missing')
+        self.assertFalse(self.router.has_route('missing'))
+        self.assertTrue(self.router.has_route('user'))
+
+    def test_built_paths_match(self):
+        result = self.router.match(self.router.url_for('user', {'org': 'acme', 'id': 1}))
+
+        self.assertEqual(result.params, {'org': 'acme', 'id': '1'})
+        self.assertEqual(result.route.name, 'user')
+
+
+class TemplateOptionTests(unittest.TestCase):
+    VALUES = ['abc', 'a b', 'caf\xe9', "-_.!~*'()", '%', 'a/b', '', 'A-Z_09']
+
+    def test_quoting_matches_urllib(self):
+        to_path = repath.template('/:value(.*)/:values(.*)+')
+
+        for value in self.VALUES:
+            self.assertEqual(
+                to_path({'value': value, 'values': [value, value]}),
+                '/%s/%s/%s' % (
+                    urllib.quote(value.encode('utf8'), "-_.!~*'()"),
+                    urllib.quote(value.encode('utf8'), ''),
+                    urllib.quote(value.encode('utf8'), ''),
+                )
+            )
+
+    def test_trusted_skips_validation(self):
+        path = '/:id(\\d+)'
+
+        self.assertRaises(ValueError, repath.template(path), {'id': 'abc'})
+        self.assertEqual(repath.template(path, trusted=True)({'id': 'abc'}), '/abc')
+
+    def test_trusted_still_requires_values(self):
+        to_path = repath.template('/:id/:tags+', trusted=True)
+
+        self.assertRaises(KeyError, to_path, {'tags': ['a']})
+        self.assertRaises(ValueError, to_path, {'id': 1, 'tags': []})
+        self.assertRaises(TypeError, to_path, {'id': [1], 'tags': ['a']})
+
+    def test_memoized_quoting(self):
+        to_path = repath.template('/:locale/:slug', memo_size=2)
+
+        for _ in range(2):
+            for slug in ['caf\xe9', 'a b', 'c d', 'plain']:
+                self.assertEqual(
+                    to_path({'locale': 'fr', 'slug': slug}),
+                    '/fr/' + urllib.quote(slug.encode('utf8'), "-_.!~*'()")
+                )
+
+    def test_registry_options(self):
+        registry = repath.TemplateRegistry(trusted=True)
+        registry.add('user', '/users/:id(\\d+)')
+
+        self.assertEqual(registry.url_for('user', {'id': 'me'}), '/users/me')
+
+
+class TemplateStreamingTests(unittest.TestCase):
+    def setUp(self):
+        self.to_path = repath.template('/caf\xe9/:id/:tags*')
+
+    def test_render_into_text_buffer(self):
+        buf = io.StringIO()
+        self.to_path.render_into(buf, {'id': 1, 'tags': ['a', 'b']})
+        self.to_path.render_into(buf, {'id': 2})
+
+        self.assertEqual(buf.getvalue(), '/caf\xe9/1/a/b/caf\xe9/2')
+
+    def test_render_into_binary_buffer(self):
+        buf = io.BytesIO()
+        self.to_path.render_into(buf, {'id': 'a b'})
+
+        self.assertEqual(buf.getvalue(), '/caf\xe9/a%20b'.encode('utf8'))
+
+    def test_render_into_file(self):
+        with tempfile.TemporaryFile('w+b') as fp:
+            self.to_path.render_into(fp, {'id': 1})
+            fp.seek(0)
+
+            self.assertEqual(fp.read(), '/caf\xe9/1'.encode('utf8'))
+
+    def test_render_into_with_encoding(self):
+        chunks = []
+
+        class Sink(object):
+            write = chunks.append
+
+        self.to_path.render_into(Sink(), {'id': 1}, encoding='latin-1')
+
+        self.assertEqual(b''.join(chunks), '/caf\xe9/1'.encode('latin-1'))
+
+    def test_render_into_raises(self):
+        self.assertRaises(KeyError, self.to_path.render_into, io.StringIO(), {})
+
+    def test_render_iter(self):
+        objs = ({'id': i} for i in range(5))
+        chunks = list(self.to_path.render_iter(objs, batch_size=2))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(
+            b''.join(chunks).decode('utf8'),
+            ''.join('/caf\xe9/%d\n' % i for i in range(5))
+        )
+
+    def test_render_iter_separator(self):
+        chunks = self.to_path.render_iter([{'id': 1}, {'id': 2}], separator=' ')
+
+        self.assertEqual(list(chunks), ['/caf\xe9/1 /caf\xe9/2 '.encode('utf8')])
+
+
+class ValidatorTests(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(repath.validate('/:id(\\d+)/:tags*', {'id': 1}), [])
+        self.assertEqual(repath.validate('/:id(\\d+)/:tags*', {'id': '1', 'tags': ['a']}), [])
+        self.assertEqual(repath.validate('/static', None), [])
+
+    def test_errors_match_template_exceptions(self):
+        path = '/:a/:b(\\d+)/:c/:d(\\d+)+/:e+'
+        params = {'b': 'x', 'c': ['1'], 'd': [1, 'x'], 'e': []}
+
+        self.assertEqual(repath.validate(path, params), [
+            repath.ParamError('a', 'missing', 'Expected "a" to be defined'),
+            repath.ParamError('b', 'pattern', 'Expected "b" to match "\\d+"'),
+            repath.ParamError('c', 'repeat', 'Expected "c" to not repeat'),
+            repath.ParamError('d', 'repeat_pattern', 'Expected all "d" to match "\\d+"'),
+            repath.ParamError('e', 'empty', 'Expected "e" to not be empty'),
+        ])
+
+        with self.assertRaises(KeyError) as context:
+            repath.template(path)(params)
+        self.assertEqual(context.exception.args[0], 'Expected "a" to be defined')
+
+    def test_converters(self):
+        check = repath.validator('/:id<int>')
+
+        self.assertEqual(check({'id': 1}), [])
+        self.assertEqual([e.reason for e in check({'id': -1})], ['pattern'])
+        self.assertEqual([e.reason for e in check({'id': 'x'})], ['pattern'])
+
+    def test_validate_many(self):
+        results = repath.validate_many('/:id(\\d+)', [{'id': 1}, {'id': 'x'}, {}])
+
+        self.assertEqual([[e.reason for e in errors] for errors in results], [
+            [], ['pattern'], ['missing'],
+        ])
+
+    def test_tokens_to_validator(self):
+        check = repath.tokens_to_validator(repath.parse('/:id'))
+
+        self.assertEqual(check({'id': 'a'}), [])
+
+
+class RouterFreezeTests(unittest.TestCase):
+    def setUp(self):
+        self.child = repath.Router()
+        self.child.add('/:id', 'child', name='child')
+
+        self.router = repath.Router()
+        self.router.add('/a/:id', 'a', name='a')
+        self.router.add('/b/:id', 'b', name='b')
+        self.router.mount('/c/:org', self.child)
+        self.router.freeze(collect=False)
+
+    def test_matching_is_unchanged(self):
+        self.assertEqual(self.router.match('/a/1').params, {'id': '1'})
+        self.assertEqual(self.router.match('/c/x/2').params, {'org': 'x', 'id': '2'})
+        self.assertEqual(self.router.url_for('child', {'org': 'x', 'id': 2}), '/c/x/2')
+
+    def test_frozen_routers_are_read_only(self):
+        self.assertTrue(self.child.frozen)
+        self.assertRaises(RuntimeError, self.router.add, '/d')
+        self.assertRaises(RuntimeError, self.child.mount, '/e', repath.Router())
+
+    def test_identical_tokens_are_shared(self):
+        a, b = self.router.entries[:2]
+
+        self.assertIs(a.tokens[1], b.tokens[1])
+        self.assertIs(a.tokens[1], self.child.entries[0].tokens[0])
+
+    def test_templates_are_compiled(self):
+        self.assertEqual(sorted(self.router.templates._templates), ['a', 'b'])
+        self.assertEqual(list(self.child.templates._templates), ['child'])
+
+    def test_freeze_collects_garbage(self):
+        router = repath.Router()
+        router.add('/a')
+        router.freeze()
+
+        if hasattr(gc, 'unfreeze'):
+            self.assertGreater(gc.get_freeze_count(), 0)
+            gc.unfreeze()
+
+
+class AdaptiveRouterTests(unittest.TestCase):
+    PATHS = ['/a', '/b/:id', '/c/:x', '/users/me', '/users/:id', '/files/*']
+
+    def make_router(self, paths=None, **options):
+        router = repath.Router(**options)
+        for path in paths or self.PATHS:
+            router.add(path, path)
+        return router
+
+    def order(self, router):
+        return [entry.path for entry in router.entries]
+
+    def test_disabled_by_default(self):
+        router = self.make_router(interval=2)
+        for _ in range(10):
+            router.match('/users/1')
+
+        self.assertEqual(self.order(router), self.PATHS)
+        self.assertEqual(router.hits, {})
+
+    def test_hot_routes_move_ahead(self):
+        router = self.make_router(adaptive=True, interval=10)
+        for _ in range(10):
+            router.match('/c/1')
+
+        self.assertEqual(self.order(router)[0], '/c/:x')
+
+    def test_overlapping_routes_keep_their_order(self):
+        router = self.make_router(adaptive=True, interval=10)
+        for _ in range(10):
+            router.match('/users/1')
+
+        order = self.order(router)
+        self.assertEqual(order[:2], ['/users/me', '/users/:id'])
+        self.assertEqual(router.match('/users/me').route.path, '/users/me')
+
+    def test_hits_decay(self):
+        router = self.make_router(adaptive=True, interval=4)
+        for _ in range(4):
+            router.match('/a')
+
+        self.assertEqual(list(router.hits.values()), [2])
+
+    def test_results_are_unchanged(self):
+        cases = [
+            (self.PATHS, {}, [
+                '/a', '/b/1', '/c/1', '/users/me', '/users/1', '/files/x/y',
+                '/nope', '/users', '/files', '/A',
+            ]),
+            (['/:p([a-z/]+)', '/x/:id'], {}, ['/x/y', '/x/1', '/a/b']),
+            (['/:id', '/'], dict(strict=True, end=False), ['/xx', '/', '/xx/y']),
+            (['/:a/:b', '/:a'], {}, ['/x', '/x/\n', '/x/y']),
+        ]
+
+        for paths, options, strings in cases:
+            for interval in (1, 3):
+                static = self.make_router(paths, **options)
+                router = self.make_router(
+                    paths, adaptive=True, interval=interval, **options)
+
+                for string in strings * 5 + list(reversed(strings)) * 5:
+                    expected = static.match(string)
+                    result = router.match(string)
+                    if expected is None:
+                        self.assertIsNone(result)
+                    else:
+                        self.assertEqual(
+                            result.route.path, expected.route.path, string)
+                        self.assertEqual(result.params, expected.params)
+
+    def test_case_insensitive_routes_keep_their_order(self):
+        router = repath.Router(flags=re.I, adaptive=True, interval=5)
+        router.add('/users', 'lower')
+        router.add('/USERS', 'upper')
+        for _ in range(5):
+            router.match('/Users')
+
+        self.assertEqual([e.target for e in router.entries], ['lower', 'upper'])
+
+    def test_mounts_reorder(self):
+        child = repath.Router()
+        child.add('/:id')
+        router = repath.Router(adaptive=True, interval=5)
+        router.add('/a')
+        router.mount('/m', child)
+        router.add('/m/x')
+        for _ in range(5):
+            router.match('/m/1')
+
+        self.assertIs(router.entries[0].router, child)
+        self.assertEqual(router.match('/m/x').route.path, '/:id')
+        self.assertEqual([type(e) for e in router.entries[1:]], [repath.Route, repath.Route])
+
+
+class NormalizedRouterTests(unittest.TestCase):
+    PATHS = [
+        '/', '/About', '/users/Me', '/users/:id', '/Files/*', '/static/:name.css',
+        '/API/:version(v[0-9])/Items', '/blog/:year?/Posts', '/x/', '/users/ME/settings',
+    ]
+
+    STRINGS = [
+        '', '/', '//', '/about', '/ABOUT', '/About/', '/about//', '/users/me',
+        '/USERS/ME', '/users/Bob', '/users/bob/', '/files/A/b', '/FILES',
+        '/static/Main.CSS', '/api/v1/items', '/API/V1/ITEMS', '/blog/posts',
+        '/BLOG/2020/posts', '/X', '/x/', '/x//', '/users/me/SETTINGS',
+        '/about\n', '/users/me\n', '/nothing', '/userS/me/x',
+    ]
+
+    def make_router(self, **options):
+        router = repath.Router(**options)
+        for path in self.PATHS:
+            router.add(path, path)
+        return router
+
+    def result(self, router, string):
+        result = router.match(string)
+        return result and (result.route.path, result.params)
+
+    def test_same_matches_as_ignorecase(self):
+        for strict in (False, True):
+            reference = self.make_router(strict=strict, flags=re.I)
+            router = self.make_router(strict=strict, sensitive=False)
+            for string in self.STRINGS:
+                self.assertEqual(
+                    self.result(router, string),
+                    self.result(reference, string),
+                    (strict, string)
+                )
+
+    def test_same_matches_as_scanning(self):
+        for sensitive in (True, False):
+            router = self.make_router(sensitive=sensitive)
+            reference = self.make_router(sensitive=sensitive)
+            reference._index()
+            reference._static.clear()
+            reference._scan = reference._full
+            for string in self.STRINGS:
+                self.assertEqual(
+                    self.result(router, string),
+                    self.result(reference, string),
+                    string
+                )
+
+    def test_params_keep_case(self):
+        router = self.make_router(sensitive=False)
+        self.assertEqual(
+            router.match('/USERS/Bob').params, {'id': 'Bob'}
+        )
+        self.assertEqual(
+            router.match('/files/A/B').params, {'0': 'A/B'}
+        )
+
+    def test_earlier_routes_are_not_shadowed(self):
+        router = repath.Router()
+        router.add('/users/:id', 'param')
+        router.add('/users/me', 'static')
+        router.add('/about', 'about')
+
+        self.assertEqual(router.match('/users/me').route.target, 'param')
+        self.assertEqual(router.match('/about').route.target, 'about')
+
+        router.freeze(collect=False)
+        self.assertEqual(router.match('/users/me').route.target, 'param')
+
+    def test_index_follows_reorder(self):
+        router = repath.Router(adaptive=True, interval=5)
+        router.add('/a', 'a')
+        router.add('/:x', 'x')
+        for _ in range(10):
+            router.match('/b')
+
+        self.assertEqual(router.match('/a').route.target, 'a')
+
+    def test_mounts(self):
+        child = repath.Router(sensitive=False)
+        child.add('/Items/:id', 'item')
+        router = repath.Router(sensitive=False, normalize=True)
+        router.mount('/Shop', child)
+
+        result = router.match('//SHOP//items/Ab.')
+        self.assertEqual(result.route.target, 'item')
+        self.assertEqual(result.params, {'id': 'Ab'})
+
+    def test_normalize(self):
+        self.assertEqual(repath.normalize('//a///b//'), '/a/b/')
+        self.assertEqual(repath.normalize('/a./b../c.d.'), '/a/b/c.d')
+        self.assertEqual(repath.normalize('/./../...'), '/./../...')
+        self.assertEqual(
+            repath.normalize('//a./', merge_slashes=False), '//a/'
+        )
+        self.assertEqual(
+            repath.normalize('//a./', strip_dots=False), '/a./'
+        )
+
+    def test_normalize_router(self):
+        router = self.make_router(normalize=True)
+        self.assertEqual(self.result(router, '//About.'), ('/About', {}))
+        self.assertEqual(
+            self.result(router, '/users//bob./'), ('/users/:id', {'id': 'bob'})
+        )
+
+    def test_fold_case(self):
+        self.assertEqual(repath.fold_case('/AbC'), '/abc')
+        self.assertEqual(repath.fold_case(u'/İx'), u'/İx')
+        self.assertEqual(
+            repath.fold_tokens(repath.parse('/A/:B')),
+            ['/a', token(
+                name='B', prefix='/', delimiter='/', pattern='[^/]+?'
+            )]
+        )
+
+    def test_static_routes_shadowed_by_segments_matching_nothing(self):
+        for options in ({}, {'sensitive': False}, {'adaptive': True, 'interval': 1}):
+            router = repath.Router(**options)
+            router.add('/globex/*')
+            router.add('/globex')
+            for _ in range(3):
+                self.assertEqual(router.match('/globex/').route.path, '/globex/*')
+                self.assertEqual(router.match('/globex').route.path, '/globex')
+
+    def test_same_as_matching_in_order(self):
+        rand = random.Random(0)
+        pieces = [
+            '/a', '/b', '/globex', '/:p', '/:q?', '/*', '/:r(\\d*)', '/:s+', '/a/',
+            '/:c(.+)', '/:d([a-z/]+)', '/:f([^?]+)',
+        ]
+        characters = ['/', '/a', '/b', '/globex', '/1', '/A', '//', '\n']
+
+        for _ in range(300):
+            paths = [
+                ''.join(
+                    piece.replace(':', ':n%d' % index) if ':' in piece else piece
+                    for index, piece in enumerate(rand.sample(pieces, rand.randint(1, 3))))
+                for _ in range(rand.randint(1, 8))
+            ]
+            options = dict(
+                adaptive=rand.random() < 0.5, interval=rand.randint(1, 5),
+                sensitive=rand.random() < 0.7, strict=rand.random() < 0.3,
+                end=rand.random() < 0.8,
+            )
+            router = repath.Router(**options)
+            for path in paths:
+                router.add(path)
+            regexes = [
+                re.compile(
+                    repath.pattern(path, strict=options['strict'], end=options['end']),
+                    0 if options['sensitive'] else re.IGNORECASE)
+                for path in paths
+            ]
+
+            for _ in range(30):
+                string = ''.join(
+                    rand.choice(characters) for _ in range(rand.randint(0, 4)))
+                expected = next(
+                    (path for path, regex in zip(paths, regexes) if regex.match(string)),
+                    None)
+                result = router.match(string)
+                self.assertEqual(
+                    None if result is None else result.route.path, expected,
+                    (string, paths, options))
+
+    def test_static_routes_behind_patterns_matching_slashes(self):
+        for pattern, path in (('/:p(.+)', '/a/b'), ('/files/:p([^?]+)', '/files/a/b')):
+            router = repath.Router()
+            router.add(pattern)
+            router.add(path)
+
+            self.assertEqual(router.match(path).route.path, pattern)
+            self.assertEqual(router._static, {})
+
+    def test_constraints(self):
+        router = repath.Router()
+        for path in ('/a/*', '/a', '/b/:id', '/b/c', '/:any/c', '/a/b/c'):
+            router.add(path)
+
+        constraints = router._get_constraints()
+        self.assertEqual(
+            dict((entry.path, [other.path for other in before])
+                 for entry, before in constraints.items()),
+            {
+                '/a/*': [], '/a': ['/a/*'], '/b/:id': [], '/b/c': ['/b/:id'],
+                '/:any/c': ['/a/*', '/b/:id', '/b/c'], '/a/b/c': ['/a/*'],
+            })
+
+
+class HostRouterTests(unittest.TestCase):
+    HOSTS = [
+        ':tenant.example.com', 'www.example.com', 'api.:tenant.example.com',
+        '*.cdn.example.com', ':labels+.deep.com', 'x.:y?.opt.com',
+        'shop-:id(\\d+).shop.com', 'example.com',
+    ]
+
+    def make_router(self, **options):
+        router = repath.HostRouter(**options)
+        for host in self.HOSTS:
+            router.add(host, host)
+        return router
+
+    def result(self, router, host, path=None):
+        result = router.match(host, path)
+        return result and (result.host.target, result.params)
+
+    def test_literal_labels_win(self):
+        router = self.make_router()
+        self.assertEqual(self.result(router, 'www.example.com'),
+                         ('www.example.com', {}))
+        self.assertEqual(self.result(router, 'example.com'),
+                         ('example.com', {}))
+        self.assertEqual(self.result(router, 'acme.example.com'),
+                         (':tenant.example.com', {'tenant': 'acme'}))
+        self.assertEqual(self.result(router, 'api.acme.example.com'),
+                         ('api.:tenant.example.com', {'tenant': 'acme'}))
+
+    def test_parameters_match_one_label(self):
+        router = self.make_router()
+        self.assertIsNone(router.match('a.b.example.com'))
+        self.assertEqual(self.result(router, 'shop-12.shop.com'),
+                         ('shop-:id(\\d+).shop.com', {'id': '12'}))
+        self.assertIsNone(router.match('shop-ab.shop.com'))
+
+    def test_labels_spanning_parameters(self):
+        router = self.make_router()
+        self.assertEqual(self.result(router, 'a.b.cdn.example.com'),
+                         ('*.cdn.example.com', {'0': 'a.b'}))
+        self.assertEqual(self.result(router, 'cdn.example.com'),
+                         (':tenant.example.com', {'tenant': 'cdn'}))
+        self.assertEqual(self.result(router, 'a.b.deep.com'),
+                         (':labels+.deep.com', {'labels': ['a', 'b']}))
+        self.assertIsNone(router.match('deep.com'))
+        self.assertEqual(self.result(router, 'x.opt.com'),
+                         ('x.:y?.opt.com', {'y': None}))
+        self.assertEqual(self.result(router, 'x.z.opt.com'),
+                         ('x.:y?.opt.com', {'y': 'z'}))
+
+    def test_case_port_and_trailing_dot(self):
+        router = self.make_router()
+        self.assertEqual(self.result(router, 'API.Acme.Example.COM.:8080'),
+                         ('api.:tenant.example.com', {'tenant': 'Acme'}))
+
+        router = self.make_router(sensitive=True)
+        self.assertEqual(self.result(router, 'WWW.example.com'),
+                         (':tenant.example.com', {'tenant': 'WWW'}))
+
+    def test_no_match(self):
+        router = self.make_router()
+        self.assertIsNone(router.match('example.org'))
+        self.assertIsNone(router.match('com'))
+        self.assertIsNone(router.match(''))
+
+    def test_first_added_host_wins(self):
+        router = repath.HostRouter()
+        router.add(':a.example.com', 'first')
+        router.add(':b.example.com', 'second')
+        router.add('www.example.com', 'third')
+        router.add('www.example.com', 'fourth')
+
+        self.assertEqual(router.match('x.example.com').host.target, 'first')
+        self.assertEqual(router.match('www.example.com').host.target, 'third')
+        self.assertEqual(len(router), 4)
+
+    def test_host_and_path(self):
+        www = repath.Router()
+        www.add('/about', 'about')
+        tenants = repath.Router()
+        tenants.add('/users/:id', 'user')
+
+        router = repath.HostRouter()
+        router.add('www.example.com', 'www', router=www)
+        router.add(':tenant.example.com', 'tenant', router=tenants)
+        router.add('static.example.com', 'static')
+
+        result = router.match('www.example.com', '/about')
+        self.assertEqual((result.host.target, result.route.target),
+                         ('www', 'about'))
+
+        result = router.match('www.example.com', '/users/1')
+        self.assertEqual(result.host.target, 'tenant')
+        self.assertEqual(result.params, {'tenant': 'www', 'id': '1'})
+
+        result = router.match('static.example.com', '/users/1')
+        self.assertEqual(result.host.target, 'tenant')
+        self.assertEqual(router.match('static.example.com').host.target,
+                         'static')
+        self.assertIsNone(router.match('acme.example.com', '/about'))
+
+
+class ImportTests(unittest.TestCase):
+    def import_times(self):
+        """
+        Import repath in a new interpreter and read the modules it imported,
+        with their cumulative import times in microseconds.
+
+        The standard modules repath imports itself are imported first, so
+        that what they import in turn, which varies between Python versions,
+        is not read.
+
+        """
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import collections, collections.abc, gc, io, re, sys, time; '
+             'sys.stderr.write("--\\n"); import repath; '
+             'print("PATH_REGEXP" in vars(repath))'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=env, check=True, universal_newlines=True,
+        )
+        times = {}
+        for line in output.stderr.partition('--\n')[2].splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative)
+        return output.stdout.strip() == 'True', times
+
+    def test_import_is_light(self):
+        compiled, times = self.import_times()
+
+        self.assertIn('repath', times)
+        for module in ('six', 'uuid', 'urllib.parse', 'mmap', 'heapq'):
+            self.assertNotIn(module, times)
+        self.assertFalse(compiled)
+
+    def test_path_regexp_is_compiled_on_first_use(self):
+        self.assertIsInstance(repath.PATH_REGEXP, repath.REGEXP_TYPE)
+        self.assertIs(repath.PATH_REGEXP, repath._path_regexp())
+        self.assertRaises(AttributeError, getattr, repath, 'NOTHING')
+
+
+class RouterMethodTests(unittest.TestCase):
+    def make_router(self, **options):
+        router = repath.Router(**options)
+        router.add('/users', 'list', methods=['GET', 'HEAD'])
+        router.add('/users', 'create', methods=['post'])
+        router.add('/users/:id', 'show', methods=['GET'])
+        router.add('/users/:id', 'update', methods=['PUT'])
+        router.add('/users/:id', 'delete', methods=['DELETE'])
+        router.add('/health', 'health')
+        return router
+
+    def target(self, router, string, method):
+        return router.match(string, method).route.target
+
+    def test_routes_share_entries(self):
+        router = self.make_router()
+
+        self.assertEqual(len(router.entries), 3)
+        show, update, delete = router.entries[1].methods.values()
+        self.assertIs(show.regex, update.regex)
+        self.assertIs(show.extract, delete.extract)
+        self.assertIs(show.methods, delete.methods)
+
+    def test_match_method(self):
+        router = self.make_router()
+
+        self.assertEqual(self.target(router, '/users', 'GET'), 'list')
+        self.assertEqual(self.target(router, '/users', 'HEAD'), 'list')
+        self.assertEqual(self.target(router, '/users', 'POST'), 'create')
+        self.assertEqual(self.target(router, '/users/1', 'PUT'), 'update')
+        self.assertEqual(router.match('/users/1', 'DELETE').params, {'id': '1'})
+        self.assertEqual(self.target(router, '/health', 'POST'), 'health')
+        self.assertIsNone(router.match('/nothing', 'GET'))
+
+    def test_method_case(self):
+        router = self.make_router()
+
+        self.assertEqual(self.target(router, '/users', 'post'), 'create')
+        self.assertEqual(self.target(router, '/users/1', 'Put'), 'update')
+
+        with self.assertRaises(repath.MethodNotAllowed) as context:
+            router.match('/users/1', 'post')
+        self.assertEqual(context.exception.method, 'POST')
+
+    def test_methods_ignored_by_default(self):
+        router = self.make_router()
+
+        self.assertEqual(router.match('/users').route.target, 'list')
+        self.assertEqual(router.match('/users/1').route.target, 'show')
+
+    def test_method_not_allowed(self):
+        router = self.make_router()
+
+        with self.assertRaises(repath.MethodNotAllowed) as context:
+            router.match('/users/1', 'POST')
+        self.assertEqual(context.exception.allowed, {'GET', 'PUT', 'DELETE'})
+        self.assertIsInstance(context.exception, LookupError)
+
+        with self.assertRaises(repath.MethodNotAllowed) as context:
+            router.match('/users', 'DELETE')
+        self.assertEqual(context.exception.allowed, {'GET', 'HEAD', 'POST'})
+
+    def test_later_routes_match_other_methods(self):
+        router = repath.Router()
+        router.add('/users/:id', 'show', methods=['GET'])
+        router.add('/users/me', 'me', methods=['POST'])
+        router.add('/users/:id', 'update', methods=['PUT'])
+        router.add('/users/:id', 'create', methods=['POST'])
+
+        self.assertEqual(len(router.entries), 3)
+        self.assertEqual(self.target(router, '/users/me', 'POST'), 'me')
+        self.assertEqual(self.target(router, '/users/1', 'POST'), 'create')
+        self.assertEqual(self.target(router, '/users/me', 'PUT'), 'update')
+
+        with self.assertRaises(repath.MethodNotAllowed) as context:
+            router.match('/users/1', 'PATCH')
+        self.assertEqual(context.exception.allowed, {'GET', 'PUT', 'POST'})
+
+    def test_later_routes_stay_behind_patterns_matching_slashes(self):
+        router = repath.Router()
+        router.add('/a/b', 'get', methods=['GET'])
+        router.add('/:p(.+)', 'any')
+        router.add('/a/b', 'post', methods=['POST'])
+
+        self.assertEqual(len(router.entries), 3)
+        self.assertEqual(self.target(router, '/a/b', 'POST'), 'any')
+        self.assertEqual(self.target(router, '/a/b', 'GET'), 'get')
+
+    def test_first_route_wins(self):
+        router = repath.Router()
+        router.add('/users', 'first', methods=['GET'])
+        router.add('/users', 'second', methods=['GET', 'POST'])
+
+        self.assertEqual(self.target(router, '/users', 'GET'), 'first')
+        self.assertEqual(self.target(router, '/users', 'POST'), 'second')
+
+    def test_mounts(self):
+        users = self.make_router()
+        router = repath.Router()
+        router.mount('/orgs/:org', users)
+        router.add('/orgs/:org/users', 'fallback', methods=['PATCH'])
+
+        result = router.match('/orgs/acme/users/1', 'PUT')
+        self.assertEqual(result.params, {'org': 'acme', 'id': '1'})
+        self.assertEqual(self.target(router, '/orgs/acme/users', 'PATCH'),
+                         'fallback')
+
+        with self.assertRaises(repath.MethodNotAllowed) as context:
+            router.match('/orgs/acme/users', 'PUT')
+        self.assertEqual(context.exception.allowed,
+                         {'GET', 'HEAD', 'POST', 'PATCH'})
+
+    def test_frozen_and_case_insensitive(self):
+        router = self.make_router(sensitive=False)
+        router.freeze(collect=False)
+
+        self.assertEqual(self.target(router, '/USERS/1', 'PUT'), 'update')
+        self.assertEqual(router.match('/USERS/Ab', 'DELETE').params, {'id': 'Ab'})
+        self.assertRaises(repath.MethodNotAllowed, router.match, '/Users', 'PUT')
+
+
+class SharedRouteTests(unittest.TestCase):
+    TENANTS = ['acme', 'globex', 'Initech']
+
+    def make_router(self, **options):
+        router = repath.Router(**options)
+        for tenant in self.TENANTS:
+            router.add('/t/%s/items/:id' % tenant, ('items', tenant))
+            router.add('/t/%s/orders/:id<int>' % tenant, ('orders', tenant))
+        return router
+
+    def patterns(self, router):
+        router._index()
+        return [regex.pattern for regex, _ in router._full]
+
+    def test_one_pattern_per_shape(self):
+        router = self.make_router()
+
+        self.assertEqual(len(self.patterns(router)), 2)
+        self.assertEqual(
+            router.match('/t/globex/orders/7'),
+            (router.entries[3], {'id': 7})
+        )
+        self.assertEqual(
+            router.match('/t/Initech/items/a').route.target, ('items', 'Initech')
+        )
+        self.assertIsNone(router.match('/t/other/items/a'))
+
+    def test_routes_share_their_shape(self):
+        router = self.make_router()
+        router._index()
+        first, second = router.entries[0], router.entries[2]
+
+        self.assertIs(router._shapes[first][0], router._shapes[second][0])
+        self.assertEqual(router._shapes[second][1], ('t', 'globex', 'items'))
+
+    def test_routes_compile_their_own_pattern_on_demand(self):
+        router = self.make_router()
+        router.freeze(collect=False)
+        route = router.match('/t/acme/items/1').route
+
+        self.assertEqual(type(route._regex), tuple)
+        self.assertEqual(route.regex.match('/t/acme/items/1').group('id'), '1')
+        self.assertIs(route.regex, route.regex)
+
+    def test_earlier_routes_win(self):
+        router = repath.Router()
+        router.add('/t/acme/items/:id', 'acme')
+        router.add('/t/:tenant/items/special', 'special')
+        router.add('/t/globex/items/:id', 'globex')
+        router.add('/t/initech/items/:id', 'initech')
+
+        self.assertEqual(len(self.patterns(router)), 3)
+        self.assertEqual(router.match('/t/globex/items/special').route.target,
+                         'special')
+        self.assertEqual(router.match('/t/acme/items/special').route.target,
+                         'acme')
+        self.assertEqual(router.match('/t/initech/items/1').route.target,
+                         'initech')
+
+    def test_case_insensitive_and_methods(self):
+        router = repath.Router(sensitive=False)
+        for tenant in self.TENANTS:
+            router.add('/t/%s/items/:id' % tenant, tenant, methods=['GET'])
+            router.add('/t/%s/items/:id' % tenant, tenant + '!', methods=['PUT'])
+
+        self.assertEqual(len(self.patterns(router)), 1)
+        result = router.match('/T/INITECH/items/Ab', 'PUT')
+        self.assertEqual((result.route.target, result.params),
+                         ('Initech!', {'id': 'Ab'}))
+        self.assertRaises(repath.MethodNotAllowed,
+                          router.match, '/t/acme/items/1', 'POST')
+
+    def test_same_matches_as_separate_patterns(self):
+        rand = random.Random(0)
+        segments = ['acme', 'globex', 'Initech', 'items', 'x']
+
+        def make_path():
+            path = ''
+            for index in range(rand.randint(1, 4)):
+                path += rand.choice(
+                    ['/' + rand.choice(segments)] * 6 +
+                    ['/:p%d' % index] * 2 + ['/:p%d<int>' % index, '/:p%d?' % index]
+                )
+            return path
+
+        def make_string():
+            return ''.join(
+                '/' + rand.choice(segments + ['1', 'ACME'])
+                for _ in range(rand.randint(1, 4))
+            ) + rand.choice(['', '/', '\n'])
+
+        for _ in range(100):
+            paths = [make_path() for _ in range(rand.randint(2, 25))]
+            for sensitive, flags in ((True, 0), (False, 0), (True, re.I)):
+                router = repath.Router(sensitive=sensitive, flags=flags)
+                for index, path in enumerate(paths):
+                    router.add(path, index)
+                separate = [
+                    (index, repath.compile(path, (0 if sensitive else re.I) | flags),
+                     repath.extractor(path))
+                    for index, path in enumerate(paths)
+                ]
+
+                for _ in range(20):
+                    string = make_string()
+                    expected = next((
+                        (index, extract(match))
+                        for index, regex, extract in separate
+                        for match in [regex.match(string)] if match
+                    ), None)
+                    result = router.match(string)
+                    self.assertEqual(
+                        result and (result.route.target, result.params),
+                        expected, (paths, sensitive, flags, string)
+                    )
+
+    def test_routes_with_the_same_segments(self):
+        router = repath.Router()
+        router.add('/t/acme/items', 'acme', methods=['GET'])
+        router.add('/t/globex/items', 'globex')
+        router.add('/t/acme/items', 'any')
+
+        for string in ('/t/acme/items', '/t/acme/items\n'):
+            self.assertEqual(router.match(string, 'POST').route.target, 'any')
+            self.assertEqual(router.match(string, 'GET').route.target, 'acme')
+
+
+class RouteMatchTests(unittest.TestCase):
+    def setUp(self):
+        self.router = repath.Router()
+        self.router.add('/users/:id<int>', name='user')
+        self.router.add('/static')
+        for tenant in ('acme', 'globex'):
+            self.router.add('/t/%s/items/:item' % tenant)
+
+    def test_lazy_params(self):
+        result = self.router.match('/users/42')
+
+        self.assertEqual(result.values, ('42',))
+        self.assertIsNone(result._params)
+        self.assertEqual(result.params, {'id': 42})
+        self.assertIs(result.params, result.params)
+
+    def test_tuple_compatibility(self):
+        route, params = self.router.match('/users/42')
+
+        self.assertEqual(route.name, 'user')
+        self.assertEqual(params, {'id': 42})
+        self.assertEqual(self.router.match('/users/42'), (route, {'id': 42}))
+        self.assertEqual(self.router.match('/users/42')[1], {'id': 42})
+        self.assertNotEqual(self.router.match('/users/42'), (route, {'id': 1}))
+        self.assertEqual(self.router.match('/static'), (self.router.entries[1], {}))
+        self.assertIn("params={'id': 42}", repr(self.router.match('/users/42')))
+
+    def test_shared_and_mounted(self):
+        result = self.router.match('/t/globex/items/x')
+        self.assertEqual(result.route.path, '/t/globex/items/:item')
+        self.assertEqual(result.values, ('x',))
+        self.assertEqual(result.params, {'item': 'x'})
+        self.assertEqual(
+            result.values,
+            result.route.regex.match('/t/globex/items/x').groups())
+
+        parent = repath.Router()
+        parent.mount('/orgs/:org', self.router)
+        result = parent.match('/orgs/acme/t/acme/items/7')
+        self.assertEqual(result.values, ('acme', '7'))
+        self.assertEqual(result.params, {'org': 'acme', 'item': '7'})
+
+        result = parent.match('/orgs/acme/users/7')
+        self.assertEqual(result.values, ('acme', '7'))
+        self.assertEqual(result.params, {'org': 'acme', 'id': 7})
+
+    def test_insensitive_values(self):
+        router = repath.Router(sensitive=False)
+        router.add('/users/:name')
+        self.assertEqual(router.match('/USERS/Bob').values, ('Bob',))
+
+    def test_allocations(self):
+        strings = ['/users/%d' % index for index in range(1000)]
+        self.router.match(strings[0])
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            results = [self.router.match(string) for string in strings]
+            lazy = tracemalloc.get_traced_memory()[0] - before
+            for result in results:
+                result.params
+            eager = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+        # without params, a match keeps little more than its captured text
+        self.assertLess(lazy / len(strings), 3 * sys.getsizeof(('42',)) + 100)
+        self.assertGreater(eager - lazy, len(strings) * sys.getsizeof({}))
+
+
+class MatchSamplerTests(unittest.TestCase):
+    def setUp(self):
+        self.sampler = repath.MatchSampler(every=3, size=2)
+        self.router = repath.Router(sampler=self.sampler)
+        self.router.add('/users/:id')
+        self.router.add('/orders/:id', methods=['GET'])
+
+    def test_samples_every_nth_lookup(self):
+        for index in range(10):
+            self.router.match('/users/%d' % index)
+
+        self.assertEqual(self.sampler.sampled, 3)
+        self.assertEqual(self.sampler.slow, 3)
+        worst = self.sampler.worst()
+        self.assertEqual(len(worst), 2)
+        self.assertLessEqual(
+            {slow.string for slow in worst}, {'/users/2', '/users/5', '/users/8'})
+        self.assertGreaterEqual(worst[0].seconds, worst[1].seconds)
+        self.assertEqual(worst[0].route, self.router.entries[0])
+        self.assertIn('sampled=3', repr(self.sampler))
+
+    def test_threshold(self):
+        self.sampler.threshold = 60
+        for index in range(9):
+            self.router.match('/users/%d' % index)
+
+        self.assertEqual((self.sampler.sampled, self.sampler.slow), (3, 0))
+        self.assertEqual(self.sampler.worst(), [])
+
+    def test_unmatched_and_not_allowed(self):
+        self.sampler.every = self.sampler._countdown = 1
+
+        self.assertIsNone(self.router.match('/nothing'))
+        with self.assertRaises(repath.MethodNotAllowed):
+            self.router.match('/orders/1', 'POST')
+
+        self.assertEqual(
+            sorted((slow.string, slow.method, slow.route) for slow in self.sampler.worst()),
+            [('/nothing', None, None), ('/orders/1', 'POST', None)],
+        )
+
+    def test_keeps_slowest(self):
+        sampler = repath.MatchSampler(every=1, size=2)
+        for seconds in (0.3, 0.1, 0.5, 0.2):
+            sampler.stop(repath.timer() - seconds, '/%s' % seconds)
+
+        self.assertEqual([slow.string for slow in sampler.worst()], ['/0.5', '/0.3'])
+
+        sampler.reset()
+        self.assertEqual((sampler.sampled, sampler.worst()), (0, []))
+
+    def test_wrap(self):
+        sampler = repath.MatchSampler(every=2)
+        match = sampler.wrap(repath.compile('/users/:id').match, '/users/:id')
+
+        self.assertEqual(match('/users/1').group(1), '1')
+        self.assertIsNone(match('/orders/1'))
+
+        self.assertEqual(sampler.worst(), [
+            repath.SlowMatch(sampler.worst()[0].seconds, '/orders/1', None, '/users/:id'),
+        ])
+
+    def test_profile(self):
+        with self.assertRaises(ValueError):
+            self.sampler.stats()
+
+        sampler = repath.MatchSampler(every=1, profile=True)
+        router = repath.Router(sampler=sampler)
+        router.add('/users/:id')
+        router.match('/users/1')
+
+        output = io.StringIO()
+        stats = sampler.stats()
+        stats.stream = output
+        stats.print_stats('_match')
+        self.assertIn('_match', output.getvalue())
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class ClassifyTests(unittest.TestCase):
+    PATHS = ['/users/:id', '/users', '/:any/x', '/orders/:id(\\d+)/', '/(.*)']
+
+    def first(self, strings, paths, flags=0, **options):
+        regexes = [re.compile(repath.pattern(path, **options), flags) for path in paths]
+        return [
+            next((index for index, regex in enumerate(regexes) if regex.match(string)), -1)
+            for string in strings
+        ]
+
+    def test_classify(self):
+        strings = [
+            '/users/1', '/users', '/users/\n', '/foo/x', '/orders/12', '/orders/x/',
+            'a/b', '', '/USERS/1',
+        ]
+        result = repath.classify(strings, self.PATHS)
+
+        self.assertEqual(result.tolist(), [0, 1, 0, 2, 3, 2, -1, -1, 4])
+        self.assertEqual(result.tolist(), self.first(strings, self.PATHS))
+        self.assertEqual(
+            repath.classify(numpy.array(strings), self.PATHS).tolist(), result.tolist())
+
+    def test_trailing_nuls(self):
+        paths = ['/a.b/\x00', '/a\x00/:id', '/:any/\x00\x00']
+        strings = ['/a.b/\x00', '/a\x00/1', '/x/\x00\x00', '/x/\x00', '/a/1']
+        result = repath.classify(strings, paths)
+
+        self.assertEqual(result.tolist(), [0, 1, 2, -1, -1])
+        self.assertEqual(result.tolist(), self.first(strings, paths))
+
+    def test_long_strings(self):
+        paths = ['/users', '/users/:id', '/:any/x', '/users:rest']
+        strings = [
+            '/users/' + 'x' * 10000, '/' + 'y' * 10000 + '/x', '/users' + 'z' * 10000,
+            '/usersx', '/users/1\n', '/users\n\nx', '/users',
+        ]
+        result = repath.classify(strings, paths)
+
+        self.assertEqual(result.tolist(), [1, 2, 3, 3, 1, 3, 0])
+        self.assertEqual(result.tolist(), self.first(strings, paths))
+
+    def test_empty(self):
+        self.assertEqual(repath.classify([], self.PATHS).tolist(), [])
+        self.assertEqual(repath.classify(['/users'], []).tolist(), [-1])
+
+    def test_segment_keys(self):
+        self.assertEqual(repath._classify_key(repath.parse('/users/:id'), False), ('users', 8))
+        self.assertEqual(repath._classify_key(repath.parse('/users/'), False), ('users', 6))
+        self.assertEqual(repath._classify_key(repath.parse('/users/'), True), ('users', 7))
+        self.assertEqual(repath._classify_key(repath.parse('/users:id'), False), (None, 7))
+        self.assertEqual(repath._classify_key(repath.parse('/users/:id?'), False), ('users', 6))
+        self.assertEqual(repath._classify_key(repath.parse('/users/:id?.:ext'), False), (None, 8))
+        self.assertEqual(repath._classify_key(repath.parse('/:id(\\d*)'), False), (None, 1))
+
+    def test_same_as_matching(self):
+        rand = random.Random(0)
+        pieces = ['/a', '/ab', '/users', '/:p', '/:q?', '/:r+', '/:s(\\d*)', '.:t', ':u', '/a/']
+        characters = ['/', '/a', '/ab', '/users', '1', '.y', 'x', '/A', '\n', '//']
+
+        for _ in range(100):
+            paths = [
+                ''.join(piece.replace(':', ':n%d' % index + '_') if ':' in piece else piece
+                        for index, piece in enumerate(rand.sample(pieces, rand.randint(1, 3))))
+                for _ in range(rand.randint(1, 6))
+            ]
+            strings = [
+                ''.join(rand.choice(characters) for _ in range(rand.randint(0, 5)))
+                for _ in range(50)
+            ]
+            options = dict(end=rand.random() < 0.7, strict=rand.random() < 0.3)
+            flags = re.IGNORECASE if rand.random() < 0.2 else 0
+
+            self.assertEqual(
+                repath.classify(strings, paths, flags=flags, **options).tolist(),
+                self.first(strings, paths, flags, **options),
+                (paths, options, flags),
+            )
+
+
+def _cache_router(extra=False):
+    router = repath.Router(sensitive=False, normalize=True)
+    router.add('/users/:id<int>')
+    router.add('/files/:path+', methods=['GET'])
+    if extra:
+        router.add('/extra')
+    return router
+
+
+def _cache_worker(name, strings, extra, results):
+    with repath.SharedMatchCache(_cache_router(extra), name=name) as cache:
+        matches = [cache.match(string) for string in strings]
+        results.put((
+            cache.hits,
+            [None if match is None else (match.route.path, match.params)
+             for match in matches],
+        ))
+
+
+@unittest.skipIf(sys.version_info < (3, 8), 'requires multiprocessing.shared_memory')
+class SharedMatchCacheTests(unittest.TestCase):
+    STRINGS = ['/users/1', '/USERS//2', '/files/a/b', '/nothing', '/users/x']
+
+    def setUp(self):
+        self.router = _cache_router()
+        self.cache = repath.SharedMatchCache(self.router, slots=256)
+        self.addCleanup(self.cache.unlink)
+        self.addCleanup(self.cache.close)
+
+    def expected(self, router=None):
+        router = router or self.router
+        return [
+            None if match is None else (match.route.path, match.params)
+            for match in map(router.match, self.STRINGS)
+        ]
+
+    def spawn(self, extra=False):
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        process = context.Process(
+            target=_cache_worker,
+            args=(self.cache.name, self.STRINGS, extra, results))
+        process.start()
+        result = results.get(timeout=60)
+        process.join(60)
+        self.assertEqual(process.exitcode, 0)
+        return result
+
+    def test_hits(self):
+        first = [self.cache.match(string) for string in self.STRINGS]
+        second = [self.cache.match(string) for string in self.STRINGS]
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (5, 5))
+        self.assertEqual(first, second)
+        self.assertEqual(second[1].values, ('2',))
+        self.assertEqual([
+            None if match is None else (match.route.path, match.params)
+            for match in second
+        ], self.expected())
+
+    def test_methods(self):
+        self.assertEqual(self.cache.match('/files/a', 'GET').params, {'path': ['a']})
+        self.assertEqual(self.cache.match('/files/a', 'GET').params, {'path': ['a']})
+        for _ in range(2):
+            with self.assertRaises(repath.MethodNotAllowed):
+                self.cache.match('/files/a', 'POST')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+    def test_shared_between_processes(self):
+        for string in self.STRINGS:
+            self.cache.match(string)
+
+        hits, matches = self.spawn()
+        self.assertEqual(hits, len(self.STRINGS))
+        self.assertEqual(matches, self.expected())
+
+    def test_filled_by_other_process(self):
+        self.assertEqual(self.spawn()[0], 0)
+
+        self.assertEqual(
+            [None if match is None else (match.route.path, match.params)
+             for match in map(self.cache.match, self.STRINGS)],
+            self.expected())
+        self.assertEqual(self.cache.hits, len(self.STRINGS))
+
+    def test_generation(self):
+        for string in self.STRINGS:
+            self.cache.match(string)
+
+        hits, matches = self.spawn(extra=True)
+        self.assertEqual(hits, 0)
+        self.assertEqual(matches, self.expected(_cache_router(extra=True)))
+
+        self.cache.invalidate()
+        self.cache.match(self.STRINGS[0])
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_converters(self):
+        def router(converters=None):
+            router = repath.Router(converters=converters)
+            router.add('/:id')
+            return router
+
+        text = repath.Converter('[0-9]+', str, str, ())
+        routers = [router(), router({'id': 'int'}), router({'id': text})]
+        generations = set()
+        for each in routers:
+            with repath.SharedMatchCache(each, slots=1) as cache:
+                cache.unlink()
+                generations.add(cache.generation)
+        self.assertEqual(len(generations), 3)
+
+        with repath.SharedMatchCache(routers[0], slots=64) as cache:
+            self.addCleanup(cache.unlink)
+            self.assertEqual(cache.match('/abc').params, {'id': 'abc'})
+            self.assertEqual(cache.match('/1').params, {'id': '1'})
+            with repath.SharedMatchCache(routers[1], name=cache.name) as other:
+                self.assertIsNone(other.match('/abc'))
+                self.assertEqual(other.match('/1').params, {'id': 1})
+                self.assertEqual(other.hits, 0)
+
+    def test_shared_patterns(self):
+        router = repath.Router()
+        for tenant in ('acme', 'globex'):
+            router.add('/t/%s/items/:item' % tenant)
+
+        with repath.SharedMatchCache(router, slots=64) as cache:
+            self.addCleanup(cache.unlink)
+            miss = cache.match('/t/acme/items/7')
+            hit = cache.match('/t/acme/items/7')
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(miss.values, ('7',))
+        self.assertEqual(hit.values, miss.values)
+        self.assertEqual(hit.params, {'item': '7'})
+
+    def test_mounted_router(self):
+        def router(prefix):
+            router = _cache_router()
+            router.mount(prefix, _cache_router())
+            return router
+
+        generations = set()
+        for prefix in ('/api', '/v2'):
+            with repath.SharedMatchCache(router(prefix), slots=1) as cache:
+                cache.unlink()
+                generations.add(cache.generation)
+        self.assertEqual(len(generations), 2)
+
+        with repath.SharedMatchCache(router('/api'), slots=64) as cache:
+            self.addCleanup(cache.unlink)
+            for _ in range(2):
+                self.assertEqual(cache.match('/users/1').params, {'id': 1})
+                self.assertEqual(cache.match('/api/users/1').params, {'id': 1})
+                self.assertIsNone(cache.match('/v2/users/1'))
+            self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_torn_slot(self):
+        self.cache.match('/users/1')
+        buf = self.cache.memory.buf
+        for offset in range(self.cache._header.size, len(buf), self.cache._slot):
+            if any(buf[offset:offset + self.cache._slot]):
+                buf[offset + 20] ^= 0xFF
+
+        self.assertEqual(self.cache.match('/users/1').params, {'id': 1})
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_attach_to_other_memory(self):
+        from multiprocessing import shared_memory
+
+        memory = shared_memory.SharedMemory(create=True, size=64)
+        self.addCleanup(memory.unlink)
+        self.addCleanup(memory.close)
+
+        with self.assertRaises(ValueError):
+            repath.SharedMatchCache(self.router, name=memory.name)
+
+
+class OptimizedPatternTests(unittest.TestCase):
+    PATHS = [
+        '/users/:id', '/:a/:b/', '/files/:name.:ext', '/:a?/x', '/a/*',
+        '/:a+', '/:a*/b', '/:a/:b?', '/:a.:b', '/x/:a-:b', '/:a(\\d+)/:b',
+        '/:a/', '/', '/:a.json', ':a', '.:a', '/:a<int>/:b', '/:a/b/:c/',
+        '/a/:b?/:c?', '/:a/:b*', '/:foo.:bar?', '/test\\/:a', '/:a/x.:b',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        # Every string of up to 4 of these characters, and longer ones
+        alphabet = ['a', 'B', '/', '.', '-', '\n', '1']
+        strings = level = ['']
+        for _ in range(4):
+            level = [string + c for string in level for c in alphabet]
+            strings = strings + level
+
+        rand = random.Random(0)
+        strings += [
+            ''.join(rand.choice(alphabet) for _ in range(rand.randint(5, 12)))
+            for _ in range(500)
+        ]
+        cls.strings = strings
+
+    def result(self, regex, string):
+        match = regex.match(string)
+        return match and (match.group(0), match.groups())
+
+    def test_same_matches(self):
+        for path in self.PATHS:
+            for end in (True, False):
+                for strict in (True, False):
+                    for flags in (0, re.I):
+                        default = repath.compile(
+                            path, flags, end=end, strict=strict)
+                        optimized = repath.compile(
+                            path, flags, end=end, strict=strict, optimize=True)
+                        for string in self.strings:
+                            self.assertEqual(
+                                self.result(optimized, string),
+                                self.result(default, string),
+                                (path, end, strict, flags, string)
+                            )
+
+    def test_patterns(self):
+        self.assertEqual(
+            repath.pattern('/users/:id/', strict=True, optimize=True),
+            '^/users/(?P<id>[^/]{0})/$'.format('+' + repath.POSSESSIVE)
+        )
+        self.assertEqual(
+            repath.pattern('/users', optimize=True), '^/users/?$'
+        )
+        self.assertEqual(
+            repath.pattern('/:a.:b', optimize=True),
+            '^/(?P<a>[^/]+?)\\.(?P<b>[^.]+?)/?$'
+        )
+        self.assertEqual(
+            repath.pattern('/users', end=False, optimize=True),
+            repath.pattern('/users', end=False)
+        )
+
+
+class FactoredPatternTests(unittest.TestCase):
+    PIECES = ['/a', '/ab', '/b', '/(\\d+)', '/:x', '.json', '/*', '/a\\*', '-c']
+
+    def test_factored(self):
+        self.assertEqual(
+            repath.pattern(['/api/users', '/api/users/:id', '/api/orders', '/'],
+                           strict=True, factor=True),
+            '(?:^/(?:api/(?:users(?:$|/(?P<id>[^/]+?)$)|orders$)|$))'
+        )
+        self.assertEqual(
+            repath.pattern([b'/a/b', b'/a/c'], strict=True, factor=True),
+            b'(?:^/a/(?:b$|c$))'
+        )
+        self.assertEqual(
+            repath.pattern(['/a\\*b', '/a\\*c'], strict=True, factor=True),
+            '(?:^/a\\*(?:b$|c$))'
+        )
+
+    def test_only_consecutive_branches_are_factored(self):
+        self.assertEqual(
+            repath.pattern(['/a/b', '/c', '/a/d', re.compile('/a/e')],
+                           strict=True, factor=True),
+            '(?:^/(?:a/b$|c$|a/d$)|/a/e)'
+        )
+
+    def test_same_matches(self):
+        rand = random.Random(0)
+        alphabet = ['a', 'b', '/', '1', '.', 'json', '*', '-c', '\n']
+        strings = [
+            ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 6)))
+            for _ in range(300)
+        ]
+
+        for _ in range(50):
+            names = iter(range(100))
+            paths = [
+                re.sub(':x', lambda match: ':x%d' % next(names), ''.join(
+                    rand.choice(self.PIECES) for _ in range(rand.randint(1, 3))
+                ))
+                for _ in range(rand.randint(2, 8))
+            ]
+
+            for end in (True, False):
+                for strict in (True, False):
+                    flat = repath.compile(paths, end=end, strict=strict)
+                    factored = repath.compile(
+                        paths, end=end, strict=strict, factor=True)
+
+                    for string in strings:
+                        for method in ('match', 'search'):
+                            expected = getattr(flat, method)(string)
+                            found = getattr(factored, method)(string)
+                            self.assertEqual(
+                                found and (found.span(), found.groupdict(),
+                                           found.groups()),
+                                expected and (expected.span(),
+                                              expected.groupdict(),
+                                              expected.groups()),
+                                (paths, end, strict, string)
+                            )
+
+
+def wsgi_request(application, path, method='GET'):
+    """
+    Call a WSGI application the way a server would, returning its status,
+    headers and body.
+
+    """
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'wsgi.input': io.BytesIO()}
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+
+    body = b''.join(application(environ, start_response))
+    return response[0], response[1], body, environ
+
+
+def asgi_request(application, scope):
+    """
+    Run an ASGI application for one connection, returning the messages it
+    sent.
+
+    """
+    sent = []
+    messages = [{'type': 'http.request', 'body': b''}]
+    if scope['type'] == 'lifespan':
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    return sent
+
+
+class WSGIDispatcherTests(unittest.TestCase):
+    def setUp(self):
+        def show_user(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['repath.params']['id'].encode('ascii')]
+
+        def fail(environ, start_response):
+            raise RuntimeError
+
+        self.router = repath.Router()
+        self.router.add('/users/:id', show_user, methods=['GET'])
+        self.router.add('/fail', fail)
+        self.dispatcher = repath.WSGIDispatcher(self.router)
+
+    def test_dispatch(self):
+        status, headers, body, environ = wsgi_request(self.dispatcher, '/users/42')
+
+        self.assertEqual((status, body), ('200 OK', b'42'))
+        self.assertEqual(environ['repath.route'].path, '/users/:id')
+        self.assertEqual(environ['wsgiorg.routing_args'], ((), {'id': '42'}))
+
+    def test_not_found(self):
+        status, headers, body, environ = wsgi_request(self.dispatcher, '/nothing')
+
+        self.assertEqual((status, body), ('404 Not Found', b'Not Found'))
+        self.assertNotIn('repath.route', environ)
+
+        dispatcher = repath.WSGIDispatcher(
+            self.router, not_found=lambda environ, start_response: (
+                start_response('410 Gone', []) or [b'']))
+        self.assertEqual(wsgi_request(dispatcher, '/nothing')[0], '410 Gone')
+
+    def test_method_not_allowed(self):
+        status, headers, body, environ = wsgi_request(
+            self.dispatcher, '/users/1', 'POST')
+
+        self.assertEqual(status, '405 Method Not Allowed')
+        self.assertIn(('Allow', 'GET'), headers)
+        self.assertEqual(environ['repath.allowed'], {'GET'})
+
+    def test_metrics(self):
+        wsgi_request(self.dispatcher, '/users/1')
+        wsgi_request(self.dispatcher, '/nothing')
+        self.assertRaises(RuntimeError, wsgi_request, self.dispatcher, '/fail')
+
+        metrics = self.dispatcher.metrics
+        self.assertEqual((metrics.requests, metrics.unmatched), (3, 1))
+        self.assertGreater(metrics.routing, 0)
+        self.assertGreater(metrics.handling, 0)
+
+    def test_custom_metrics(self):
+        records = []
+
+        class Metrics(object):
+            def record(self, route, routing, handling):
+                records.append((route and route.path, routing >= 0, handling >= 0))
+
+        dispatcher = repath.WSGIDispatcher(self.router, metrics=Metrics())
+        wsgi_request(dispatcher, '/users/1')
+        wsgi_request(dispatcher, '/nothing')
+
+        self.assertEqual(records, [('/users/:id', True, True), (None, True, True)])
+
+
+class ASGIDispatcherTests(unittest.TestCase):
+    def setUp(self):
+        async def show_user(scope, receive, send):
+            await receive()
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({
+                'type': 'http.response.body',
+                'body': scope['path_params']['id'].encode('ascii'),
+            })
+
+        async def echo(scope, receive, send):
+            await send({'type': 'websocket.accept'})
+
+        self.router = repath.Router()
+        self.router.add('/users/:id', show_user, methods=['GET', 'HEAD'])
+        self.router.add('/ws', echo)
+        self.dispatcher = repath.ASGIDispatcher(self.router)
+
+    def test_dispatch(self):
+        scope = {'type': 'http', 'path': '/users/42'}
+        sent = asgi_request(self.dispatcher, scope)
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(sent[1]['body'], b'42')
+        self.assertNotIn('path_params', scope)
+
+    def test_not_found(self):
+        sent = asgi_request(self.dispatcher, {'type': 'http', 'path': '/nothing'})
+        self.assertEqual(sent[0]['status'], 404)
+
+        sent = asgi_request(self.dispatcher, {'type': 'websocket', 'path': '/nothing'})
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': 1000}])
+
+    def test_method_not_allowed(self):
+        scope = {'type': 'http', 'path': '/users/1', 'method': 'PUT'}
+        sent = asgi_request(self.dispatcher, scope)
+
+        self.assertEqual(sent[0]['status'], 405)
+        self.assertIn((b'allow', b'GET, HEAD'), sent[0]['headers'])
+
+        scope = {'type': 'http', 'path': '/users/1', 'method': 'HEAD'}
+        self.assertEqual(asgi_request(self.dispatcher, scope)[0]['status'], 200)
+
+    def test_websocket(self):
+        sent = asgi_request(self.dispatcher, {'type': 'websocket', 'path': '/ws'})
+        self.assertEqual(sent, [{'type': 'websocket.accept'}])
+
+    def test_lifespan(self):
+        sent = asgi_request(self.dispatcher, {'type': 'lifespan'})
+        self.assertEqual([message['type'] for message in sent], [
+            'lifespan.startup.complete', 'lifespan.shutdown.complete'
+        ])
+        self.assertEqual(self.dispatcher.metrics.requests, 0)
+
+    def test_metrics(self):
+        asgi_request(self.dispatcher, {'type': 'http', 'path': '/users/1'})
+        asgi_request(self.dispatcher, {'type': 'http', 'path': '/nothing'})
+
+        metrics = self.dispatcher.metrics
+        self.assertEqual((metrics.requests, metrics.unmatched), (2, 1))
+        self.assertGreater(metrics.routing, 0)
+        self.assertIn('requests=2', repr(metrics))